@@ -0,0 +1,79 @@
+"""Likes and follows, shared by the pages and the JSON API.
+
+Each function acts for `user`, the logged-in CurrentUser, commits, and
+drops the cached snapshots and fragments the change affects. With
+write-behind on (see writebehind.py), the change is queued instead.
+"""
+
+import fragments
+import timeline
+import user_context
+import writebehind
+from models import db, Follows, Liked_Message, Message, User
+
+
+def toggle_like(user, message_id):
+    """Like or unlike a message.
+
+    Returns (liked, the message's like count), or None if there's no
+    such message.
+    """
+
+    queue = writebehind.get_queue()
+    if queue:
+        message = Message.query.get(message_id)
+        if message is None:
+            return None
+
+        stored = message_id in User.liked_message_ids(user, [message_id])
+        liked = message_id not in user.liked_message_ids([message_id])
+        queue.enqueue(writebehind.LIKE, user.id, message_id, liked)
+        return liked, message.likes_count + liked - stored
+
+    result = Liked_Message.toggle(user.id, message_id)
+    if result is None:
+        return None
+
+    db.session.commit()
+    user_context.invalidate(user.id)
+    fragments.invalidate('message', message_id)
+
+    return result
+
+
+def follow(user, followed_id):
+    """Follow another user; False if there's no such user."""
+
+    followed_user = User.query.get(followed_id)
+    if followed_user is None:
+        return False
+
+    queue = writebehind.get_queue()
+    if queue:
+        queue.enqueue(writebehind.FOLLOW, user.id, followed_id, True)
+        return True
+
+    if Follows.add(user.id, followed_id):
+        User.adjust_counts(user.id, following_count=1)
+        User.adjust_counts(followed_id, followers_count=1)
+        timeline.backfill(user.id, followed_id)
+    db.session.commit()
+    user_context.invalidate(user.id, followed_id)
+
+    return True
+
+
+def unfollow(user, followed_id):
+    """Stop following another user."""
+
+    queue = writebehind.get_queue()
+    if queue:
+        queue.enqueue(writebehind.FOLLOW, user.id, followed_id, False)
+        return
+
+    if Follows.remove(user.id, followed_id):
+        User.adjust_counts(user.id, following_count=-1)
+        User.adjust_counts(followed_id, followers_count=-1)
+        timeline.trim(user.id, followed_id)
+    db.session.commit()
+    user_context.invalidate(user.id, followed_id)
@@ -0,0 +1,291 @@
+"""Warbler's JSON API, version 1, under /api/v1.
+
+Read endpoints select just the columns they return, as row tuples, and
+serialize those directly; no ORM objects are built. Lists come a page
+at a time:
+
+    {"items": [...], "next_cursor": "..."}
+
+Pass next_cursor back as ?cursor= for the following page; it's null on
+the last one. The API authenticates with the site's session cookie.
+
+Responses of API_COMPRESS_MIN_SIZE bytes or more are compressed, with
+brotli if the client accepts it and the brotli package is installed,
+otherwise with gzip. orjson, if installed, speeds up encoding.
+"""
+
+import gzip
+import json
+from functools import wraps
+
+from flask import Blueprint, current_app, g, request
+
+import actions
+import timeline
+from models import db, Follows, Liked_Message, Message, User
+from pagination import InvalidCursor, paginate
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+MESSAGE_COLUMNS = (Message.id, Message.text, Message.timestamp,
+                   Message.likes_count, Message.user_id,
+                   User.username, User.image_url)
+
+PROFILE_COLUMNS = (User.id, User.username, User.image_url,
+                   User.header_image_url, User.bio, User.location,
+                   User.messages_count, User.followers_count,
+                   User.following_count, User.likes_count)
+
+PROFILE_FIELDS = tuple(column.key for column in PROFILE_COLUMNS)
+
+
+##############################################################################
+# Serialization
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def respond(data, status=200):
+    return current_app.response_class(dumps(data), status=status,
+                                      mimetype='application/json')
+
+
+def error(status, message):
+    return respond({'error': message}, status)
+
+
+def page_response(items, page):
+    return respond({'items': items, 'next_cursor': page.next_cursor})
+
+
+def message_query():
+    """Query for message rows: MESSAGE_COLUMNS, author joined."""
+
+    return (db.session
+            .query(*MESSAGE_COLUMNS)
+            .join(User, User.id == Message.user_id))
+
+
+def serialize_messages(rows):
+    liked = (g.user.liked_message_ids([row[0] for row in rows])
+             if g.user else set())
+
+    return [{'id': id,
+             'text': text,
+             'timestamp': timestamp.isoformat(),
+             'likes_count': likes_count,
+             'liked': id in liked,
+             'user': {'id': user_id,
+                      'username': username,
+                      'image_url': image_url}}
+            for id, text, timestamp, likes_count, user_id, username, image_url
+            in rows]
+
+
+def serialize_cards(rows):
+    return [{'id': id,
+             'username': username,
+             'image_url': image_url,
+             'header_image_url': header_image_url,
+             'bio': bio,
+             'following': g.user.follows(id, viewer_follows)}
+            for (id, username, image_url, header_image_url, bio, version,
+                 viewer_follows)
+            in rows]
+
+
+##############################################################################
+# Hooks and errors
+
+def login_required(function):
+    @wraps(function)
+    def wrap(**args):
+        if not g.user:
+            return error(401, "Log in first.")
+        return function(**args)
+    return wrap
+
+
+@api.errorhandler(404)
+def not_found(exc):
+    return error(404, "Not found.")
+
+
+@api.errorhandler(InvalidCursor)
+def invalid_cursor(exc):
+    return error(400, "Invalid page cursor.")
+
+
+@api.after_request
+def compress(response):
+    """Compress large responses, if the client accepts it."""
+
+    if (response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.status_code != 200):
+        return response
+
+    config = current_app.config
+    data = response.get_data()
+    if len(data) < config.get('API_COMPRESS_MIN_SIZE', 1024):
+        return response
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        data = brotli.compress(data, quality=config.get('API_BROTLI_QUALITY', 4))
+        encoding = 'br'
+    elif accepted['gzip']:
+        data = gzip.compress(data, config.get('API_GZIP_LEVEL', 6))
+        encoding = 'gzip'
+    else:
+        return response
+
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+
+    return response
+
+
+##############################################################################
+# Feeds and profiles
+
+@api.route('/timeline')
+@login_required
+def home():
+    """The logged-in user's home timeline."""
+
+    page = timeline.home_timeline(g.user, cursor=request.args.get('cursor'),
+                                  query=message_query)
+
+    return page_response(serialize_messages(page.items), page)
+
+
+@api.route('/users/<int:user_id>')
+def user(user_id):
+    """A user's profile and counts."""
+
+    row = (db.session
+           .query(*PROFILE_COLUMNS)
+           .filter(User.id == user_id)
+           .first())
+    if row is None:
+        return error(404, "No such user.")
+
+    profile = dict(zip(PROFILE_FIELDS, row))
+    if g.user:
+        profile['following'] = user_id in g.user.following_ids
+
+    return respond(profile)
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """A user's messages, newest first."""
+
+    page = paginate(message_query().filter(Message.user_id == user_id),
+                    [Message.timestamp, Message.id],
+                    cursor=request.args.get('cursor'))
+
+    return page_response(serialize_messages(page.items), page)
+
+
+@api.route('/users/<int:user_id>/followers')
+@login_required
+def followers(user_id):
+    """The users following a user."""
+
+    page = paginate(User
+                    .card_query(g.user.id)
+                    .join(Follows, Follows.user_following_id == User.id)
+                    .filter(Follows.user_being_followed_id == user_id),
+                    [Follows.user_following_id],
+                    cursor=request.args.get('cursor'),
+                    descending=False,
+                    key=lambda row: [row.id])
+
+    return page_response(serialize_cards(page.items), page)
+
+
+@api.route('/users/<int:user_id>/following')
+@login_required
+def following(user_id):
+    """The users a user follows."""
+
+    page = paginate(User
+                    .card_query(g.user.id)
+                    .join(Follows, Follows.user_being_followed_id == User.id)
+                    .filter(Follows.user_following_id == user_id),
+                    [Follows.user_being_followed_id],
+                    cursor=request.args.get('cursor'),
+                    descending=False,
+                    key=lambda row: [row.id])
+
+    return page_response(serialize_cards(page.items), page)
+
+
+@api.route('/users/<int:user_id>/likes')
+@login_required
+def likes(user_id):
+    """The messages a user has liked, most recently posted first."""
+
+    page = paginate(message_query()
+                    .join(Liked_Message,
+                          Liked_Message.liked_msg_id == Message.id)
+                    .filter(Liked_Message.liker_id == user_id),
+                    [Liked_Message.liked_msg_id],
+                    cursor=request.args.get('cursor'),
+                    key=lambda row: [row.id])
+
+    return page_response(serialize_messages(page.items), page)
+
+
+##############################################################################
+# Actions
+
+@api.route('/messages/<int:message_id>/like', methods=['POST'])
+@login_required
+def toggle_like(message_id):
+    """Like the message, or unlike it if it's liked."""
+
+    result = actions.toggle_like(g.user, message_id)
+    if result is None:
+        return error(404, "No such message.")
+
+    liked, likes_count = result
+    return respond({'id': message_id, 'liked': liked,
+                    'likes_count': likes_count})
+
+
+@api.route('/users/<int:user_id>/follow', methods=['POST'])
+@login_required
+def toggle_follow(user_id):
+    """Follow the user, or unfollow them if they're followed."""
+
+    if user_id == g.user.id:
+        return error(400, "You can't follow yourself.")
+
+    # Not g.user.following_ids: the snapshot may be stale. A queued
+    # follow or unfollow still counts (see CurrentUser.follows).
+    stored = Follows.exists(g.user.id, user_id)
+    if g.user.follows(user_id, stored):
+        actions.unfollow(g.user, user_id)
+        return respond({'id': user_id, 'following': False})
+
+    if not actions.follow(g.user, user_id):
+        return error(404, "No such user.")
+
+    return respond({'id': user_id, 'following': True})
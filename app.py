@@ -1,12 +1,32 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+
+from flask import (Flask, render_template, request, flash, redirect, session, g,
+                   abort, jsonify)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 from functools import wraps
 
+import actions
+from api import api
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Liked_Message
+from models import db, connect_db, User, Message, Liked_Message, Follows
+import db_pool
+import fragments
+import http_cache
+import instrumentation
+import loader
+import migrate
+import search
+import streaming
+import timeline
+import user_context
+import writebehind
+from pagination import InvalidCursor, paginate
+import passwords
+import replicas
+from passwords import PasswordHasherBusy
 
 CURR_USER_KEY = "curr_user"
 
@@ -18,11 +38,113 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgres:///warbler'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
+# Pool sizing, recycling, pre-ping and statement timeout come from DB_*
+# environment variables; see db_pool.py.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = db_pool.engine_options(
+    app.config['SQLALCHEMY_DATABASE_URI'])
+# Read-only requests go to these replicas, if any; see replicas.py.
+app.config['DATABASE_REPLICA_URLS'] = [
+    url.strip()
+    for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    if url.strip()]
+app.config['REPLICA_STRATEGY'] = os.environ.get(
+    'REPLICA_STRATEGY', 'round_robin')
+app.config['REPLICA_PIN_SECONDS'] = 10
+app.config['REPLICA_RETRY_SECONDS'] = 30
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "nevertell")
+
+# Accounts with more followers than this are merged into home timelines at
+# read time instead of being copied into every follower's timeline.
+app.config['TIMELINE_FANOUT_THRESHOLD'] = int(
+    os.environ.get('TIMELINE_FANOUT_THRESHOLD', 10000))
+app.config['TIMELINE_BACKFILL_LIMIT'] = 100
+
+# Rows per page for cursor-paginated lists (feeds, likes, users).
+app.config['PAGE_SIZE'] = 100
+
+# Message searches rank only this many of the newest matches.
+app.config['SEARCH_MAX_CANDIDATES'] = 5000
+
+# gunicorn worker processes (gunicorn.conf.py sets WEB_CONCURRENCY).
+# Per-process caches and brokers only suit one.
+app.config['WEB_CONCURRENCY'] = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+# Snapshots of the logged-in user, cached between requests. 'memory' is
+# per process, so it's only the default for a single worker; with more,
+# snapshots go in Redis if USER_CACHE_URL is set and aren't cached if not.
+app.config['USER_CACHE_URL'] = os.environ.get('USER_CACHE_URL')
+if app.config['WEB_CONCURRENCY'] == 1:
+    _user_cache_default = 'memory'
+elif app.config['USER_CACHE_URL']:
+    _user_cache_default = 'redis'
+else:
+    _user_cache_default = 'null'
+app.config['USER_CACHE_BACKEND'] = os.environ.get('USER_CACHE_BACKEND',
+                                                  _user_cache_default)
+app.config['USER_CACHE_TTL'] = 60
+app.config['USER_CACHE_SIZE'] = 10000
+
+# bcrypt runs in a pool of PASSWORD_HASH_WORKERS processes (0: inline);
+# at most PASSWORD_HASH_MAX_PENDING hashes may be waiting at once. More, or
+# a hash taking over PASSWORD_HASH_TIMEOUT seconds, gets a 503.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_MAX_PENDING'] = 32
+app.config['PASSWORD_HASH_TIMEOUT'] = 10
+
+# Query counts and timings per request: see instrumentation.py.
+app.config['INSTRUMENTATION_ENABLED'] = True
+app.config['SLOW_QUERY_MS'] = int(os.environ.get('SLOW_QUERY_MS', 100))
+app.config['N_PLUS_ONE_THRESHOLD'] = 10
+app.config['SLOWEST_STATEMENTS'] = 5
+app.config['INTERNAL_METRICS_TOKEN'] = os.environ.get('INTERNAL_METRICS_TOKEN')
+app.config['METRICS_ENABLED'] = os.environ.get(
+    'METRICS_ENABLED', '').lower() in ('1', 'true', 'yes', 'on')
+
+# Rendered message items and user cards ({% cache %} in templates). Like
+# the user cache, the 'redis' backend shares them across workers.
+app.config['FRAGMENT_CACHE_ENABLED'] = True
+app.config['FRAGMENT_CACHE_BACKEND'] = os.environ.get(
+    'FRAGMENT_CACHE_BACKEND', 'memory')
+app.config['FRAGMENT_CACHE_URL'] = os.environ.get('FRAGMENT_CACHE_URL')
+app.config['FRAGMENT_CACHE_TTL'] = 3600
+app.config['FRAGMENT_CACHE_SIZE'] = 50000
+
+# Queue likes and follows locally and apply them in batches from a
+# background thread; see writebehind.py.
+app.config['WRITE_BEHIND_ENABLED'] = os.environ.get(
+    'WRITE_BEHIND_ENABLED', '').lower() in ('1', 'true', 'yes', 'on')
+app.config['WRITE_BEHIND_PATH'] = os.environ.get('WRITE_BEHIND_PATH')
+app.config['WRITE_BEHIND_INTERVAL'] = 0.5
+app.config['WRITE_BEHIND_BATCH_SIZE'] = 500
+
+# JSON API responses this big or bigger are gzip/brotli compressed.
+app.config['API_COMPRESS_MIN_SIZE'] = 1024
+app.config['API_GZIP_LEVEL'] = 6
+app.config['API_BROTLI_QUALITY'] = 4
+
+# Server-sent events for new messages on the home page, off unless
+# STREAM_BROKER is set: 'redis' reaches streams on every worker, 'local'
+# only those in the same process, so it only suits a single worker.
+app.config['STREAM_BROKER'] = os.environ.get('STREAM_BROKER')
+app.config['STREAM_BROKER_URL'] = os.environ.get('STREAM_BROKER_URL',
+                                                 'redis://localhost:6379/0')
+app.config['STREAM_KEEPALIVE'] = 15
+app.config['STREAM_MAX_SECONDS'] = 300
+
 # toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+replicas.init_app(app)
+user_context.init_app(app)
+passwords.init_app(app)
+instrumentation.init_app(app)
+fragments.init_app(app)
+writebehind.init_app(app)
+app.register_blueprint(api)
+streaming.init_app(app)
 
 
 ##############################################################################
@@ -34,7 +156,13 @@ def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = user_context.load(session[CURR_USER_KEY])
+
+        queue = writebehind.get_queue()
+        if g.user and queue:
+            pending = queue.pending(g.user.id)
+            g.user.overlay(pending[writebehind.FOLLOW],
+                           pending[writebehind.LIKE])
 
     else:
         g.user = None
@@ -89,6 +217,7 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        search.user_changed(user)
         do_login(user)
 
         return redirect("/")
@@ -108,6 +237,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # Saves the password hash if authenticate upgraded it.
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -134,17 +265,24 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username, bio and
+    location; results come best match first.
     """
 
-    search = request.args.get('q')
+    q = request.args.get('q')
+    cursor = request.args.get('cursor')
 
-    if not search:
-        users = User.query.all()
+    if not q:
+        users = paginate(User.query,
+                         [User.username],
+                         cursor=cursor,
+                         descending=False)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = search.search_users(q, cursor=cursor)
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html',
+                           users=users,
+                           next_cursor=users.next_cursor)
 
 
 @app.route('/users/<int:user_id>')
@@ -153,14 +291,19 @@ def users_show(user_id):
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
+    messages = paginate(Message
+                        .timeline_query()
+                        .filter(Message.user_id == user_id),
+                        [Message.timestamp, Message.id],
+                        cursor=request.args.get('cursor'))
     user = User.query.get_or_404(user_id)
-    return render_template('users/show.html', user=user, messages=messages)
+    liked_ids = liked_by_current_user(messages)
+
+    return render_template('users/show.html',
+                           user=user,
+                           messages=messages,
+                           liked_ids=liked_ids,
+                           next_cursor=messages.next_cursor)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -168,8 +311,17 @@ def users_show(user_id):
 def show_following(user_id):
     """Show list of people this user is following."""
     user = User.query.get_or_404(user_id)
+    users = paginate(User
+                     .card_query(g.user.id)
+                     .join(Follows, Follows.user_being_followed_id == User.id)
+                     .filter(Follows.user_following_id == user_id),
+                     [Follows.user_being_followed_id],
+                     cursor=request.args.get('cursor'),
+                     descending=False,
+                     key=lambda row: [row.id])
 
-    return render_template('users/following.html', user=user)
+    return render_template('users/following.html', user=user, users=users,
+                           next_cursor=users.next_cursor)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -177,9 +329,17 @@ def show_following(user_id):
 def users_followers(user_id):
     """Show list of followers of this user."""
     user = User.query.get_or_404(user_id)
+    users = paginate(User
+                     .card_query(g.user.id)
+                     .join(Follows, Follows.user_following_id == User.id)
+                     .filter(Follows.user_being_followed_id == user_id),
+                     [Follows.user_following_id],
+                     cursor=request.args.get('cursor'),
+                     descending=False,
+                     key=lambda row: [row.id])
 
-    return render_template('users/followers.html', user=user)
-
+    return render_template('users/followers.html', user=user, users=users,
+                           next_cursor=users.next_cursor)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -187,9 +347,8 @@ def users_followers(user_id):
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    if not actions.follow(g.user, follow_id):
+        abort(404)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -198,29 +357,33 @@ def add_follow(follow_id):
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    actions.unfollow(g.user, follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
+@check_login
 def profile():
     """Update profile for current user."""
-    form = UserEditForm(obj=g.user)
+    user = g.user.model
+    form = UserEditForm(obj=user)
 
     if form.validate_on_submit():
         pwd = form.password.data
-        if User.authenticate(username=g.user.username, password=pwd):
-            g.user.username = form.username.data
-            g.user.email = form.email.data
-            g.user.image_url = form.image_url.data
-            g.user.header_image_url = form.header_image_url.data
-            g.user.bio = form.bio.data
-
-            db.session.add(g.user)
+        if user.check_password(pwd):
+            user.username = form.username.data
+            user.email = form.email.data
+            user.image_url = form.image_url.data
+            user.header_image_url = form.header_image_url.data
+            user.bio = form.bio.data
+            user.version = User.version + 1
+
+            db.session.add(user)
             db.session.commit()
+            user_context.invalidate(user.id)
+            fragments.invalidate('user', user.id)
+            search.user_changed(user)
 
             flash('Profile successfully updated', 'success')
             return redirect('/')
@@ -239,8 +402,15 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    user_id = g.user.id
+    g.user.release_counts()
+    # Let the database cascades remove messages, follows and likes rather
+    # than loading every related row into the session first.
+    User.query.filter(User.id == user_id).delete(synchronize_session=False)
     db.session.commit()
+    user_context.invalidate(user_id)
+    fragments.invalidate('user', user_id)
+    search.user_deleted(user_id)
 
     return redirect("/signup")
 
@@ -248,6 +418,15 @@ def delete_user():
 ##############################################################################
 # Messages routes:
 
+def liked_by_current_user(messages):
+    """Ids of the given messages that the logged-in user has liked."""
+
+    if not g.user:
+        return set()
+
+    return g.user.liked_message_ids([msg.id for msg in messages])
+
+
 @app.route('/messages/new', methods=["GET", "POST"])
 @check_login
 def messages_add():
@@ -259,22 +438,47 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        User.adjust_counts(g.user.id, messages_count=1)
+        db.session.flush()
+        timeline.fan_out(msg)
+        search.message_added(msg)
+        event = streaming.message_event(msg, g.user)
         db.session.commit()
+        user_context.invalidate(g.user.id)
+        streaming.publish(g.user.id, event)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Page of messages matching the 'q' param, best matches first."""
+
+    q = request.args.get('q', '')
+    messages = search.search_messages(q, cursor=request.args.get('cursor'))
+    liked_ids = liked_by_current_user(messages)
+
+    return render_template('messages/search.html',
+                           q=q,
+                           messages=messages,
+                           liked_ids=liked_ids,
+                           next_cursor=messages.next_cursor)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    likers_ids = [liker.id for liker in msg.likers]
-    return render_template('messages/show.html', message=msg, likers_ids=likers_ids)
+    msg = Message.query.get_or_404(message_id)
+    liked_ids = liked_by_current_user([msg])
+
+    return render_template('messages/show.html',
+                           message=msg,
+                           liked_ids=liked_ids)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -282,50 +486,78 @@ def messages_show(message_id):
 def messages_destroy(message_id):
     """Delete a message."""
 
-    if Message.query.get(message_id).first().user_id is not g.user.id:
+    msg = Message.query.get_or_404(message_id)
+
+    if msg.user_id != g.user.id:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
-    db.session.delete(msg)
+    likers = db.session.query(Liked_Message.liker_id).filter(
+        Liked_Message.liked_msg_id == msg.id)
+    User.query.filter(User.id.in_(likers.subquery())).update(
+        {User.likes_count: User.likes_count - 1,
+         User.version: User.version + 1},
+        synchronize_session=False)
+    User.adjust_counts(g.user.id, messages_count=-1)
+
+    message_id = msg.id
+    Message.query.filter(Message.id == message_id).delete(
+        synchronize_session=False)
     db.session.commit()
+    user_context.invalidate(g.user.id)
+    fragments.invalidate('message', message_id)
+    search.message_deleted(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
 
 @app.route("/like", methods=["POST"])
+@check_login
 def like_message():
-    """Shows whether a message is liked."""
+    """Like or unlike a message, then go back to the page it was on."""
 
-    msg_id = int(request.form["message_id"])
+    if actions.toggle_like(g.user, int(request.form["message_id"])) is None:
+        abort(404)
 
-    liked_message = Liked_Message.query.filter(
-        Liked_Message.liker_id == g.user.id,
-        Liked_Message.liked_msg_id == msg_id).first()
+    return redirect(request.referrer or "/")
 
-    if liked_message:
-        db.session.delete(liked_message)
-    else:
-        new_liked_message = Liked_Message(
-            liker_id=g.user.id, liked_msg_id=msg_id)
 
-        db.session.add(new_liked_message)
-    
-    db.session.commit()
+@app.route("/messages/<int:message_id>/like", methods=["POST"])
+def like_message_json(message_id):
+    """Like or unlike a message; respond with its new state as JSON."""
+
+    if not g.user:
+        return jsonify(error="Log in to like messages."), 401
 
-    return redirect(request.referrer)
+    result = actions.toggle_like(g.user, message_id)
+    if result is None:
+        abort(404)
+
+    liked, likes_count = result
+    return jsonify(message_id=message_id, liked=liked,
+                   likes_count=likes_count)
 
 
 @app.route("/users/<int:user_id>/likes")
+@check_login
 def liked_messages(user_id):
     """Shows all messages liked by a user."""
 
-    liked_messages_list = db.session.query(Liked_Message, Message).filter(
-        Liked_Message.liker_id == g.user.id).join(Message).all()
-
-    liked_msgs = [msg[1] for msg in liked_messages_list]
-
-    return render_template("likes.html", liked_msgs=liked_msgs)
+    # Most recently posted first; paging on the liked message id walks the
+    # liked_messages primary key instead of sorting all of a user's likes.
+    liked_msgs = paginate(Message
+                          .timeline_query()
+                          .join(Liked_Message)
+                          .filter(Liked_Message.liker_id == user_id),
+                          [Liked_Message.liked_msg_id],
+                          cursor=request.args.get('cursor'),
+                          key=lambda msg: [msg.id])
+    liked_ids = liked_by_current_user(liked_msgs)
+
+    return render_template("likes.html",
+                           liked_msgs=liked_msgs,
+                           liked_ids=liked_ids,
+                           next_cursor=liked_msgs.next_cursor)
 
 ##############################################################################
 # Homepage and error pages
@@ -336,36 +568,81 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, 100 per page
     """
 
     if g.user:
-        follower_ids = [follower.id for follower in g.user.following]
-        messages = (Message
-                    .query.filter(Message.user_id.in_(follower_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        # likers_ids = [liker.id for liker in messages.likers]
-        return render_template('home.html', messages=messages)
+        messages = timeline.home_timeline(g.user,
+                                          cursor=request.args.get('cursor'))
+        liked_ids = liked_by_current_user(messages)
+
+        return render_template('home.html',
+                               messages=messages,
+                               liked_ids=liked_ids,
+                               next_cursor=messages.next_cursor)
 
     else:
         return render_template('home-anon.html')
 
 
+@app.errorhandler(InvalidCursor)
+def invalid_cursor(error):
+    """Reject page cursors that we didn't hand out."""
+
+    return "Invalid page cursor.", 400
+
+
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    """Shed logins and signups while the password hasher is backed up."""
+
+    return "Too many logins in progress; try again shortly.", 503, {
+        'Retry-After': '5'}
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+# Command line
+
+
+@app.cli.command()
+def recount():
+    """Recompute the denormalized user and message counters."""
+
+    users, messages = User.recount()
+    db.session.commit()
+
+    click.echo(f"Recounted {users} users and {messages} messages.")
+
+
+@app.cli.command()
+def reindex():
+    """Rebuild the user and message search indexes."""
+
+    click.echo(search.rebuild_indexes())
+    db.session.commit()
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply the schema migrations the database hasn't had yet."""
+
+    migrations = migrate.upgrade(db.engine, echo=click.echo)
+    click.echo(f"Applied {len(migrations)} migrations.")
+
+
+@app.cli.command()
+@click.option('--directory', default='generator',
+              help="Directory holding users.csv, messages.csv, ...")
+@click.option('--chunk-size', default=loader.CHUNK_SIZE,
+              help="Rows sent to the database at a time.")
+def seed(directory, chunk_size):
+    """Drop everything and bulk-load the sample data CSVs."""
+
+    loader.seed(directory, chunk_size, echo=click.echo)
+
+
+##############################################################################
+# HTTP caching: ETags for read pages, fingerprinted static files.
+# See http_cache.py for the per-route rules.
+
+http_cache.init_app(app)
@@ -0,0 +1,231 @@
+"""Load test: throughput of each gunicorn worker class under many clients.
+
+Starts gunicorn once per worker class (see gunicorn.conf.py) against the
+benchmark dataset, and holds --concurrency connections open against it
+(500 by default). Each run drives two scenarios:
+
+- 'pages': logged-in page views (home, profiles, messages), the same
+  requests benchmarks/routes.py makes. These mostly wait on Postgres.
+- 'login': GET /login for a CSRF token, then POST the credentials.
+  bcrypt makes these CPU-bound.
+
+For each worker class and scenario it reports requests per second,
+p50/p95/p99 latency and failures (errors, timeouts and refused
+connections). The client runs in this process, on the same machine, so
+it competes with the server for CPU; compare the classes with each
+other, not with numbers from another machine.
+
+    python -m benchmarks.concurrency --users 5000 --messages 50000
+    python -m benchmarks.concurrency --no-seed --classes sync,gevent
+
+The database (--database, default postgresql:///warbler-bench) is
+dropped and reloaded with generator/create_csvs.py unless --no-seed is
+given, as for benchmarks/routes.py. gevent runs need gevent and
+psycogreen installed.
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.client import HTTPConnection
+from urllib.parse import urlencode
+
+from benchmarks.routes import seed, session_cookie, start_gunicorn, summarize
+
+SCENARIOS = ('pages', 'login')
+
+CSRF_TOKEN = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+
+# Every generated user's password (see generator/create_csvs.py).
+PASSWORD = 'password'
+
+
+def plan(db, requests, logins, rng):
+    """Build each scenario's requests, from ids in the database."""
+
+    from models import Message, User
+
+    viewers = [user_id for (user_id,) in (db.session
+                                          .query(User.id)
+                                          .filter(User.following_count > 0))]
+    users = db.session.query(User.id, User.username).all()
+    messages = [message_id for (message_id,) in db.session.query(Message.id)]
+    if not viewers or not messages:
+        raise SystemExit("The dataset needs follows and messages.")
+
+    pages = []
+    for i in range(requests):
+        path = rng.choice(['/',
+                           f"/users/{rng.choice(users)[0]}",
+                           f"/messages/{rng.choice(messages)}"])
+        pages.append((rng.choice(viewers), path))
+
+    return {'pages': pages,
+            'login': [rng.choice(users)[1] for i in range(logins)]}
+
+
+class Client:
+    """Makes one request at a time to the server at `port`."""
+
+    def __init__(self, app, port):
+        self.app = app
+        self.port = port
+
+    def request(self, method, path, headers, body=None):
+        """The response's status, headers and body; None if it failed."""
+
+        connection = HTTPConnection('127.0.0.1', self.port, timeout=60)
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            resp = connection.getresponse()
+            return resp.status, resp.getheaders(), resp.read()
+        except OSError:
+            return None
+        finally:
+            connection.close()
+
+    def pages(self, item):
+        viewer_id, path = item
+        result = self.request('GET', path,
+                              {'Cookie': session_cookie(self.app, viewer_id)})
+        return result is not None and result[0] == 200
+
+    def login(self, username):
+        result = self.request('GET', '/login', {})
+        if result is None or result[0] != 200:
+            return False
+
+        status, headers, body = result
+        token = CSRF_TOKEN.search(body.decode())
+        cookie = dict(headers).get('Set-Cookie', '').split(';')[0]
+        if token is None:
+            return False
+
+        result = self.request(
+            'POST', '/login',
+            {'Cookie': cookie,
+             'Content-Type': 'application/x-www-form-urlencoded'},
+            urlencode({'username': username, 'password': PASSWORD,
+                       'csrf_token': token.group(1)}))
+
+        # A successful login redirects; a failed one shows the form again.
+        return result is not None and result[0] == 302
+
+
+def run(client, scenario, items, concurrency):
+    """Work through `items` on `concurrency` connections at once."""
+
+    do = getattr(client, scenario)
+    queue = list(items)
+    lock = threading.Lock()
+    latencies = []
+    failures = [0]
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                item = queue.pop()
+
+            start = time.perf_counter()
+            ok = do(item)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                failures[0] += not ok
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    result = summarize(latencies, elapsed=time.perf_counter() - start)
+    result['failures'] = failures[0]
+    return result
+
+
+def report(results):
+    print(f"\n{'class':<8} {'scenario':<8} {'req/s':>8} {'p50 ms':>8} "
+          f"{'p95 ms':>8} {'p99 ms':>8} {'failed':>7}")
+
+    for worker_class, scenarios in results.items():
+        for scenario, row in scenarios.items():
+            print(f"{worker_class:<8} {scenario:<8} {row['rps']:8.1f} "
+                  f"{row['p50_ms']:8.1f} {row['p95_ms']:8.1f} "
+                  f"{row['p99_ms']:8.1f} {row['failures']:7d}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare gunicorn worker classes under many clients.")
+    parser.add_argument('--database', default='postgresql:///warbler-bench')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--follows', type=float, default=20)
+    parser.add_argument('--likes', type=float, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-seed', dest='reseed', action='store_false',
+                        help="reuse the data already in --database")
+    parser.add_argument('--classes', default='sync,gthread,gevent',
+                        help="gunicorn worker classes to compare")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--workers', type=int, default=2,
+                        help="gunicorn worker processes")
+    parser.add_argument('--concurrency', type=int, default=500,
+                        help="simultaneous connections to gunicorn")
+    parser.add_argument('--requests', type=int, default=2000,
+                        help="page views in the pages scenario")
+    parser.add_argument('--logins', type=int, default=200,
+                        help="logins in the login scenario")
+    parser.add_argument('--pool-size', type=int, default=20,
+                        help="DB_POOL_SIZE for each worker")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+
+    # Like the tests: pick the database before the app connects to it.
+    os.environ['DATABASE_URL'] = options.database
+    from app import app
+    from models import db
+
+    if options.reseed:
+        seed(options)
+
+    with app.app_context():
+        items = plan(db, options.requests, options.logins,
+                     random.Random(options.seed))
+        db.session.remove()
+
+    environ = {'DB_POOL_SIZE': str(options.pool_size),
+               'GUNICORN_WORKER_CONNECTIONS': str(options.concurrency)}
+    results = {}
+
+    for worker_class in options.classes.split(','):
+        server, port = start_gunicorn(options.database, options.workers,
+                                      worker_class, environ)
+        try:
+            client = Client(app, port)
+            results[worker_class] = {
+                scenario: run(client, scenario, items[scenario],
+                              options.concurrency)
+                for scenario in options.scenarios.split(',')}
+        finally:
+            server.terminate()
+            server.wait()
+
+    report(results)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""Microbenchmark: rendering the users listing against a following list.
+
+users/index.html asks `g.user.is_following(user)` once per card. This
+renders the listing for N users while the viewer follows F accounts, and
+compares the old check (scan every followed User) with the IdSet lookup.
+With the IdSet, time per card should stay flat as F grows, so the page
+scales linearly in N alone.
+
+Run from the repo root (no database needed):
+
+    python -m benchmarks.is_following
+"""
+
+import timeit
+from types import SimpleNamespace
+
+from flask import g, render_template
+
+from app import app
+from models import IdSet
+from pagination import Page
+from user_context import CurrentUser
+
+CARDS = (100, 1000)
+FOLLOWING = (10, 1000, 10000)
+
+
+def make_user(user_id):
+    return SimpleNamespace(id=user_id,
+                           username=f"user{user_id}",
+                           image_url="/static/images/default-pic.png",
+                           header_image_url="/static/images/warbler-hero.jpg",
+                           bio="")
+
+
+class ListScanUser(CurrentUser):
+    """The previous is_following: compare against every followed user."""
+
+    def is_following(self, other_user):
+        found = [user for user in self._following_users if user.id == other_user.id]
+        return len(found) == 1
+
+
+def viewer(user_class, following):
+    snapshot = {'id': 0, 'username': 'viewer',
+                'image_url': '/static/images/default-pic.png',
+                'following_ids': list(range(1, following * 2, 2))}
+    user = user_class(snapshot)
+    user._following_users = [make_user(i) for i in snapshot['following_ids']]
+    return user
+
+
+def time_render(user, cards):
+    users = Page([make_user(i) for i in range(1, cards + 1)])
+
+    with app.test_request_context('/users'):
+        g.user = user
+        run = lambda: render_template('users/index.html', users=users)
+        run()
+        return min(timeit.repeat(run, number=3, repeat=3)) / 3
+
+
+def time_lookups(id_set, lookups=100000):
+    probe = list(range(lookups))
+    return timeit.timeit(lambda: [i in id_set for i in probe], number=1)
+
+
+def main():
+    print("users listing render (ms per card)")
+    print(f"{'cards':>6} {'following':>9} {'list scan':>10} {'IdSet':>8}")
+    for following in FOLLOWING:
+        for cards in CARDS:
+            scan = (time_render(viewer(ListScanUser, following), cards)
+                    if following * cards <= 10 ** 6 else None)
+            fast = time_render(viewer(CurrentUser, following), cards)
+            scan_text = f"{scan * 1000 / cards:10.3f}" if scan else f"{'-':>10}"
+            print(f"{cards:>6} {following:>9} {scan_text} "
+                  f"{fast * 1000 / cards:8.3f}")
+
+    print()
+    print("100k membership checks (ms)")
+    for following in FOLLOWING:
+        ids = range(1, following * 2, 2)
+        print(f"{following:>9} following: "
+              f"IdSet {time_lookups(IdSet(ids)) * 1000:7.1f}  "
+              f"set {time_lookups(set(ids)) * 1000:7.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,459 @@
+"""Load test: time Warbler's main routes against a generated dataset.
+
+Seeds a database with generator/create_csvs.py, then drives the routes
+below. It runs them twice:
+
+- 'client': serially through Flask's test client, in this process,
+  counting SQL statements per request.
+- 'gunicorn': with concurrent connections against a real gunicorn
+  server, measuring throughput.
+
+For each route it reports p50/p95/p99 latency, queries per request and
+requests per second.
+
+    python -m benchmarks.routes --users 5000 --messages 50000 --save
+    python -m benchmarks.routes --users 5000 --messages 50000
+
+--save records the results as the baseline (benchmarks/baseline.json by
+default). Later runs compare against it and exit with status 1 if a
+route's p95 grew by more than --threshold, or its query count grew at
+all. Baselines are only comparable on the same machine with the same
+dataset options, so they aren't checked in.
+
+Any failed request (an error status, a refused connection or a timeout)
+also makes the run exit with status 1, and keeps --save from saving:
+timings of error pages say nothing about the routes.
+
+The database (--database, default postgresql:///warbler-bench) is
+dropped and reloaded unless --no-seed is given.
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.client import HTTPConnection
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GENERATOR = os.path.join(ROOT, 'generator', 'create_csvs.py')
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+ROUTES = (
+    'homepage',
+    'users_show',
+    'list_users',
+    'messages_show',
+    'like_message',
+    'add_follow',
+    'stop_following',
+)
+
+
+class Unit:
+    """Requests made in order, as one logged-in user.
+
+    Units that change data undo their own changes (like then unlike,
+    follow then unfollow), so runs can be repeated on the same dataset.
+    """
+
+    def __init__(self, viewer_id, requests):
+        self.viewer_id = viewer_id
+        self.requests = requests
+
+
+def plan(db, rounds, rng):
+    """Build the Units for each scenario, from ids in the database."""
+
+    from models import Follows, Message, User
+
+    viewers = [user_id for (user_id,) in (db.session
+                                          .query(User.id)
+                                          .filter(User.following_count > 0))]
+    users = [user_id for (user_id,) in db.session.query(User.id)]
+    messages = [message_id for (message_id,) in db.session.query(Message.id)]
+    if not viewers or not messages:
+        raise SystemExit("The dataset needs follows and messages.")
+
+    def following(viewer_id):
+        return {followed for (followed,) in (db.session
+                                             .query(Follows.user_being_followed_id)
+                                             .filter(Follows.user_following_id
+                                                     == viewer_id))}
+
+    def get(route, path):
+        return (route, 'GET', path, None)
+
+    def post(route, path, data=None):
+        return (route, 'POST', path, data)
+
+    units = {'homepage': [], 'users_show': [], 'list_users': [],
+             'messages_show': [], 'like_message': [], 'follow': []}
+
+    for i in range(rounds):
+        viewer_id = rng.choice(viewers)
+        message_id = rng.choice(messages)
+
+        units['homepage'].append(Unit(viewer_id, [get('homepage', '/')]))
+        units['users_show'].append(Unit(viewer_id, [
+            get('users_show', f"/users/{rng.choice(users)}")]))
+        units['list_users'].append(Unit(viewer_id, [
+            get('list_users', '/users'),
+            get('list_users', '/users?' + urlencode({'q': 'a'}))]))
+        units['messages_show'].append(Unit(viewer_id, [
+            get('messages_show', f"/messages/{message_id}")]))
+
+        # Toggled twice: liked then unliked, or the other way round.
+        like = post('like_message', '/like', {'message_id': message_id})
+        units['like_message'].append(Unit(viewer_id, [like, like]))
+
+        not_followed = set(rng.sample(users, min(len(users), 10)))
+        not_followed -= following(viewer_id) | {viewer_id}
+        if not_followed:
+            target = min(not_followed)
+            units['follow'].append(Unit(viewer_id, [
+                post('add_follow', f"/users/follow/{target}"),
+                post('stop_following', f"/users/stop-following/{target}")]))
+
+    # Concurrent units must not race on the same follow edge or like.
+    for name in ('like_message', 'follow'):
+        seen = set()
+        distinct = []
+        for unit in units[name]:
+            key = (unit.viewer_id, repr(unit.requests[0]))
+            if key not in seen:
+                seen.add(key)
+                distinct.append(unit)
+        units[name] = distinct
+
+    return units
+
+
+def session_cookie(app, user_id):
+    """A signed session cookie logging in `user_id`, as the app would set."""
+
+    from app import CURR_USER_KEY
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    value = serializer.dumps({CURR_USER_KEY: user_id})
+    return f"{app.session_cookie_name}={value}"
+
+
+def percentile(ordered, fraction):
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def summarize(samples, queries=None, elapsed=None):
+    """Figures for one route from its latencies (in seconds)."""
+
+    ordered = sorted(samples)
+    result = {
+        'requests': len(ordered),
+        'p50_ms': percentile(ordered, 0.50) * 1000,
+        'p95_ms': percentile(ordered, 0.95) * 1000,
+        'p99_ms': percentile(ordered, 0.99) * 1000,
+        'mean_ms': sum(ordered) / len(ordered) * 1000,
+        'rps': len(ordered) / (elapsed or sum(ordered)),
+    }
+    if queries is not None:
+        result['queries'] = sum(queries) / len(queries)
+
+    return result
+
+
+##############################################################################
+# Drivers
+
+def run_client(app, db, units):
+    """Run every unit serially through the test client."""
+
+    from sqlalchemy import event
+
+    client = app.test_client(use_cookies=False)
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    latencies = {route: [] for route in ROUTES}
+    queries = {route: [] for route in ROUTES}
+    errors = 0
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        for scenario in units.values():
+            for unit in scenario:
+                headers = {'Cookie': session_cookie(app, unit.viewer_id),
+                           'Referer': '/'}
+                for route, method, path, data in unit.requests:
+                    statements[0] = 0
+                    start = time.perf_counter()
+                    resp = client.open(path, method=method, data=data,
+                                       headers=headers)
+                    latencies[route].append(time.perf_counter() - start)
+                    queries[route].append(statements[0])
+                    errors += resp.status_code >= 400
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+
+    return {route: summarize(latencies[route], queries[route])
+            for route in ROUTES if latencies[route]}, errors
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(database, workers, worker_class='sync', environ=None):
+    """Start gunicorn with gunicorn.conf.py; return it and its port.
+
+    `environ` adds to the server's environment, e.g. DB_POOL_SIZE.
+    """
+
+    port = free_port()
+    env = dict(os.environ, DATABASE_URL=database,
+               GUNICORN_WORKER_CLASS=worker_class,
+               WEB_CONCURRENCY=str(workers), **(environ or {}))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'app:app',
+         '--config', 'gunicorn.conf.py',
+         '--bind', f"127.0.0.1:{port}",
+         '--workers', str(workers),
+         '--log-level', 'warning'],
+        cwd=ROOT, env=env)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server, port
+        except OSError:
+            if server.poll() is not None:
+                break
+            time.sleep(0.2)
+
+    server.kill()
+    raise SystemExit("gunicorn did not start.")
+
+
+def run_gunicorn(app, units, port, concurrency):
+    """Run each scenario's units across `concurrency` connections."""
+
+    results = {}
+    errors = [0]
+
+    def request(cookie, method, path, data):
+        connection = HTTPConnection('127.0.0.1', port, timeout=60)
+        headers = {'Cookie': cookie, 'Referer': '/'}
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            return connection.getresponse().status
+        except OSError:
+            return None
+        finally:
+            connection.close()
+
+    for scenario in units.values():
+        latencies = {}
+        queue = list(scenario)
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not queue:
+                        return
+                    unit = queue.pop()
+                cookie = session_cookie(app, unit.viewer_id)
+                for route, method, path, data in unit.requests:
+                    start = time.perf_counter()
+                    status = request(cookie, method, path, data)
+                    elapsed = time.perf_counter() - start
+                    with lock:
+                        latencies.setdefault(route, []).append(elapsed)
+                        errors[0] += status is None or status >= 400
+
+        threads = [threading.Thread(target=worker) for i in range(concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        # Routes sharing a scenario (follow/unfollow) share its wall time.
+        for route, samples in latencies.items():
+            share = len(samples) / sum(map(len, latencies.values()))
+            results[route] = summarize(samples, elapsed=elapsed * share)
+
+    return results, errors[0]
+
+
+##############################################################################
+# Reporting
+
+def report(mode, results, baseline, threshold):
+    """Print `results` beside `baseline`; return the regressed routes."""
+
+    print(f"\n{mode}")
+    print(f"{'route':<16} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'queries':>8} {'req/s':>8} {'vs base':>8}")
+
+    regressions = []
+    for route in ROUTES:
+        if route not in results:
+            continue
+        row = results[route]
+        base = baseline.get(route)
+
+        change = ''
+        if base:
+            ratio = row['p95_ms'] / base['p95_ms'] - 1
+            change = f"{ratio:+.0%}"
+            if ratio > threshold:
+                regressions.append(f"{mode} {route}: p95 {base['p95_ms']:.1f}"
+                                   f" -> {row['p95_ms']:.1f} ms")
+            if row.get('queries', 0) > base.get('queries', float('inf')):
+                regressions.append(f"{mode} {route}: queries "
+                                   f"{base['queries']:.1f} -> "
+                                   f"{row['queries']:.1f}")
+
+        queries = f"{row['queries']:8.1f}" if 'queries' in row else f"{'-':>8}"
+        print(f"{route:<16} {row['p50_ms']:8.1f} {row['p95_ms']:8.1f} "
+              f"{row['p99_ms']:8.1f} {queries} {row['rps']:8.1f} {change:>8}")
+
+    return regressions
+
+
+def seed(options):
+    """Generate a dataset with the generator and bulk-load it."""
+
+    import loader
+    from app import app
+
+    with tempfile.TemporaryDirectory() as directory:
+        subprocess.run(
+            [sys.executable, GENERATOR,
+             '--users', str(options.users),
+             '--messages', str(options.messages),
+             '--follows', str(options.follows),
+             '--likes', str(options.likes),
+             '--seed', str(options.seed),
+             '--end', '2020-01-01',
+             '--out', directory],
+            check=True)
+
+        with app.app_context():
+            loader.seed(directory, echo=lambda line: None)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark Warbler's routes against generated data.")
+    parser.add_argument('--database', default='postgresql:///warbler-bench')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--follows', type=float, default=20)
+    parser.add_argument('--likes', type=float, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-seed', dest='reseed', action='store_false',
+                        help="reuse the data already in --database")
+    parser.add_argument('--rounds', type=int, default=50,
+                        help="units per scenario")
+    parser.add_argument('--modes', default='client,gunicorn')
+    parser.add_argument('--workers', type=int, default=2,
+                        help="gunicorn worker processes")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="simultaneous connections to gunicorn")
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true',
+                        help="save these results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="allowed p95 growth over the baseline")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+
+    # Like the tests: pick the database before the app connects to it.
+    os.environ['DATABASE_URL'] = options.database
+    from app import app
+    from models import db
+
+    if options.reseed:
+        seed(options)
+
+    with app.app_context():
+        units = plan(db, options.rounds, random.Random(options.seed))
+        db.session.remove()
+
+    dataset = {name: getattr(options, name)
+               for name in ('users', 'messages', 'follows', 'likes', 'seed')}
+    results = {'dataset': dataset}
+    errors = 0
+    modes = options.modes.split(',')
+
+    if 'client' in modes:
+        # Warm up caches and connections, then measure.
+        run_client(app, db, {name: scenario[:2]
+                             for name, scenario in units.items()})
+        results['client'], failed = run_client(app, db, units)
+        errors += failed
+
+    if 'gunicorn' in modes:
+        server, port = start_gunicorn(options.database, options.workers)
+        try:
+            results['gunicorn'], failed = run_gunicorn(
+                app, units, port, options.concurrency)
+            errors += failed
+        finally:
+            server.terminate()
+            server.wait()
+
+    baseline = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('dataset') != dataset:
+            print("Baseline was taken with different dataset options; "
+                  "not comparing.")
+            baseline = {}
+
+    regressions = []
+    for mode in modes:
+        regressions += report(mode, results[mode], baseline.get(mode, {}),
+                              options.threshold)
+
+    if errors:
+        print(f"\n{errors} requests failed.")
+        if options.save:
+            print("Not saving a baseline from a run with failures.")
+        return 1
+
+    if options.save:
+        with open(options.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"\nSaved baseline to {options.baseline}")
+    elif regressions:
+        print("\nRegressions against the baseline:")
+        for regression in regressions:
+            print(f"  {regression}")
+
+    return 1 if regressions and not options.save else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
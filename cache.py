@@ -0,0 +1,113 @@
+"""Small key/value caches for Warbler.
+
+Every backend has the same interface: get(key) returns the value or None,
+set(key, value) stores it for the cache's TTL, delete(key) drops it.
+
+- LRUCache keeps values in this process, bounded by size and age.
+- RedisCache keeps JSON-encoded values in Redis (or anything with the
+  same get/set/delete calls), so all workers share entries and
+  invalidations.
+- NullCache stores nothing, for turning caching off.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """An in-process cache holding at most `maxsize` entries for `ttl` seconds."""
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class RedisCache:
+    """A cache stored in Redis, shared by every worker.
+
+    `client` is a redis.Redis (or a stand-in with the same get, set and
+    delete methods). Values must be JSON-serializable.
+    """
+
+    def __init__(self, client, prefix='warbler:', ttl=60):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+class NullCache:
+    """A cache that never holds anything."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+
+def make_cache(backend='memory', url=None, maxsize=10000, ttl=60,
+               prefix='warbler:'):
+    """Build the cache named by `backend`: 'memory', 'redis' or 'null'."""
+
+    if backend == 'memory':
+        return LRUCache(maxsize=maxsize, ttl=ttl)
+
+    if backend == 'redis':
+        # Optional dependency: only needed when Redis is configured.
+        import redis
+        return RedisCache(redis.Redis.from_url(url), prefix=prefix, ttl=ttl)
+
+    if backend == 'null':
+        return NullCache()
+
+    raise ValueError(f"Unknown cache backend: {backend!r}")
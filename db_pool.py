@@ -0,0 +1,143 @@
+"""Database connection pool settings and statistics.
+
+engine_options() turns DB_* environment variables into the engine
+options Flask-SQLAlchemy passes to create_engine:
+
+- DB_POOL_SIZE: connections kept open per worker process (default 5).
+- DB_MAX_OVERFLOW: extra connections allowed under load (default 10).
+- DB_POOL_TIMEOUT: seconds to wait for a free connection (default 10).
+- DB_POOL_RECYCLE: seconds before a connection is replaced (default
+  1800), so none outlives a server-side idle timeout.
+- DB_POOL_PRE_PING: test each connection on checkout (default on). A
+  connection left dead by a failover is replaced before a request uses
+  it, rather than failing that request.
+- DB_STATEMENT_TIMEOUT_MS: Postgres statement_timeout (default 0, none).
+
+Each worker process can hold up to DB_POOL_SIZE + DB_MAX_OVERFLOW
+connections, so keep workers * (size + overflow) under the server's
+max_connections.
+
+The pool counts checkouts, waits for a connection, timeouts and overflow
+use; stats() reports them for the metrics endpoint.
+"""
+
+import os
+import threading
+import time
+
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool
+
+# A checkout slower than this had to wait for a connection to come free.
+WAIT_THRESHOLD = 0.001
+
+
+def _flag(value):
+    return value.lower() not in ('0', 'false', 'no', 'off', '')
+
+
+class MeteredQueuePool(QueuePool):
+    """A QueuePool that counts checkouts and time spent waiting for one."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics_lock = threading.Lock()
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        with self.metrics_lock:
+            self.checkouts = 0
+            self.waits = 0
+            self.wait_time = 0.0
+            self.max_wait = 0.0
+            self.timeouts = 0
+            self.max_overflow_seen = 0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeout:
+            with self.metrics_lock:
+                self.timeouts += 1
+            raise
+
+        waited = time.perf_counter() - start
+        with self.metrics_lock:
+            self.checkouts += 1
+            if waited > WAIT_THRESHOLD:
+                self.waits += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+            self.max_overflow_seen = max(self.max_overflow_seen,
+                                         self.overflow())
+
+        return connection
+
+
+def engine_options(url, environ=os.environ):
+    """create_engine options for the database at `url`, from `environ`."""
+
+    options = {
+        'pool_pre_ping': _flag(environ.get('DB_POOL_PRE_PING', '1')),
+    }
+
+    # SQLite uses its own single-connection pools.
+    if url.startswith('sqlite'):
+        return options
+
+    options.update({
+        'poolclass': MeteredQueuePool,
+        'pool_size': int(environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(environ.get('DB_POOL_TIMEOUT', 10)),
+        'pool_recycle': int(environ.get('DB_POOL_RECYCLE', 1800)),
+    })
+
+    statement_timeout = int(environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+    if statement_timeout and url.startswith('postgres'):
+        options['connect_args'] = {
+            'options': f"-c statement_timeout={statement_timeout}"}
+
+    return options
+
+
+def stats(engine):
+    """Checkout, wait and overflow figures for `engine`'s pool."""
+
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__}
+
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0),
+        })
+
+    if isinstance(pool, MeteredQueuePool):
+        with pool.metrics_lock:
+            stats.update({
+                'checkouts': pool.checkouts,
+                'waits': pool.waits,
+                'wait_ms': pool.wait_time * 1000,
+                'max_wait_ms': pool.max_wait * 1000,
+                'timeouts': pool.timeouts,
+                'max_overflow_seen': max(pool.max_overflow_seen, 0),
+            })
+
+    return stats
+
+
+def after_fork(engine):
+    """Drop connections inherited from the parent process.
+
+    Connections can't be shared between processes: a forked worker that
+    used its parent's sockets would interleave traffic with its
+    siblings. Call from a gunicorn post_fork hook.
+    """
+
+    engine.dispose()
+    if isinstance(engine.pool, MeteredQueuePool):
+        engine.pool.reset_metrics()
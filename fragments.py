@@ -0,0 +1,108 @@
+"""Cached fragments of rendered templates.
+
+A Jinja extension adding a {% cache %} tag:
+
+    {% cache 'message', msg.id, msg.user.version, msg.id in liked_ids %}
+      <li>...</li>
+    {% endcache %}
+
+The first two values name the entity the fragment shows ('message' 42).
+The rest, and the tag's place in its template, pick out one variant of
+it. Put in the rest anything else the fragment depends on: the
+author's version, and the viewer's like or follow state. A variant's
+HTML is rendered once and then reused until it falls out of the cache.
+
+Every variant of an entity is kept under one cache key, so invalidate()
+drops them all at once. Routes that change what a fragment shows call it.
+
+The store comes from the FRAGMENT_CACHE_* settings, like the user
+snapshot cache (see cache.py). FRAGMENT_CACHE_ENABLED turns the tag
+into a plain block.
+"""
+
+from flask import current_app
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from cache import make_cache
+from http_cache import build_id
+
+# Variants kept per entity: two like states times a few templates, with
+# room to spare. The oldest is dropped past this.
+MAX_VARIANTS = 16
+
+
+def get_cache():
+    """This app's fragment cache, built from its config."""
+
+    extensions = current_app.extensions
+    if 'fragment_cache' not in extensions:
+        config = current_app.config
+        # Keyed by build, so a deploy with new templates starts afresh
+        # even when the store is shared.
+        extensions['fragment_cache'] = make_cache(
+            backend=config.get('FRAGMENT_CACHE_BACKEND', 'memory'),
+            url=config.get('FRAGMENT_CACHE_URL'),
+            maxsize=config.get('FRAGMENT_CACHE_SIZE', 50000),
+            ttl=config.get('FRAGMENT_CACHE_TTL', 3600),
+            prefix=f"warbler:fragment:{build_id()[:12]}:")
+
+    return extensions['fragment_cache']
+
+
+def invalidate(kind, *entity_ids):
+    """Drop every cached fragment of these entities, e.g. ('message', 42)."""
+
+    cache = get_cache()
+    for entity_id in entity_ids:
+        cache.delete(f"{kind}:{entity_id}")
+
+
+class FragmentCacheExtension(Extension):
+    """Adds {% cache kind, id, *variant %} ... {% endcache %}."""
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        token = next(parser.stream)
+
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+
+        # Tell apart fragments of the same entity in different places.
+        place = nodes.Const(f"{parser.name}:{token.lineno}")
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method('_render', [place, nodes.List(args)]),
+            [], [], body).set_lineno(token.lineno)
+
+    def _render(self, place, parts, caller):
+        if not current_app.config.get('FRAGMENT_CACHE_ENABLED', True):
+            return caller()
+
+        kind, entity_id, *variant = parts
+        key = f"{kind}:{entity_id}"
+        variant = repr([place] + variant)
+
+        cache = get_cache()
+        variants = dict(cache.get(key) or {})
+        html = variants.get(variant)
+        if html is not None:
+            return Markup(html)
+
+        html = caller()
+        variants[variant] = str(html)
+        while len(variants) > MAX_VARIANTS:
+            del variants[next(iter(variants))]
+        cache.set(key, variants)
+
+        return html
+
+
+def init_app(app):
+    """Make {% cache %} available in `app`'s templates."""
+
+    app.jinja_env.add_extension(FragmentCacheExtension)
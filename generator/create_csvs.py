@@ -2,76 +2,295 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for load testing:
+
+    python generator/create_csvs.py --users 1000000 --messages 20000000 \\
+        --processes 8 --out /tmp/warbler-data
+    FLASK_APP=app.py flask seed --directory /tmp/warbler-data
+
+Nothing is fetched from the network, and the same --seed (and --end,
+--processes) always produces the same files. --end defaults to a fixed
+date, not today, so that holds from one day to the next. Rows are written as they
+are generated, so memory use stays flat however many rows you ask for.
+
+The data is skewed the way a real site's is:
+
+- Follows: out-degrees are Pareto-distributed around --follows, and
+  targets are drawn from a power law over users, so a few accounts have
+  a large share of all followers.
+- Messages: more popular users post more, and timestamps crowd towards
+  --end.
+- Likes: out-degrees are Pareto-distributed around --likes, and a few
+  messages take most of the likes.
+
+Every row carries an explicit id (or, for the link tables, both ids), so
+shards can be generated independently. With --processes N, users and
+messages are split into N ranges, each written by its own process, and
+the parts are joined at the end.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import random
+import shutil
+import time
+from datetime import datetime
+from multiprocessing import Pool
+
 from faker import Faker
-from helpers import get_random_datetime
+from faker.providers.lorem.en_US import Provider as Lorem
+
+from helpers import Shuffle, get_random_datetime, parse_datetime, skewed_index
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+MESSAGES_CSV_HEADERS = ['id', 'text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['liker_id', 'liked_msg_id']
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
-
-fake = Faker()
+FILES = (
+    ('users.csv', USERS_CSV_HEADERS),
+    ('messages.csv', MESSAGES_CSV_HEADERS),
+    ('follows.csv', FOLLOWS_CSV_HEADERS),
+    ('likes.csv', LIKES_CSV_HEADERS),
+)
 
-# Generate random profile image URLs to use for users
+# Every user's password is "password".
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-image_urls = [
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
+
+WORDS = Lorem.word_list
+
+# The latest message time, unless --end says otherwise.
+DEFAULT_END = datetime(2020, 1, 1)
+
+# Faker is slow, so names and places are drawn from pools made up front.
+POOL_SIZE = 1000
+
+
+def make_pools(seed):
+    fake = Faker()
+    fake.seed_instance(seed)
+
+    return {
+        'names': [fake.user_name() for i in range(POOL_SIZE)],
+        'cities': [fake.city() for i in range(POOL_SIZE)],
+    }
+
+
+def sentence(rng, min_words, max_words):
+    words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+    return (' '.join(words).capitalize() + '.')[:MAX_WARBLER_LENGTH]
+
+
+def degree(rng, mean, limit):
+    """A Pareto-distributed count averaging about `mean`, at most `limit`."""
+
+    # paretovariate(2) averages 2.
+    return min(round(mean * rng.paretovariate(2) / 2), limit)
+
+
+def shard_range(total, shards, index):
+    """The ids (from 1) that shard `index` of `shards` generates."""
+
+    return (total * index // shards + 1, total * (index + 1) // shards + 1)
+
+
+def write_users(writer, rng, ids, pools):
+    for user_id in range(*ids):
+        username = f"{rng.choice(pools['names'])}{user_id}"
+        writer.writerow([
+            user_id,
+            f"{username}@example.com",
+            username,
+            rng.choice(IMAGE_URLS),
+            PASSWORD,
+            sentence(rng, 4, 12),
+            HEADER_IMAGE_URL,
+            rng.choice(pools['cities']),
+        ])
+
+    return ids[1] - ids[0]
+
+
+def write_messages(writer, rng, ids, options, popular):
+    end = options.end
+    for message_id in range(*ids):
+        author = popular[skewed_index(rng, options.users,
+                                      options.activity_skew)] + 1
+        writer.writerow([
+            message_id,
+            sentence(rng, 3, 25),
+            get_random_datetime(rng, end, options.days, options.time_skew),
+            author,
+        ])
+
+    return ids[1] - ids[0]
+
+
+def pick_distinct(rng, count, draw, exclude=None):
+    """Up to `count` distinct results of draw(), never `exclude`."""
+
+    picked = set()
+    for attempt in range(count * 10):
+        if len(picked) == count:
+            break
+        choice = draw()
+        if choice != exclude:
+            picked.add(choice)
+
+    return picked
+
+
+def write_follows(writer, rng, ids, options, popular):
+    users = options.users
+    draw = lambda: popular[skewed_index(rng, users, options.follow_skew)] + 1
+
+    rows = 0
+    for follower in range(*ids):
+        count = degree(rng, options.follows, users - 1)
+        for followed in pick_distinct(rng, count, draw, exclude=follower):
+            writer.writerow([followed, follower])
+            rows += 1
+
+    return rows
+
+
+def write_likes(writer, rng, ids, options, popular_messages):
+    messages = options.messages
+    if not messages:
+        return 0
+
+    draw = lambda: popular_messages[
+        skewed_index(rng, messages, options.like_skew)] + 1
+
+    rows = 0
+    for liker in range(*ids):
+        count = degree(rng, options.likes, messages)
+        for message_id in pick_distinct(rng, count, draw):
+            writer.writerow([liker, message_id])
+            rows += 1
+
+    return rows
+
+
+def part_path(options, filename, index):
+    if options.processes == 1:
+        return os.path.join(options.out, filename)
+    return os.path.join(options.out, f"{filename}.part{index}")
+
+
+def generate_shard(options, index):
+    """Write shard `index`'s rows of every file. Returns rows written."""
+
+    # The same in every shard: who is popular, and which messages are.
+    layout = random.Random(options.seed)
+    popular = Shuffle(options.users, layout)
+    popular_messages = Shuffle(max(options.messages, 1), layout)
+    pools = make_pools(options.seed)
+
+    rng = random.Random(f"{options.seed}:{index}")
+    users = shard_range(options.users, options.processes, index)
+    messages = shard_range(options.messages, options.processes, index)
+
+    writers = {
+        'users.csv': lambda w: write_users(w, rng, users, pools),
+        'messages.csv': lambda w: write_messages(w, rng, messages, options,
+                                                 popular),
+        'follows.csv': lambda w: write_follows(w, rng, users, options, popular),
+        'likes.csv': lambda w: write_likes(w, rng, users, options,
+                                           popular_messages),
+    }
+
+    rows = 0
+    for filename, headers in FILES:
+        with open(part_path(options, filename, index), 'w', newline='',
+                  buffering=1 << 20) as part:
+            writer = csv.writer(part)
+            if options.processes == 1:
+                writer.writerow(headers)
+            rows += writers[filename](writer)
+
+    return rows
+
+
+def join_parts(options):
+    """Concatenate each file's shard parts, under a single header."""
+
+    for filename, headers in FILES:
+        with open(os.path.join(options.out, filename), 'w', newline='') as out:
+            csv.writer(out).writerow(headers)
+            for index in range(options.processes):
+                path = part_path(options, filename, index)
+                with open(path, newline='') as part:
+                    shutil.copyfileobj(part, out, 1 << 20)
+                os.remove(path)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate Warbler sample data as CSV files.")
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--follows', type=float, default=17,
+                        help="average number of users each user follows")
+    parser.add_argument('--likes', type=float, default=5,
+                        help="average number of messages each user likes")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--end', type=parse_datetime, default=DEFAULT_END,
+                        help="latest message time (default: 2020-01-01); "
+                             "a date, date and time, or 'now'")
+    parser.add_argument('--days', type=float, default=730,
+                        help="how far back messages go")
+    parser.add_argument('--follow-skew', type=float, default=3.0,
+                        help="power-law exponent for who gets followed; "
+                             "1 is uniform")
+    parser.add_argument('--activity-skew', type=float, default=2.0,
+                        help="power-law exponent for who posts")
+    parser.add_argument('--like-skew', type=float, default=3.0,
+                        help="power-law exponent for what gets liked")
+    parser.add_argument('--time-skew', type=float, default=2.0,
+                        help="how strongly messages crowd towards --end")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="number of shards, generated in parallel")
+    parser.add_argument('--out', default=os.path.dirname(os.path.abspath(__file__)),
+                        help="directory to write the CSVs to")
+
+    options = parser.parse_args(argv)
+    if options.users < 2:
+        parser.error("--users must be at least 2")
+    options.processes = max(1, min(options.processes, options.users))
+
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    os.makedirs(options.out, exist_ok=True)
+
+    start = time.monotonic()
+    if options.processes == 1:
+        rows = generate_shard(options, 0)
+    else:
+        with Pool(options.processes) as pool:
+            rows = sum(pool.starmap(generate_shard,
+                                    [(options, index)
+                                     for index in range(options.processes)]))
+        join_parts(options)
+
+    elapsed = time.monotonic() - start
+    print(f"Wrote {rows:,} rows to {options.out} in {elapsed:.1f}s "
+          f"({rows / max(elapsed, 1e-6):,.0f} rows/s)")
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
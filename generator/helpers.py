@@ -1,14 +1,52 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+from datetime import datetime, timedelta
+from math import gcd
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(rng, end, days=730, skew=2.0):
+    """Get a random datetime in the `days` before `end`.
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    With `skew` above 1, times crowd towards `end`, the way activity on a
+    growing site does: with the default of 2, half of them fall in the
+    most recent quarter of the range.
+    """
 
-    return datetime.fromtimestamp(random_timestamp)
+    return end - timedelta(days=days * rng.random() ** skew)
+
+
+def skewed_index(rng, count, exponent):
+    """A random index in range(count), biased towards 0.
+
+    Index i is drawn with density proportional to (i / count) ** (1 /
+    exponent - 1): a power law, where a handful of low indexes take a
+    large share of the draws. An exponent of 1 is uniform.
+    """
+
+    return min(int(count * rng.random() ** exponent), count - 1)
+
+
+class Shuffle:
+    """A fixed pseudo-random permutation of range(count), in O(1) memory.
+
+    Maps i to (i * step + offset) % count, with `step` coprime to
+    `count` so that every index maps to a different one.
+    """
+
+    def __init__(self, count, rng):
+        self.count = count
+        self.offset = rng.randrange(count)
+        self.step = rng.randrange(count // 2, count) | 1 if count > 2 else 1
+        while gcd(self.step, count) != 1:
+            self.step += 2
+
+    def __getitem__(self, i):
+        return (i * self.step + self.offset) % self.count
+
+
+def parse_datetime(text):
+    """Parse --end: a date, a date and time, or 'now'."""
+
+    if text == 'now':
+        return datetime.now()
+    return datetime.fromisoformat(text)
@@ -0,0 +1,58 @@
+"""Serving Warbler from gevent workers.
+
+With GUNICORN_WORKER_CLASS=gevent, each gunicorn worker runs its
+requests as greenlets. Thousands of them fit in one process. A greenlet
+that waits on the network, for a client or for Postgres, yields to the
+others instead of blocking the worker. The app code stays as it is.
+
+Two things have to happen before the app is imported (gunicorn.conf.py
+calls patch() first thing):
+
+- gevent's monkey-patching, so sockets, locks, queues and sleeps are
+  cooperative.
+- psycogreen's wait callback for psycopg2. psycopg2 talks to Postgres in
+  C, below the patched sockets; without the callback every query would
+  block the whole worker until it returned.
+
+CPU-bound work can't yield. run_blocking() hands a call to gevent's
+thread pool instead, where it runs beside the event loop; bcrypt, which
+releases the GIL, is the case that matters (see passwords.py).
+
+Greenlets still share the worker's connection pool, so DB_POOL_SIZE +
+DB_MAX_OVERFLOW (see db_pool.py) caps how many can query at once; the
+rest wait up to DB_POOL_TIMEOUT for a connection.
+
+gevent and psycogreen are only needed for this worker class.
+"""
+
+
+def patch():
+    """Make this process cooperative: patch the stdlib and psycopg2."""
+
+    # Optional dependencies: only needed with gevent workers.
+    from gevent import monkey
+    monkey.patch_all()
+
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+
+def is_patched():
+    """Has gevent monkey-patched this process?"""
+
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+
+    return monkey.is_module_patched('threading')
+
+
+def run_blocking(function, *args):
+    """Call `function`, off the event loop if gevent is running one."""
+
+    if is_patched():
+        import gevent
+        return gevent.get_hub().threadpool.apply(function, args)
+
+    return function(*args)
@@ -0,0 +1,55 @@
+"""gunicorn settings for Warbler (used by the Procfile).
+
+Workers are forked from a master that has already imported the app, so
+each starts with a copy of the master's database pool. post_fork throws
+those connections away; every worker then opens its own.
+
+Each worker holds up to DB_POOL_SIZE + DB_MAX_OVERFLOW connections (see
+db_pool.py); size WEB_CONCURRENCY to fit the database's max_connections.
+
+With more than one worker, the app won't start with its in-process
+user cache (USER_CACHE_BACKEND in app.py) or, if new-message streams
+are turned on, its in-process broker (STREAM_BROKER).
+
+GUNICORN_WORKER_CLASS picks how a worker serves requests at once:
+
+- gthread (the default): GUNICORN_THREADS threads per worker. An open
+  /stream (see streaming.py) holds a thread, not a whole worker, and
+  gives its database connection back while it waits.
+- gevent: up to GUNICORN_WORKER_CONNECTIONS greenlets per worker, with
+  non-blocking Postgres access (see green.py). Needs gevent and
+  psycogreen. Raise DB_POOL_SIZE to match the concurrency wanted.
+- sync: one request per worker at a time.
+
+benchmarks/concurrency.py compares them.
+"""
+
+import os
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+
+if worker_class == 'gevent':
+    # Before the app (preloaded below) imports anything that blocks.
+    import green
+    green.patch()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+# Exported so the app sees the worker count too (see WEB_CONCURRENCY).
+os.environ.setdefault('WEB_CONCURRENCY', '2')
+workers = int(os.environ['WEB_CONCURRENCY'])
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+preload_app = True
+
+
+def post_fork(server, worker):
+    import db_pool
+    import writebehind
+    from app import app
+    from models import db
+
+    db_pool.after_fork(db.engine)
+    # Threads don't survive the fork: apply likes and follows a previous
+    # worker queued but didn't get to.
+    writebehind.resume(app)
@@ -0,0 +1,199 @@
+"""HTTP caching for Warbler's pages and static files.
+
+Read pages that are safe to cache have a Rule in RULES, keyed by
+endpoint. A rule names the Cache-Control header to send and a function
+returning the versions of what the page shows: for a profile, the
+profile owner's User.version, which every change to their profile,
+counts or messages bumps.
+
+The ETag is a hash of those versions together with:
+- the URL,
+- the viewer, the viewer's version (read fresh from the database, as the
+  user_context snapshot may be stale in this worker) and their queued
+  likes and follows (follow buttons and like stars depend on them),
+- the build (the templates).
+
+A request whose If-None-Match matches is answered 304 Not Modified from
+before_request, without running the view or rendering anything.
+Responses with no rule are marked `private, no-cache`.
+
+Static files referenced through static_url() carry a content
+fingerprint in their URL, so they can be cached for a year as immutable:
+a changed file gets a new URL.
+"""
+
+import hashlib
+import os
+
+from flask import current_app, g, request, session, url_for
+
+from models import db, Message, User
+
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+DEFAULT_CACHE_CONTROL = 'private, no-cache'
+
+
+class Rule:
+    """How to cache one endpoint.
+
+    `versions(**view_args)` returns a list of values that change whenever
+    the page's content does, or None to leave this response uncached
+    (e.g. for a page that doesn't exist).
+    """
+
+    def __init__(self, cache_control, versions):
+        self.cache_control = cache_control
+        self.versions = versions
+
+
+def anonymous_home():
+    # Signed-in users get their timeline, which has no version to check.
+    return None if g.user else []
+
+
+def user_page(user_id):
+    version = db.session.query(User.version).filter(User.id == user_id).scalar()
+    return None if version is None else [version]
+
+
+def message_page(message_id):
+    version = (db.session
+               .query(User.version)
+               .join(Message, Message.user_id == User.id)
+               .filter(Message.id == message_id)
+               .scalar())
+    return None if version is None else [version]
+
+
+RULES = {
+    'homepage': Rule('public, no-cache', anonymous_home),
+    'users_show': Rule('private, no-cache', user_page),
+    'messages_show': Rule('private, no-cache', message_page),
+}
+
+
+def _hash_files(paths):
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        with open(path, 'rb') as f:
+            digest.update(path.encode('utf-8'))
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def build_id():
+    """Identifies this build of the templates, so a deploy changes ETags."""
+
+    extensions = current_app.extensions
+    if 'http_cache_build' not in extensions:
+        build = current_app.config.get('HTTP_CACHE_BUILD_ID')
+        if not build:
+            templates = os.path.join(current_app.root_path,
+                                     current_app.template_folder)
+            build = _hash_files(
+                os.path.join(directory, name)
+                for directory, dirs, files in os.walk(templates)
+                for name in files)
+        extensions['http_cache_build'] = build
+
+    return extensions['http_cache_build']
+
+
+def viewer_version():
+    # Read from the database, not the g.user snapshot: that is cached per
+    # process, and another worker may have handled the viewer's last like
+    # or follow without this one's snapshot hearing of it.
+    return (db.session
+            .query(User.version)
+            .filter(User.id == g.user.id)
+            .scalar())
+
+
+def etag_for(versions):
+    viewer = ((g.user.id, viewer_version(), g.user.pending) if g.user
+              else None)
+    key = repr((build_id(), request.full_path, viewer, versions))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+##############################################################################
+# Static files
+
+_fingerprints = {}
+
+
+def fingerprint(filename):
+    """A short hash of a static file's contents."""
+
+    path = os.path.join(current_app.static_folder, filename)
+    key = (path, os.path.getmtime(path))
+    if key not in _fingerprints:
+        _fingerprints[key] = _hash_files([path])[:12]
+    return _fingerprints[key]
+
+
+def static_url(filename):
+    """URL for a static file that changes whenever its contents do."""
+
+    return url_for('static', filename=filename, v=fingerprint(filename))
+
+
+##############################################################################
+# Request hooks
+
+def _check_not_modified():
+    """Answer 304 without running the view, if the client's copy is current."""
+
+    g.cache_etag = None
+
+    rule = RULES.get(request.endpoint)
+    # Flashed messages show once: that response must not be revalidated.
+    if rule is None or request.method != 'GET' or '_flashes' in session:
+        return None
+
+    versions = rule.versions(**(request.view_args or {}))
+    if versions is None:
+        return None
+
+    g.cache_etag = etag_for(versions)
+    if g.cache_etag in request.if_none_match:
+        # after_request hooks still run, and add the ETag and Cache-Control.
+        return current_app.response_class(status=304)
+
+    return None
+
+
+def _set_headers(response):
+    rule = RULES.get(request.endpoint)
+    etag = g.get('cache_etag')
+
+    if request.endpoint == 'static':
+        filename = (request.view_args or {}).get('filename')
+        version = request.args.get('v')
+        if (version and response.status_code == 200
+                and version == fingerprint(filename)):
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_MAX_AGE
+            response.cache_control.immutable = True
+
+    elif etag and response.status_code in (200, 304):
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = rule.cache_control
+        response.vary.add('Cookie')
+
+    elif 'Cache-Control' not in response.headers:
+        response.headers['Cache-Control'] = DEFAULT_CACHE_CONTROL
+
+    return response
+
+
+def init_app(app):
+    """Apply RULES to `app`'s responses and add static_url() to templates.
+
+    Call after the hooks that set g.user are registered.
+    """
+
+    app.before_request(_check_not_modified)
+    app.after_request(_set_headers)
+    app.add_template_global(static_url)
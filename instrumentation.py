@@ -0,0 +1,272 @@
+"""Always-on request and SQL instrumentation.
+
+Every statement an engine runs during a request is timed (through
+SQLAlchemy's cursor events), and so is template rendering (through
+Flask's template signals). When the request finishes:
+
+- The totals go back to the client in a Server-Timing header, so they
+  show up in the browser's network panel.
+- They are added to per-endpoint aggregates, served as JSON from
+  /_internal/metrics.
+- Statements slower than SLOW_QUERY_MS are logged.
+- So is any statement shape repeated more than N_PLUS_ONE_THRESHOLD
+  times in one request -- usually a lazy load in a loop.
+
+/_internal/metrics is off (404) by default. With INTERNAL_METRICS_TOKEN
+set it wants that token as a bearer token; with METRICS_ENABLED on and
+no token it answers anyone, so only turn that on where the port isn't
+exposed. The client's address is no guide: behind a proxy every request
+comes from loopback.
+"""
+
+import hmac
+import re
+import threading
+import time
+from collections import Counter, deque
+
+from flask import (abort, before_render_template, current_app, g,
+                   has_request_context, jsonify, request, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import db_pool
+from models import db
+from passwords import password_hasher
+
+LATENCY_SAMPLES = 1000
+
+# Bound parameters and literals vary between calls of the same statement;
+# strip them to find its shape. An IN list of n parameters becomes "IN (?)".
+_PARAMETER_LIST = re.compile(r"\(\s*(?:%\(\w+\)s|\?|:\w+)(?:\s*,\s*(?:%\(\w+\)s|\?|:\w+))*\s*\)")
+_PARAMETER = re.compile(r"%\(\w+\)s|\?|(?<![:\w]):\w+|\b\d+\b|'(?:[^']|'')*'")
+_SPACE = re.compile(r"\s+")
+
+
+def statement_shape(statement):
+    """`statement` with its parameters and literals replaced by '?'."""
+
+    shape = _PARAMETER_LIST.sub("(?)", statement)
+    shape = _PARAMETER.sub("?", shape)
+    return _SPACE.sub(" ", shape).strip()
+
+
+class RequestStats:
+    """What one request spent, and on which statements."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.render_start = None
+        self.statements = []
+
+    def record(self, statement, duration):
+        self.queries += 1
+        self.db_time += duration
+        self.statements.append((statement, duration))
+
+    def slowest(self, count):
+        return sorted(self.statements, key=lambda s: s[1], reverse=True)[:count]
+
+    def repeated(self, threshold):
+        """{shape: times run} for shapes run more than `threshold` times."""
+
+        shapes = Counter(statement_shape(statement)
+                         for statement, duration in self.statements)
+        return {shape: count for shape, count in shapes.items()
+                if count > threshold}
+
+
+class EndpointStats:
+    """Running totals for one endpoint."""
+
+    def __init__(self):
+        self.requests = 0
+        self.total_time = 0.0
+        self.queries = 0
+        self.max_queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.n_plus_one = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.slowest = []
+
+    def add(self, stats, elapsed, slowest_count, repeated):
+        self.requests += 1
+        self.total_time += elapsed
+        self.queries += stats.queries
+        self.max_queries = max(self.max_queries, stats.queries)
+        self.db_time += stats.db_time
+        self.render_time += stats.render_time
+        self.n_plus_one += bool(repeated)
+        self.latencies.append(elapsed)
+
+        slowest = self.slowest + [(duration, statement_shape(statement))
+                                  for statement, duration
+                                  in stats.slowest(slowest_count)]
+        self.slowest = sorted(slowest, reverse=True)[:slowest_count]
+
+    def as_dict(self):
+        latencies = sorted(self.latencies)
+        requests = self.requests or 1
+        return {
+            'requests': self.requests,
+            'mean_ms': self.total_time / requests * 1000,
+            'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000
+                      if latencies else None,
+            'mean_queries': self.queries / requests,
+            'max_queries': self.max_queries,
+            'mean_db_ms': self.db_time / requests * 1000,
+            'mean_render_ms': self.render_time / requests * 1000,
+            'n_plus_one_requests': self.n_plus_one,
+            'slowest_statements': [{'ms': duration * 1000, 'statement': shape}
+                                   for duration, shape in self.slowest],
+        }
+
+
+class Metrics:
+    """Per-endpoint aggregates, shared by the threads of a worker."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def add(self, endpoint, stats, elapsed, slowest_count, repeated):
+        with self.lock:
+            if endpoint not in self.endpoints:
+                self.endpoints[endpoint] = EndpointStats()
+            self.endpoints[endpoint].add(stats, elapsed, slowest_count,
+                                         repeated)
+
+    def as_dict(self):
+        with self.lock:
+            return {endpoint: stats.as_dict()
+                    for endpoint, stats in sorted(self.endpoints.items())}
+
+    def clear(self):
+        with self.lock:
+            self.endpoints.clear()
+
+
+metrics = Metrics()
+
+
+def current_stats():
+    """The RequestStats for the current request, if it is being measured."""
+
+    if has_request_context():
+        return g.get('request_stats')
+    return None
+
+
+##############################################################################
+# SQLAlchemy events, for every engine
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    duration = time.perf_counter() - conn.info['query_start'].pop()
+
+    stats = current_stats()
+    if stats is not None:
+        stats.record(statement, duration)
+
+        slow_ms = current_app.config.get('SLOW_QUERY_MS', 100)
+        if duration * 1000 > slow_ms:
+            current_app.logger.warning(
+                "Slow query (%.1f ms) in %s: %s",
+                duration * 1000, request.endpoint, statement)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute: drop its
+    # start time, or the connection's stack grows with every error.
+    if context.connection is not None and context.statement is not None:
+        starts = context.connection.info.get('query_start')
+        if starts:
+            starts.pop()
+
+
+##############################################################################
+# Request hooks
+
+def _start_request():
+    g.request_stats = RequestStats()
+
+
+def _before_render(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None:
+        stats.render_start = time.perf_counter()
+
+
+def _after_render(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None and stats.render_start is not None:
+        stats.render_time += time.perf_counter() - stats.render_start
+        stats.render_start = None
+
+
+def _finish_request(response):
+    stats = current_stats()
+    if stats is None:
+        return response
+
+    elapsed = time.perf_counter() - stats.start
+    config = current_app.config
+    endpoint = request.endpoint or '<unmatched>'
+
+    repeated = stats.repeated(config.get('N_PLUS_ONE_THRESHOLD', 10))
+    for shape, count in repeated.items():
+        current_app.logger.warning(
+            "Possible N+1 in %s: ran %d times: %s", endpoint, count, shape)
+
+    metrics.add(endpoint, stats, elapsed,
+                config.get('SLOWEST_STATEMENTS', 5), repeated)
+
+    response.headers.add(
+        'Server-Timing',
+        f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries", '
+        f'render;dur={stats.render_time * 1000:.1f}, '
+        f'total;dur={elapsed * 1000:.1f}')
+
+    return response
+
+
+def metrics_view():
+    """Aggregated per-endpoint figures, for this worker process."""
+
+    token = current_app.config.get('INTERNAL_METRICS_TOKEN')
+    if token:
+        given = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(given.encode(),
+                                   f"Bearer {token}".encode()):
+            abort(404)
+    elif not current_app.config.get('METRICS_ENABLED', False):
+        abort(404)
+
+    return jsonify(endpoints=metrics.as_dict(),
+                   db_pool=db_pool.stats(db.engine),
+                   password_hasher=password_hasher.stats())
+
+
+def init_app(app):
+    """Measure `app`'s requests, unless INSTRUMENTATION_ENABLED is off."""
+
+    if not app.config.get('INSTRUMENTATION_ENABLED', True):
+        return
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+    app.add_url_rule('/_internal/metrics', 'internal_metrics', metrics_view)
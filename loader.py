@@ -0,0 +1,240 @@
+"""Bulk-load Warbler's tables from CSV files.
+
+Used by `flask seed` (and seed.py) to fill a fresh database from the
+generator's CSVs. Files are streamed in chunks, so memory use doesn't
+grow with the size of the load:
+
+- On Postgres each chunk goes through COPY ... FROM STDIN.
+- Elsewhere each chunk is one executemany INSERT.
+
+Secondary indexes (and, on Postgres, foreign keys) are dropped before
+loading and recreated afterwards. Building an index once over the loaded
+rows is much cheaper than updating it on every insert.
+
+Each file's header row names the columns it holds, so a file may
+include the `id` column or leave it to the database. Sequences are moved
+past the loaded ids afterwards.
+"""
+
+import csv
+import io
+import os
+import time
+from datetime import datetime
+
+from sqlalchemy import DateTime, text
+
+from models import db, Follows, Liked_Message, Message, User
+import migrate
+import timeline
+
+CHUNK_SIZE = 50000
+
+# In load order: every table is loaded after the tables it refers to.
+# Missing files are skipped.
+FILES = (
+    (User.__table__, 'users.csv'),
+    (Message.__table__, 'messages.csv'),
+    (Follows.__table__, 'follows.csv'),
+    (Liked_Message.__table__, 'likes.csv'),
+)
+
+
+def read_chunks(path, chunk_size=CHUNK_SIZE):
+    """Return the header of the CSV at `path` and an iterator of row lists."""
+
+    source = open(path, newline='')
+    reader = csv.reader(source)
+    header = next(reader)
+
+    def chunks():
+        with source:
+            chunk = []
+            for row in reader:
+                chunk.append(row)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+    return header, chunks()
+
+
+##############################################################################
+# Deferred indexes and constraints
+
+def _deferred_postgres(connection, table):
+    """Statements to drop, and then recreate, `table`'s indexes and FKs."""
+
+    drops, creates = [], []
+
+    foreign_keys = connection.execute(text(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = CAST(:table AS regclass) AND contype = 'f'"),
+        table=table.name)
+    for name, definition in foreign_keys:
+        drops.append(f'ALTER TABLE {table.name} DROP CONSTRAINT "{name}"')
+        creates.append(
+            f'ALTER TABLE {table.name} ADD CONSTRAINT "{name}" {definition}')
+
+    # Indexes that back a constraint (the primary key) stay put.
+    indexes = connection.execute(text(
+        "SELECT i.relname, pg_get_indexdef(i.oid) FROM pg_index x "
+        "JOIN pg_class i ON i.oid = x.indexrelid "
+        "WHERE x.indrelid = CAST(:table AS regclass) AND NOT EXISTS "
+        "(SELECT 1 FROM pg_constraint c WHERE c.conindid = i.oid)"),
+        table=table.name)
+    for name, definition in indexes:
+        drops.append(f'DROP INDEX "{name}"')
+        creates.append(definition)
+
+    return drops, creates
+
+
+def _deferred_sqlite(connection, table):
+    # Automatic indexes (primary keys, unique columns) have no SQL.
+    indexes = connection.execute(text(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+        "AND tbl_name = :table AND sql IS NOT NULL"), table=table.name)
+
+    drops, creates = [], []
+    for name, definition in indexes:
+        drops.append(f'DROP INDEX "{name}"')
+        creates.append(definition)
+
+    return drops, creates
+
+
+def deferred_ddl(connection, table):
+    """Return (drops, creates): DDL to run before and after loading `table`."""
+
+    if connection.dialect.name == 'postgresql':
+        return _deferred_postgres(connection, table)
+    if connection.dialect.name == 'sqlite':
+        return _deferred_sqlite(connection, table)
+    return [], []
+
+
+##############################################################################
+# Loading
+
+def _copy_chunk(connection, table, header, chunk):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(chunk)
+    buffer.seek(0)
+
+    columns = ', '.join(header)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def _insert_chunk(connection, table, header, chunk):
+    # Match COPY: empty fields are NULL. DB-API drivers other than
+    # psycopg2 want datetimes as objects, not strings.
+    dates = {name for name in header
+             if isinstance(table.c[name].type, DateTime)}
+
+    def convert(name, value):
+        if value == '':
+            return None
+        if name in dates:
+            return datetime.fromisoformat(value)
+        return value
+
+    connection.execute(table.insert(), [
+        {name: convert(name, value) for name, value in zip(header, row)}
+        for row in chunk])
+
+
+def load_table(connection, table, path, chunk_size=CHUNK_SIZE, echo=print):
+    """Stream the CSV at `path` into `table`. Returns the rows loaded."""
+
+    header, chunks = read_chunks(path, chunk_size)
+    load_chunk = (_copy_chunk if connection.dialect.name == 'postgresql'
+                  else _insert_chunk)
+
+    rows = 0
+    start = time.monotonic()
+    for chunk in chunks:
+        load_chunk(connection, table, header, chunk)
+        rows += len(chunk)
+        elapsed = time.monotonic() - start
+        echo(f"{table.name}: {rows:,} rows "
+             f"({rows / max(elapsed, 1e-6):,.0f} rows/s)")
+
+    return rows
+
+
+def reset_sequences(connection, tables):
+    """Move id sequences past the largest loaded id (Postgres only)."""
+
+    if connection.dialect.name != 'postgresql':
+        return
+
+    for table in tables:
+        if 'id' not in table.c:
+            continue
+        connection.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+            f"COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) FROM {table.name}"))
+
+
+def load(directory, chunk_size=CHUNK_SIZE, echo=print):
+    """Load every CSV in `directory` named in FILES.
+
+    Returns {table name: rows loaded}.
+    """
+
+    files = [(table, os.path.join(directory, filename))
+             for table, filename in FILES
+             if os.path.exists(os.path.join(directory, filename))]
+    tables = [table for table, path in files]
+
+    loaded = {}
+    with db.engine.begin() as connection:
+        deferred = [deferred_ddl(connection, table) for table in tables]
+        for drops, creates in deferred:
+            for statement in drops:
+                connection.execute(text(statement))
+
+        for table, path in files:
+            loaded[table.name] = load_table(connection, table, path,
+                                            chunk_size, echo)
+
+        start = time.monotonic()
+        for drops, creates in deferred:
+            for statement in creates:
+                connection.execute(text(statement))
+        echo(f"Rebuilt indexes in {time.monotonic() - start:.1f}s")
+
+        reset_sequences(connection, tables)
+
+    return loaded
+
+
+def seed(directory='generator', chunk_size=CHUNK_SIZE, echo=print):
+    """Recreate the database from the CSVs in `directory`.
+
+    Loads the files, then fills in what the write paths would have kept
+    up to date: the counters and materialized timelines.
+    """
+
+    db.drop_all()
+    db.create_all()
+    migrate.stamp(db.engine)
+
+    start = time.monotonic()
+    loaded = load(directory, chunk_size, echo)
+
+    User.recount()
+    timeline.rebuild()
+    db.session.commit()
+
+    elapsed = time.monotonic() - start
+    rows = sum(loaded.values())
+    echo(f"Loaded {rows:,} rows in {elapsed:.1f}s "
+         f"({rows / max(elapsed, 1e-6):,.0f} rows/s)")
+
+    return loaded
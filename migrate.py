@@ -0,0 +1,151 @@
+"""Schema migrations.
+
+db.create_all() creates missing tables but never changes existing ones.
+Changes to an existing database are migrations: modules in migrations/
+named NNNN_description.py, each with an upgrade(connection) function.
+`flask migrate` applies the ones not yet recorded in the
+schema_migrations table, in order.
+
+Each migration runs in its own transaction, together with the row
+recording it, unless the module sets TRANSACTIONAL = False: Postgres
+can't CREATE INDEX CONCURRENTLY inside a transaction. Such migrations
+must be safe to run again after failing halfway; create_index() is.
+
+Migrations check for what they add (has_table(), has_column()), so
+running one against a database that already has its changes does
+nothing.
+
+A database made by create_all() already matches the models, which
+include every migration's changes; stamp() records them all as applied
+without running them.
+"""
+
+import importlib.util
+import os
+import re
+from datetime import datetime
+
+from sqlalchemy import (Column, DateTime, MetaData, Table, Text, inspect,
+                        select, text)
+
+DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'migrations')
+
+_FILENAME = re.compile(r"^(\d{4})_\w+\.py$")
+
+metadata = MetaData()
+
+schema_migrations = Table(
+    'schema_migrations', metadata,
+    Column('version', Text, primary_key=True),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+class Migration:
+    """One migration module."""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)[:-3]
+        self.version = self.name[:4]
+
+        spec = importlib.util.spec_from_file_location(
+            f"migrations.{self.name}", path)
+        self.module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.module)
+
+        self.transactional = getattr(self.module, 'TRANSACTIONAL', True)
+
+    def __repr__(self):
+        return f"<Migration {self.name}>"
+
+
+def discover(directory=DIRECTORY):
+    """The migrations in `directory`, in order."""
+
+    return [Migration(os.path.join(directory, filename))
+            for filename in sorted(os.listdir(directory))
+            if _FILENAME.match(filename)]
+
+
+def applied(engine):
+    """Versions of the migrations already applied to `engine`'s database."""
+
+    metadata.create_all(engine)
+    with engine.connect() as connection:
+        return {version for (version,) in
+                connection.execute(select([schema_migrations.c.version]))}
+
+
+def has_table(connection, table):
+    return table in inspect(connection).get_table_names()
+
+
+def has_column(connection, table, column):
+    return column in {info['name']
+                      for info in inspect(connection).get_columns(table)}
+
+
+def create_index(connection, name, table, definition):
+    """Create index `name` ON `table` `definition`, unless it's there.
+
+    On Postgres the index is built CONCURRENTLY, so `connection` must be
+    in autocommit mode. A concurrent build that fails partway leaves an
+    INVALID index behind; that one is dropped and built again, rather
+    than skipped.
+    """
+
+    if connection.dialect.name != 'postgresql':
+        connection.execute(
+            f"CREATE INDEX IF NOT EXISTS {name} ON {table} {definition}")
+        return
+
+    valid = connection.execute(text(
+        "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"
+    ), name=name).scalar()
+    if valid:
+        return
+    if valid is not None:
+        connection.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+    connection.execute(f"CREATE INDEX CONCURRENTLY {name} ON {table} {definition}")
+
+
+def _record(connection, migration):
+    connection.execute(schema_migrations.insert().values(
+        version=migration.version, applied_at=datetime.utcnow()))
+
+
+def upgrade(engine, directory=DIRECTORY, echo=print):
+    """Apply the migrations `engine`'s database hasn't had; return them."""
+
+    done = applied(engine)
+    pending = [migration for migration in discover(directory)
+               if migration.version not in done]
+
+    for migration in pending:
+        echo(f"Applying {migration.name}")
+
+        if migration.transactional or engine.dialect.name != 'postgresql':
+            with engine.begin() as connection:
+                migration.module.upgrade(connection)
+                _record(connection, migration)
+        else:
+            with engine.connect() as connection:
+                connection = connection.execution_options(
+                    isolation_level='AUTOCOMMIT')
+                migration.module.upgrade(connection)
+                _record(connection, migration)
+
+    return pending
+
+
+def stamp(engine, directory=DIRECTORY):
+    """Record every migration as applied, as after db.create_all()."""
+
+    done = applied(engine)
+    with engine.begin() as connection:
+        for migration in discover(directory):
+            if migration.version not in done:
+                _record(connection, migration)
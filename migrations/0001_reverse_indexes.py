@@ -0,0 +1,29 @@
+"""Indexes for lookups from the second column of a composite key.
+
+The follows key leads with the followed user, and the liked_messages key
+with the liker, so "whom does X follow" and "who liked message M" had
+no index. Each new index holds both columns, so those lookups are
+index-only.
+
+Also makes sure databases from before the profile feed index have it. A
+btree scans both ways, so (user_id, timestamp, id) serves the feed's
+newest-first order too.
+"""
+
+from migrate import create_index
+
+TRANSACTIONAL = False
+
+INDEXES = [
+    ('ix_follows_user_following_id_user_being_followed_id',
+     'follows', '(user_following_id, user_being_followed_id)'),
+    ('ix_liked_messages_liked_msg_id_liker_id',
+     'liked_messages', '(liked_msg_id, liker_id)'),
+    ('ix_messages_user_id_timestamp_id',
+     'messages', '(user_id, timestamp, id)'),
+]
+
+
+def upgrade(connection):
+    for name, table, definition in INDEXES:
+        create_index(connection, name, table, definition)
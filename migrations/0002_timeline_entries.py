@@ -0,0 +1,54 @@
+"""Materialized home timelines (see timeline.py).
+
+Creates timeline_entries and fills it from follows and messages, as
+timeline.rebuild() would. Authors with more than
+TIMELINE_FANOUT_THRESHOLD followers are left out: their messages are
+merged in when timelines are read.
+"""
+
+import os
+
+from sqlalchemy import text
+
+from migrate import has_table
+from timeline import DEFAULT_FANOUT_THRESHOLD
+
+CREATE = [
+    """CREATE TABLE timeline_entries (
+           owner_id INTEGER NOT NULL
+               REFERENCES users (id) ON DELETE CASCADE,
+           message_id INTEGER NOT NULL
+               REFERENCES messages (id) ON DELETE CASCADE,
+           author_id INTEGER NOT NULL
+               REFERENCES users (id) ON DELETE CASCADE,
+           timestamp TIMESTAMP NOT NULL,
+           PRIMARY KEY (owner_id, message_id)
+       )""",
+    """CREATE INDEX ix_timeline_entries_owner_timestamp
+       ON timeline_entries (owner_id, timestamp, message_id)""",
+]
+
+BACKFILL = text("""
+INSERT INTO timeline_entries (owner_id, message_id, author_id, timestamp)
+SELECT follows.user_following_id, messages.id, messages.user_id,
+       messages.timestamp
+FROM follows
+JOIN messages ON messages.user_id = follows.user_being_followed_id
+WHERE messages.user_id NOT IN (
+    SELECT user_being_followed_id FROM follows
+    GROUP BY user_being_followed_id
+    HAVING count(*) > :threshold
+)
+""")
+
+
+def upgrade(connection):
+    if has_table(connection, 'timeline_entries'):
+        return
+
+    for statement in CREATE:
+        connection.execute(statement)
+
+    threshold = int(os.environ.get('TIMELINE_FANOUT_THRESHOLD',
+                                   DEFAULT_FANOUT_THRESHOLD))
+    connection.execute(BACKFILL, threshold=threshold)
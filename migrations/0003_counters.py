@@ -0,0 +1,47 @@
+"""Denormalized counters on users and messages.
+
+Adds the count columns and fills them in, as User.recount() would.
+"""
+
+from migrate import has_column
+
+COLUMNS = [
+    ('users', 'messages_count'),
+    ('users', 'followers_count'),
+    ('users', 'following_count'),
+    ('users', 'likes_count'),
+    ('messages', 'likes_count'),
+]
+
+RECOUNT = [
+    """UPDATE users SET
+           messages_count = (SELECT count(*) FROM messages
+                             WHERE messages.user_id = users.id),
+           followers_count = (SELECT count(*) FROM follows
+                              WHERE follows.user_being_followed_id = users.id),
+           following_count = (SELECT count(*) FROM follows
+                              WHERE follows.user_following_id = users.id),
+           likes_count = (SELECT count(*) FROM liked_messages
+                          WHERE liked_messages.liker_id = users.id)""",
+    """UPDATE messages SET
+           likes_count = (SELECT count(*) FROM liked_messages
+                          WHERE liked_messages.liked_msg_id = messages.id)""",
+]
+
+
+def upgrade(connection):
+    missing = [(table, column) for table, column in COLUMNS
+               if not has_column(connection, table, column)]
+    if not missing:
+        return
+
+    for table, column in missing:
+        connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} "
+                           f"INTEGER NOT NULL DEFAULT 0")
+
+    # timeline.rebuild() looks users up by follower count.
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_users_followers_count "
+                       "ON users (followers_count)")
+
+    for statement in RECOUNT:
+        connection.execute(statement)
@@ -0,0 +1,29 @@
+"""Trigram indexes for user search (see search.py).
+
+Postgres only, and only where the pg_trgm extension is available; the
+indexes on username, bio and location are built concurrently.
+"""
+
+from sqlalchemy import text
+
+from migrate import create_index
+
+TRANSACTIONAL = False
+
+FIELDS = ('username', 'bio', 'location')
+
+
+def upgrade(connection):
+    if connection.dialect.name != 'postgresql':
+        return
+
+    available = connection.execute(text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    )).scalar()
+    if not available:
+        return
+
+    connection.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for field in FIELDS:
+        create_index(connection, f"ix_users_{field}_trgm", 'users',
+                     f"USING gin ({field} gin_trgm_ops)")
@@ -0,0 +1,13 @@
+"""Full-text index over message text (see search.py). Postgres only."""
+
+from migrate import create_index
+
+TRANSACTIONAL = False
+
+
+def upgrade(connection):
+    if connection.dialect.name != 'postgresql':
+        return
+
+    create_index(connection, 'ix_messages_text_fts', 'messages',
+                 "USING gin (to_tsvector('english', text))")
@@ -0,0 +1,9 @@
+"""users.version, which HTTP ETags are built from (see http_cache.py)."""
+
+from migrate import has_column
+
+
+def upgrade(connection):
+    if not has_column(connection, 'users', 'version'):
+        connection.execute("ALTER TABLE users ADD COLUMN version "
+                           "INTEGER NOT NULL DEFAULT 0")
@@ -0,0 +1,17 @@
+"""An index for short user searches, which match username prefixes.
+
+Postgres only; built concurrently. lower(username) with
+text_pattern_ops serves LIKE 'term%' whatever the database collation.
+"""
+
+from migrate import create_index
+
+TRANSACTIONAL = False
+
+
+def upgrade(connection):
+    if connection.dialect.name != 'postgresql':
+        return
+
+    create_index(connection, 'ix_users_username_prefix', 'users',
+                 "(lower(username) text_pattern_ops)")
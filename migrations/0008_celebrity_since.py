@@ -0,0 +1,36 @@
+"""users.celebrity_since, marking authors merged into timelines at read
+time (see timeline.py).
+
+Marks the authors above TIMELINE_FANOUT_THRESHOLD, whose messages have
+not been fanned out. An author who was above it once but has since
+dropped below can't be told apart from one who never was; run
+timeline.rebuild() (as `flask seed` does) to rematerialize their
+messages.
+"""
+
+import os
+from datetime import datetime
+
+from sqlalchemy import text
+
+from migrate import has_column
+from timeline import DEFAULT_FANOUT_THRESHOLD
+
+MARK = text("""
+UPDATE users SET celebrity_since = :now
+WHERE followers_count > :threshold
+""")
+
+
+def upgrade(connection):
+    if has_column(connection, 'users', 'celebrity_since'):
+        return
+
+    connection.execute("ALTER TABLE users "
+                       "ADD COLUMN celebrity_since TIMESTAMP")
+    connection.execute("CREATE INDEX ix_users_celebrity_since "
+                       "ON users (celebrity_since)")
+
+    threshold = int(os.environ.get('TIMELINE_FANOUT_THRESHOLD',
+                                   DEFAULT_FANOUT_THRESHOLD))
+    connection.execute(MARK, now=datetime.utcnow(), threshold=threshold)
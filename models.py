@@ -1,12 +1,54 @@
 """SQLAlchemy models for Warbler."""
 
+from array import array
+from bisect import bisect_left
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, event, func, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import aliased, joinedload, load_only
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import password_hasher
+from replicas import RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy()
+
+
+class IdSet:
+    """A compact, read-only set of integer ids.
+
+    Ids are kept sorted in an array('i') -- 4 bytes each, against roughly
+    70 for an int in a Python set -- and membership is a binary search,
+    so checking thousands of users against a large following list stays
+    cheap in both time and memory.
+    """
+
+    def __init__(self, ids=()):
+        self.ids = array('i', sorted(ids))
+
+    @classmethod
+    def from_sorted(cls, ids):
+        """Build from ids that are already in ascending order."""
+
+        id_set = cls()
+        id_set.ids = array('i', ids)
+        return id_set
+
+    def __contains__(self, item):
+        position = bisect_left(self.ids, item)
+        return position < len(self.ids) and self.ids[position] == item
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __eq__(self, other):
+        return set(self) == set(other)
+
+    def __repr__(self):
+        return f"IdSet({list(self.ids)})"
 
 
 class Follows(db.Model):
@@ -26,6 +68,59 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    __table_args__ = (
+        # The primary key serves "followers of X"; this serves "X follows".
+        db.Index('ix_follows_user_following_id_user_being_followed_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+    @classmethod
+    def add(cls, follower_id, followed_id):
+        """Make `follower_id` follow `followed_id`.
+
+        Returns whether a row was inserted: False if the edge was already
+        there, so repeated follows leave the counters alone.
+        """
+
+        table = cls.__table__
+        values = {'user_being_followed_id': followed_id,
+                  'user_following_id': follower_id}
+
+        if db.session.connection().dialect.name == 'postgresql':
+            insert = (postgresql.insert(table)
+                      .values(values)
+                      .on_conflict_do_nothing()
+                      .returning(table.c.user_following_id))
+            return db.session.execute(insert).first() is not None
+
+        if cls._edge(follower_id, followed_id).first() is not None:
+            return False
+        db.session.execute(table.insert().values(values))
+        return True
+
+    @classmethod
+    def remove(cls, follower_id, followed_id):
+        """Stop `follower_id` following `followed_id`.
+
+        Returns whether a row was deleted.
+        """
+
+        deleted = cls._edge(follower_id, followed_id).delete(
+            synchronize_session=False)
+        return deleted > 0
+
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`, in the database?"""
+
+        return db.session.query(
+            cls._edge(follower_id, followed_id).exists()).scalar()
+
+    @classmethod
+    def _edge(cls, follower_id, followed_id):
+        return cls.query.filter(cls.user_being_followed_id == followed_id,
+                                cls.user_following_id == follower_id)
+
 
 class User(db.Model):
     """User in the system."""
@@ -72,6 +167,54 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts, kept in step by the write paths in app.py and
+    # repaired in bulk by `flask recount`.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+        index=True,
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped whenever anything shown on this user's pages changes; HTTP
+    # ETags are built from it (see http_cache.py).
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # When this user's messages stopped being fanned out to followers'
+    # timelines; NULL while they are. See timeline.py.
+    celebrity_since = db.Column(
+        db.DateTime,
+        index=True,
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -93,17 +236,80 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @property
+    def following_ids(self):
+        """IdSet of the users this user follows, loaded once per instance."""
+
+        if '_following_ids' not in self.__dict__:
+            followed = (db.session
+                        .query(Follows.user_being_followed_id)
+                        .filter(Follows.user_following_id == self.id)
+                        .order_by(Follows.user_being_followed_id))
+            self._following_ids = IdSet.from_sorted(
+                user_id for (user_id,) in followed)
+
+        return self._following_ids
+
+    @property
+    def follower_ids(self):
+        """IdSet of the users following this user, loaded once per instance."""
+
+        if '_follower_ids' not in self.__dict__:
+            followers = (db.session
+                         .query(Follows.user_following_id)
+                         .filter(Follows.user_being_followed_id == self.id)
+                         .order_by(Follows.user_following_id))
+            self._follower_ids = IdSet.from_sorted(
+                user_id for (user_id,) in followers)
+
+        return self._follower_ids
+
+    @classmethod
+    def card_query(cls, viewer_id):
+        """Query for users as they are shown on user cards.
+
+        Only the columns a card shows are loaded, and each row carries
+        `viewer_follows`: whether `viewer_id` follows that user, from an
+        outer join on the viewer's follow edge in the same SELECT.
+        """
+
+        edge = aliased(Follows)
+
+        return (db.session
+                .query(cls.id, cls.username, cls.image_url,
+                       cls.header_image_url, cls.bio, cls.version,
+                       edge.user_following_id.isnot(None)
+                       .label('viewer_follows'))
+                .outerjoin(edge,
+                           and_(edge.user_being_followed_id == cls.id,
+                                edge.user_following_id == viewer_id)))
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.follower_ids
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.following_ids
+
+    def liked_message_ids(self, message_ids):
+        """Return the set of `message_ids` this user has liked.
+
+        Answers the question for a whole page of messages in one query,
+        rather than loading each message's likers.
+        """
+
+        if not message_ids:
+            return set()
+
+        liked = (db.session
+                 .query(Liked_Message.liked_msg_id)
+                 .filter(Liked_Message.liker_id == self.id,
+                         Liked_Message.liked_msg_id.in_(message_ids)))
+
+        return {message_id for (message_id,) in liked}
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -112,7 +318,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_hasher.hash(password)
 
         user = User(
             username=username,
@@ -137,13 +343,113 @@ class User(db.Model):
 
         user = cls.query.filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            return user
 
         return False
 
+    def check_password(self, password):
+        """Does `password` match this user's password?
+
+        If the stored hash was made at a different bcrypt cost than is now
+        configured, it is replaced with a fresh one; the caller commits.
+        """
+
+        if not password_hasher.verify(self.password, password):
+            return False
+
+        if password_hasher.needs_rehash(self.password):
+            self.password = password_hasher.hash(password)
+
+        return True
+
+    @classmethod
+    def adjust_counts(cls, user_id, **deltas):
+        """Add `deltas` (e.g. followers_count=1) to a user's counters.
+
+        Done as a single UPDATE with column arithmetic, so concurrent
+        requests don't overwrite each other's increments. Also bumps the
+        user's version.
+        """
+
+        values = {getattr(cls, name): getattr(cls, name) + delta
+                  for name, delta in deltas.items()}
+        values[cls.version] = cls.version + 1
+        cls.query.filter(cls.id == user_id).update(
+            values, synchronize_session=False)
+
+    def release_counts(self):
+        """Take this user's follows and likes out of other rows' counters.
+
+        Call before deleting the user: the database cascades remove the
+        follows and likes rows, but not the counts derived from them.
+        """
+
+        followers = db.session.query(Follows.user_following_id).filter(
+            Follows.user_being_followed_id == self.id)
+        User.query.filter(User.id.in_(followers.subquery())).update(
+            {User.following_count: User.following_count - 1,
+             User.version: User.version + 1},
+            synchronize_session=False)
+
+        followed = db.session.query(Follows.user_being_followed_id).filter(
+            Follows.user_following_id == self.id)
+        User.query.filter(User.id.in_(followed.subquery())).update(
+            {User.followers_count: User.followers_count - 1,
+             User.version: User.version + 1},
+            synchronize_session=False)
+
+        liked = db.session.query(Liked_Message.liked_msg_id).filter(
+            Liked_Message.liker_id == self.id)
+        Message.query.filter(Message.id.in_(liked.subquery())).update(
+            {Message.likes_count: Message.likes_count - 1},
+            synchronize_session=False)
+
+        likes_of_own = (db.session
+                        .query(func.count())
+                        .select_from(Liked_Message)
+                        .join(Message)
+                        .filter(Message.user_id == self.id,
+                                Liked_Message.liker_id == User.id)
+                        .correlate(User)
+                        .as_scalar())
+        likers = (db.session
+                  .query(Liked_Message.liker_id)
+                  .join(Message)
+                  .filter(Message.user_id == self.id))
+        User.query.filter(User.id.in_(likers.subquery())).update(
+            {User.likes_count: User.likes_count - likes_of_own,
+             User.version: User.version + 1},
+            synchronize_session=False)
+
+    @classmethod
+    def recount(cls):
+        """Recompute every user's and message's counters from scratch.
+
+        Returns the number of users and messages updated.
+        """
+
+        def count_of(column, model):
+            return (db.session
+                    .query(func.count())
+                    .filter(column == model.id)
+                    .correlate(model)
+                    .as_scalar())
+
+        users = cls.query.update({
+            cls.messages_count: count_of(Message.user_id, cls),
+            cls.followers_count: count_of(Follows.user_being_followed_id, cls),
+            cls.following_count: count_of(Follows.user_following_id, cls),
+            cls.likes_count: count_of(Liked_Message.liker_id, cls),
+            cls.version: cls.version + 1,
+        }, synchronize_session=False)
+
+        messages = Message.query.update({
+            Message.likes_count: count_of(Liked_Message.liked_msg_id, Message),
+        }, synchronize_session=False)
+
+        return users, messages
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -163,7 +469,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -172,6 +478,13 @@ class Message(db.Model):
         nullable=False,
     )
 
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
     likers = db.relationship(
@@ -180,6 +493,35 @@ class Message(db.Model):
         backref="message"
     )
 
+    __table_args__ = (
+        # Serves profile feeds: one user's messages in (timestamp, id) order.
+        db.Index('ix_messages_user_id_timestamp_id',
+                 'user_id', 'timestamp', 'id'),
+    )
+
+    @classmethod
+    def timeline_query(cls):
+        """Query for messages as they are shown in a list of messages.
+
+        Each message's author is joined into the same SELECT, limited to the
+        columns the templates use, so a page of messages costs one statement
+        no matter how many authors appear on it.
+        """
+
+        return (cls
+                .query
+                .options(load_only('id', 'text', 'timestamp', 'user_id'),
+                         joinedload(cls.user)
+                         .load_only('id', 'username', 'image_url', 'version')))
+
+    @classmethod
+    def adjust_likes(cls, message_id, delta):
+        """Add `delta` to a message's like count."""
+
+        cls.query.filter(cls.id == message_id).update(
+            {cls.likes_count: cls.likes_count + delta},
+            synchronize_session=False)
+
 
 class Liked_Message(db.Model):
     """User's liked messages."""
@@ -198,6 +540,142 @@ class Liked_Message(db.Model):
         primary_key=True
     )
 
+    __table_args__ = (
+        # The primary key serves "X's likes"; this serves "who liked M".
+        db.Index('ix_liked_messages_liked_msg_id_liker_id',
+                 'liked_msg_id', 'liker_id'),
+    )
+
+    @classmethod
+    def toggle(cls, user_id, message_id, connection=None):
+        """Like the message if `user_id` doesn't, else unlike it.
+
+        Returns (liked, the message's like count), or None if there's no
+        such message. The like row and both counters change together,
+        in one statement on Postgres; double clicks toggle twice rather
+        than failing on the primary key.
+        """
+
+        if connection is None:
+            connection = db.session.connection()
+
+        params = {'user_id': user_id, 'message_id': message_id}
+
+        if connection.dialect.name == 'postgresql':
+            row = connection.execute(TOGGLE_LIKE, params).first()
+            return tuple(row) if row else None
+
+        # SQLite can't modify data in a CTE: the same steps, one by one.
+        if connection.execute(UNLIKE, params).first():
+            delta = -1
+        else:
+            delta = len(connection.execute(LIKE, params).fetchall())
+
+        params['delta'] = delta
+        row = connection.execute(COUNT_LIKE, params).first()
+        if row is None:
+            return None
+        if delta:
+            connection.execute(COUNT_LIKER, params)
+
+        return delta >= 0, row[0]
+
+
+# A like inserted concurrently (ON CONFLICT) still leaves the message liked.
+TOGGLE_LIKE = text("""
+WITH deleted AS (
+    DELETE FROM liked_messages
+    WHERE liker_id = :user_id AND liked_msg_id = :message_id
+    RETURNING 1
+), inserted AS (
+    INSERT INTO liked_messages (liker_id, liked_msg_id)
+    SELECT :user_id, id FROM messages
+    WHERE id = :message_id AND NOT EXISTS (SELECT FROM deleted)
+    ON CONFLICT DO NOTHING
+    RETURNING 1
+), delta AS (
+    SELECT (SELECT count(*) FROM inserted) - (SELECT count(*) FROM deleted) AS n
+), liker AS (
+    UPDATE users SET likes_count = likes_count + delta.n,
+                     version = version + 1
+    FROM delta
+    WHERE id = :user_id AND delta.n <> 0
+), message AS (
+    UPDATE messages SET likes_count = likes_count + delta.n
+    FROM delta
+    WHERE id = :message_id
+    RETURNING likes_count
+)
+SELECT NOT EXISTS (SELECT FROM deleted) AS liked, likes_count FROM message
+""")
+
+UNLIKE = text("""
+DELETE FROM liked_messages
+WHERE liker_id = :user_id AND liked_msg_id = :message_id
+RETURNING 1
+""")
+
+LIKE = text("""
+INSERT INTO liked_messages (liker_id, liked_msg_id)
+SELECT :user_id, id FROM messages WHERE id = :message_id
+ON CONFLICT DO NOTHING
+RETURNING 1
+""")
+
+COUNT_LIKE = text("""
+UPDATE messages SET likes_count = likes_count + :delta
+WHERE id = :message_id
+RETURNING likes_count
+""")
+
+COUNT_LIKER = text("""
+UPDATE users SET likes_count = likes_count + :delta, version = version + 1
+WHERE id = :user_id
+""")
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into one follower's home timeline."""
+
+    __tablename__ = 'timeline_entries'
+
+    owner_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_owner_timestamp',
+                 'owner_id', 'timestamp', 'message_id'),
+    )
+
+
+@event.listens_for(User, 'expire')
+def _forget_follow_ids(user, attrs):
+    """Reload follow id sets along with the rest of an expired user."""
+
+    if user is not None:
+        user.__dict__.pop('_following_ids', None)
+        user.__dict__.pop('_follower_ids', None)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
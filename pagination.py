@@ -0,0 +1,150 @@
+"""Keyset (cursor) pagination for Warbler's lists.
+
+Pages are ordered on a unique key such as (timestamp, id), and the next
+page starts strictly after the last row shown, so fetching page 1000
+costs the same index range scan as fetching page 1. Cursors are opaque,
+URL-safe tokens wrapping the last row's key.
+"""
+
+import base64
+import json
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import (BigInteger, DateTime, Integer, SmallInteger, String,
+                        tuple_)
+
+DEFAULT_PER_PAGE = 100
+
+
+class InvalidCursor(ValueError):
+    """A cursor token that could not be decoded, or doesn't fit its columns."""
+
+
+class Page:
+    """One page of results, plus the cursor for the page after it."""
+
+    def __init__(self, items, next_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(values):
+    """Turn a row's sort key into an opaque cursor token."""
+
+    payload = [value.isoformat() if isinstance(value, datetime) else value
+               for value in values]
+    token = base64.urlsafe_b64encode(json.dumps(payload).encode('utf-8'))
+
+    return token.decode('ascii').rstrip('=')
+
+
+def integer_bits(column_type):
+    """How many bits the database stores an integer column in."""
+
+    if isinstance(column_type, BigInteger):
+        return 64
+    if isinstance(column_type, SmallInteger):
+        return 16
+    return 32
+
+
+def cursor_value(value, column):
+    """`value`, as a value of `column`'s type; ValueError if it isn't one.
+
+    Cursors come from clients, so a value the database would refuse (a
+    string for an integer id, an id out of range) must be caught here,
+    not surface as a DataError from the query.
+    """
+
+    if column is None:
+        return value
+
+    column_type = column.type
+    if isinstance(column_type, DateTime):
+        if not isinstance(value, str):
+            raise ValueError(value)
+        return datetime.fromisoformat(value)
+
+    if isinstance(column_type, Integer):
+        limit = 2 ** (integer_bits(column_type) - 1)
+        if (not isinstance(value, int) or isinstance(value, bool)
+                or not -limit <= value < limit):
+            raise ValueError(value)
+        return value
+
+    if isinstance(column_type, String):
+        if not isinstance(value, str) or '\x00' in value:
+            raise ValueError(value)
+        return value
+
+    raise TypeError(f"Can't paginate on a column of type {column_type}")
+
+
+def decode_cursor(token, columns):
+    """Turn a cursor token back into values comparable with `columns`.
+
+    A None entry in `columns` takes its value as-is. Raises InvalidCursor
+    unless every value fits its column's type.
+    """
+
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        if not isinstance(payload, list) or len(payload) != len(columns):
+            raise InvalidCursor(token)
+
+        return [cursor_value(value, column)
+                for value, column in zip(payload, columns)]
+
+    except ValueError as exc:
+        raise InvalidCursor(token) from exc
+
+
+def per_page_default():
+    """The app's PAGE_SIZE setting."""
+
+    return current_app.config.get('PAGE_SIZE', DEFAULT_PER_PAGE)
+
+
+def paginate(query, columns, cursor=None, per_page=None,
+             descending=True, key=None):
+    """Return the page of `query` after `cursor`, ordered on `columns`.
+
+    `columns` must together be unique (end with a primary key) and should
+    match an index. `key` maps a result row to its values for `columns`;
+    by default they are read from same-named attributes on the row.
+    """
+
+    if per_page is None:
+        per_page = per_page_default()
+
+    if key is None:
+        names = [column.key for column in columns]
+        key = lambda row: [getattr(row, name) for name in names]
+
+    if cursor:
+        after = tuple_(*decode_cursor(cursor, columns))
+        position = tuple_(*columns)
+        query = query.filter(position < after if descending else position > after)
+
+    order = [column.desc() if descending else column.asc()
+             for column in columns]
+    rows = query.order_by(*order).limit(per_page + 1).all()
+
+    return page_of(rows, per_page, key)
+
+
+def page_of(rows, per_page, key):
+    """Cut `rows` (already sorted, fetched with one extra) into a Page."""
+
+    items = rows[:per_page]
+    next_cursor = encode_cursor(key(items[-1])) if len(rows) > per_page else None
+
+    return Page(items, next_cursor)
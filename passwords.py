@@ -0,0 +1,196 @@
+"""Password hashing for Warbler.
+
+bcrypt is deliberately slow: at the default cost a hash or check takes
+a few hundred milliseconds of CPU. PasswordHasher runs that work in a
+small process pool, so it can't take more CPUs than it is given. It also
+bounds how many hashes may wait at once: past that, a login fails at
+once (PasswordHasherBusy, a 503) instead of queueing. So does one whose
+hash times out or whose pool has died. It keeps latency and queue-depth
+numbers for the metrics endpoint.
+
+Configure it with init_app(app), which reads:
+
+- BCRYPT_LOG_ROUNDS: bcrypt cost for new hashes. Hashes made at another
+  cost are upgraded the next time their owner logs in.
+- PASSWORD_HASH_WORKERS: size of the process pool; 0 hashes inline
+  (in a thread, under gevent: see green.py).
+- PASSWORD_HASH_MAX_PENDING: hashes allowed to be queued or running.
+- PASSWORD_HASH_TIMEOUT: seconds to wait for a result from the pool.
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+import green
+
+LATENCY_SAMPLES = 1000
+
+
+class PasswordHasherBusy(Exception):
+    """Too many password hashes are already queued, or the pool failed."""
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'),
+                         bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _verify(hashed, password):
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    except ValueError:
+        # Not a bcrypt hash at all.
+        return False
+
+
+def hash_rounds(hashed):
+    """The bcrypt cost a hash was made with, e.g. 12 for '$2b$12$...'."""
+
+    try:
+        return int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """Hashes and checks passwords in a bounded process pool."""
+
+    def __init__(self, workers=0, rounds=12, max_pending=32, timeout=30):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.configure(workers, rounds, max_pending, timeout)
+
+    def configure(self, workers=0, rounds=12, max_pending=32, timeout=30):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+                self.executor = None
+
+            self.workers = workers
+            self.rounds = rounds
+            self.max_pending = max_pending
+            self.timeout = timeout
+            self.slots = threading.BoundedSemaphore(max_pending)
+
+            self.pending = 0
+            self.max_pending_seen = 0
+            self.completed = 0
+            self.rejected = 0
+            self.timed_out = 0
+            self.pool_failures = 0
+            self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def _pool(self):
+        # Created on first use, so each forked web worker gets its own.
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(self.workers)
+            return self.executor
+
+    def _discard_pool(self, executor):
+        # A worker process died; the next hash starts a fresh pool.
+        with self.lock:
+            self.pool_failures += 1
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False)
+
+    def _submit(self, function, *args):
+        executor = self._pool()
+        try:
+            future = executor.submit(function, *args)
+            return future.result(self.timeout)
+        except FutureTimeout:
+            future.cancel()
+            with self.lock:
+                self.timed_out += 1
+            raise PasswordHasherBusy()
+        except BrokenProcessPool:
+            self._discard_pool(executor)
+            raise PasswordHasherBusy()
+
+    def _run(self, function, *args):
+        # Don't wait for a slot: a queue of logins only grows under load.
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise PasswordHasherBusy()
+
+        start = time.monotonic()
+        with self.lock:
+            self.pending += 1
+            self.max_pending_seen = max(self.max_pending_seen, self.pending)
+
+        try:
+            if self.workers:
+                return self._submit(function, *args)
+            # Under gevent, don't stall every other request meanwhile.
+            return green.run_blocking(function, *args)
+
+        finally:
+            with self.lock:
+                self.pending -= 1
+                self.completed += 1
+                self.latencies.append(time.monotonic() - start)
+            self.slots.release()
+
+    def hash(self, password):
+        """Return a bcrypt hash of `password` at the configured cost."""
+
+        return self._run(_hash, password, self.rounds)
+
+    def verify(self, hashed, password):
+        """Does `password` match `hashed`?"""
+
+        return self._run(_verify, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made at a different cost than we now use?"""
+
+        return hash_rounds(hashed) != self.rounds
+
+    def stats(self):
+        """Queue depth and latency figures, for the metrics endpoint."""
+
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {
+                'workers': self.workers,
+                'rounds': self.rounds,
+                'pending': self.pending,
+                'max_pending': self.max_pending,
+                'max_pending_seen': self.max_pending_seen,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+                'pool_failures': self.pool_failures,
+            }
+
+        if latencies:
+            stats['latency_ms'] = {
+                'p50': latencies[len(latencies) // 2] * 1000,
+                'p95': latencies[int(len(latencies) * 0.95)] * 1000,
+                'max': latencies[-1] * 1000,
+            }
+
+        return stats
+
+
+password_hasher = PasswordHasher()
+
+
+def init_app(app):
+    """Configure the shared PasswordHasher from `app`'s settings."""
+
+    config = app.config
+    password_hasher.configure(
+        workers=config.get('PASSWORD_HASH_WORKERS', 0),
+        rounds=config.get('BCRYPT_LOG_ROUNDS', 12),
+        max_pending=config.get('PASSWORD_HASH_MAX_PENDING', 32),
+        timeout=config.get('PASSWORD_HASH_TIMEOUT', 30))
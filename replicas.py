@@ -0,0 +1,187 @@
+"""Send read-only requests to database replicas.
+
+With DATABASE_REPLICA_URLS set (comma-separated), the session routes each
+statement to a database:
+
+- Read-only requests (GET, HEAD, OPTIONS) read from a replica, picked
+  round-robin or by fewest checked-out connections
+  (REPLICA_STRATEGY: 'round_robin' or 'least_loaded').
+- Everything else uses the primary: flushes, INSERT/UPDATE/DELETE, other
+  textual statements, other request methods, and anything run outside
+  a request (CLI commands, tests).
+
+Read-your-writes: once a request has written, its client's reads go to
+the primary for REPLICA_PIN_SECONDS. Replicas are usually less than a
+second behind, so after e.g. posting a message the redirect to the
+profile shows it. The pin is kept in the Flask session.
+
+A replica that fails to connect is skipped for REPLICA_RETRY_SECONDS.
+With no replica available, reads fall back to the primary.
+"""
+
+import itertools
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
+
+import db_pool
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+PIN_KEY = '_db_primary_until'
+
+
+def is_write(clause):
+    """Might `clause` change data?"""
+
+    if isinstance(clause, UpdateBase):
+        return True
+    if isinstance(clause, TextClause):
+        return not clause.text.lstrip().upper().startswith('SELECT')
+    return False
+
+
+class Replica:
+    """One replica database, and whether it's currently usable."""
+
+    def __init__(self, url, retry_seconds=30):
+        self.url = url
+        self.engine = create_engine(url, **db_pool.engine_options(url))
+        self.retry_seconds = retry_seconds
+        self.down_until = 0
+        self.checked = False
+        event.listen(self.engine, 'handle_error', self._on_error)
+
+    def _on_error(self, context):
+        if context.is_disconnect:
+            self.mark_down()
+
+    def mark_down(self):
+        self.down_until = time.monotonic() + self.retry_seconds
+        self.checked = False
+
+    def available(self):
+        """Is this replica up? Checked by connecting, once per retry period."""
+
+        if time.monotonic() < self.down_until:
+            return False
+
+        if not self.checked:
+            try:
+                self.engine.connect().close()
+            except Exception:
+                self.mark_down()
+                current_app.logger.warning("Replica %s is unavailable",
+                                           self.engine.url)
+                return False
+            self.checked = True
+
+        return True
+
+    def load(self):
+        pool = self.engine.pool
+        return pool.checkedout() if hasattr(pool, 'checkedout') else 0
+
+
+class ReplicaRouter:
+    """Picks a replica for each read-only session."""
+
+    def __init__(self, urls, strategy='round_robin', retry_seconds=30):
+        if strategy not in ('round_robin', 'least_loaded'):
+            raise ValueError(f"Unknown replica strategy: {strategy!r}")
+
+        self.replicas = [Replica(url, retry_seconds) for url in urls]
+        self.strategy = strategy
+        self.lock = threading.Lock()
+        self.turns = itertools.cycle(range(len(self.replicas)))
+
+    def choose(self):
+        """An available replica's engine, or None to use the primary."""
+
+        if self.strategy == 'least_loaded':
+            candidates = sorted(self.replicas, key=lambda r: r.load())
+        else:
+            with self.lock:
+                start = next(self.turns)
+            candidates = self.replicas[start:] + self.replicas[:start]
+
+        for replica in candidates:
+            if replica.available():
+                return replica.engine
+
+        return None
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica.engine.dispose()
+
+
+def _reads_from_replica():
+    if not has_request_context() or request.method not in READ_METHODS:
+        return False
+    if g.get('db_wrote'):
+        return False
+    return session.get(PIN_KEY, 0) <= time.time()
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from a replica when the request allows it."""
+
+    def get_bind(self, mapper=None, clause=None):
+        router = self.app.extensions.get('replica_router')
+
+        if self._flushing or is_write(clause):
+            if has_request_context():
+                g.db_wrote = True
+
+        elif router is not None and _reads_from_replica():
+            # One replica per session transaction, so a request's reads
+            # see a single consistent snapshot.
+            engine = self.info.get('replica')
+            if engine is None:
+                engine = self.info['replica'] = router.choose()
+            if engine is not None:
+                return engine
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with sessions that can read from replicas."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def _forget_replica(db_session, *args):
+    db_session.info.pop('replica', None)
+
+
+event.listen(RoutingSession, 'after_commit', _forget_replica)
+event.listen(RoutingSession, 'after_rollback', _forget_replica)
+
+
+def _pin_after_write(response):
+    if g.get('db_wrote') or (request.method not in READ_METHODS
+                             and response.status_code < 400):
+        seconds = current_app.config.get('REPLICA_PIN_SECONDS', 10)
+        session[PIN_KEY] = time.time() + seconds
+    return response
+
+
+def init_app(app):
+    """Route `app`'s reads to the replicas in DATABASE_REPLICA_URLS, if any."""
+
+    urls = app.config.get('DATABASE_REPLICA_URLS') or []
+    if urls:
+        app.extensions['replica_router'] = ReplicaRouter(
+            urls,
+            strategy=app.config.get('REPLICA_STRATEGY', 'round_robin'),
+            retry_seconds=app.config.get('REPLICA_RETRY_SECONDS', 30))
+
+    app.after_request(_pin_after_write)
@@ -0,0 +1,671 @@
+"""Search for Warbler.
+
+Users are searched by username, bio and location. On Postgres the query
+runs in the database; with the pg_trgm extension, trigram GIN indexes
+make the substring match an index lookup (without it, each search scans
+the users table, and a warning says so). Elsewhere (SQLite test runs)
+an in-process n-gram inverted index answers the same query.
+
+Both backends match and rank users the same way. A term of three or
+more characters matches anywhere in a username, bio or location; a
+shorter one only matches the start of a username. Exact username
+matches come first, then username prefixes, then other username
+matches, then bio/location matches. Ties among username matches go to
+the shorter username; then to the account with more followers.
+
+Messages are searched by their text. On Postgres a GIN index over
+to_tsvector('english', text) serves the match and ts_rank orders it;
+elsewhere an in-process inverted index scores matches with BM25. Both
+require every search word to appear (like plainto_tsquery), and both
+rank only the newest SEARCH_MAX_CANDIDATES matches, so a common word
+costs a bounded amount of ranking work.
+"""
+
+import math
+import re
+import threading
+import time
+from bisect import bisect_left
+
+from flask import current_app
+from sqlalchemy import DDL, case, event, func, literal_column, or_, text
+
+from models import db, Message, User
+from pagination import (InvalidCursor, Page, decode_cursor, encode_cursor,
+                        per_page_default)
+
+# Deep pages of search results aren't useful; don't rank past this.
+MAX_RESULTS = 1000
+
+INDEX_MAX_AGE_SECONDS = 300
+
+# Matches ranked per message search (SEARCH_MAX_CANDIDATES), newest first.
+MAX_CANDIDATES = 5000
+
+# How long, and how many of, the message ids skipped over are looked for
+# again: ids are assigned when a message is inserted, but it becomes
+# visible when its transaction commits, so a lower id can appear after a
+# higher one.
+ID_GAP_SECONDS = 60
+MAX_GAPS = 100
+
+EXACT, PREFIX, USERNAME, PROFILE = 4, 3, 2, 1
+
+USER_FIELDS = ('username', 'bio', 'location')
+
+# Terms shorter than a trigram only match username prefixes.
+MIN_SUBSTRING_LENGTH = 3
+
+TRIGRAM_INDEXES = [
+    f"CREATE INDEX IF NOT EXISTS ix_users_{field}_trgm "
+    f"ON users USING gin ({field} gin_trgm_ops)"
+    for field in USER_FIELDS
+]
+
+# Serves short terms' username prefix match, pg_trgm or not.
+USERNAME_PREFIX_INDEX = DDL(
+    "CREATE INDEX IF NOT EXISTS ix_users_username_prefix "
+    "ON users (lower(username) text_pattern_ops)")
+
+
+##############################################################################
+# Text helpers
+
+
+def escape_like(value):
+    """Escape LIKE wildcards so `value` matches literally."""
+
+    return (value
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def match_rank(term, username, bio, location):
+    """How well a user matches `term` (lowercased); 0 if not at all."""
+
+    username = username.lower()
+    if username == term:
+        return EXACT
+    if username.startswith(term):
+        return PREFIX
+    if term in username:
+        return USERNAME
+    if term in (bio or '').lower() or term in (location or '').lower():
+        return PROFILE
+
+    return 0
+
+
+##############################################################################
+# Postgres trigram backend
+
+
+def has_trigram_support(connection):
+    """Is pg_trgm installed in the database behind `connection`?"""
+
+    if connection.dialect.name != 'postgresql':
+        return False
+
+    installed = connection.execute(text(
+        "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).scalar()
+
+    return bool(installed)
+
+
+def install_trigram_indexes(connection):
+    """Create pg_trgm and the trigram indexes, if Postgres offers them.
+
+    Returns True if the indexes are in place.
+    """
+
+    if connection.dialect.name != 'postgresql':
+        return False
+
+    available = connection.execute(text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    )).scalar()
+    if not available:
+        return False
+
+    connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    for statement in TRIGRAM_INDEXES:
+        connection.execute(text(statement))
+
+    return True
+
+
+@event.listens_for(User.__table__, 'after_create')
+def _create_trigram_indexes(target, connection, **kw):
+    install_trigram_indexes(connection)
+
+
+event.listen(User.__table__, 'after_create',
+             USERNAME_PREFIX_INDEX.execute_if(dialect='postgresql'))
+
+
+def _search_sql(term, offset, limit):
+    username = func.lower(User.username)
+    prefix = f"{escape_like(term)}%"
+
+    if len(term) < MIN_SUBSTRING_LENGTH:
+        match = username.like(prefix)
+    else:
+        pattern = f"%{escape_like(term)}%"
+        match = or_(User.username.ilike(pattern),
+                    User.bio.ilike(pattern),
+                    User.location.ilike(pattern))
+
+    rank = case([
+        (username == term, EXACT),
+        (username.like(prefix), PREFIX),
+        (User.username.ilike(f"%{escape_like(term)}%"), USERNAME),
+    ], else_=PROFILE)
+
+    return (User
+            .query
+            .filter(match)
+            .order_by(rank.desc(),
+                      case([(rank > PROFILE, func.length(User.username))],
+                           else_=0),
+                      User.followers_count.desc(),
+                      User.id)
+            .offset(offset)
+            .limit(limit)
+            .all())
+
+
+##############################################################################
+# In-process n-gram backend
+
+
+class UserIndex:
+    """An in-memory inverted index from trigrams to user ids.
+
+    Built from the database on first use and rebuilt once it is older
+    than INDEX_MAX_AGE_SECONDS; the app updates it in place when users
+    sign up, edit their profile or delete their account, so this
+    process's changes show up immediately.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.built_at = None
+        self.users = {}
+        self.postings = {}
+        self.usernames = []
+
+    def clear(self):
+        with self.lock:
+            self.built_at = None
+            self.users = {}
+            self.postings = {}
+            self.usernames = []
+
+    def ensure_fresh(self):
+        with self.lock:
+            if (self.built_at is None
+                    or time.monotonic() - self.built_at > INDEX_MAX_AGE_SECONDS):
+                self.rebuild()
+
+    def rebuild(self):
+        rows = db.session.query(User.id, User.username, User.bio,
+                                User.location, User.followers_count)
+
+        with self.lock:
+            self.users = {}
+            self.postings = {}
+            for row in rows.yield_per(1000):
+                self._add(*row)
+
+            self.usernames = sorted((fields[0].lower(), user_id)
+                                    for user_id, fields in self.users.items())
+            self.built_at = time.monotonic()
+
+    def add(self, user):
+        """Index (or re-index) `user`."""
+
+        with self.lock:
+            if self.built_at is None:
+                return
+
+            self.remove(user.id)
+            self._add(user.id, user.username, user.bio, user.location,
+                      user.followers_count or 0)
+
+            entry = (user.username.lower(), user.id)
+            self.usernames.insert(bisect_left(self.usernames, entry), entry)
+
+    def remove(self, user_id):
+        with self.lock:
+            fields = self.users.pop(user_id, None)
+            if fields is None:
+                return
+
+            for gram in self._grams(fields):
+                self.postings[gram].discard(user_id)
+
+            entry = (fields[0].lower(), user_id)
+            position = bisect_left(self.usernames, entry)
+            if self.usernames[position:position + 1] == [entry]:
+                del self.usernames[position]
+
+    def _add(self, user_id, username, bio, location, followers_count):
+        fields = (username, bio or '', location or '', followers_count)
+        self.users[user_id] = fields
+
+        for gram in self._grams(fields):
+            self.postings.setdefault(gram, set()).add(user_id)
+
+    def _grams(self, fields):
+        grams = set()
+        for value in fields[:3]:
+            value = value.lower()
+            grams.update(value[i:i + 3] for i in range(len(value) - 2))
+
+        return grams
+
+    def candidates(self, term):
+        """Ids of users that might contain `term` in a searched field."""
+
+        if len(term) < MIN_SUBSTRING_LENGTH:
+            # Too short for a trigram: only look for username prefixes.
+            start = bisect_left(self.usernames, (term, 0))
+            found = set()
+            for username, user_id in self.usernames[start:]:
+                if not username.startswith(term):
+                    break
+                found.add(user_id)
+            return found
+
+        grams = [term[i:i + 3] for i in range(len(term) - 2)]
+        posting_sets = sorted((self.postings.get(gram, set())
+                               for gram in grams), key=len)
+
+        return set.intersection(*posting_sets) if posting_sets else set()
+
+    def search(self, term, offset, limit):
+        """Return ids of the users ranked `offset`..`offset + limit`."""
+
+        self.ensure_fresh()
+
+        with self.lock:
+            ranked = []
+            for user_id in self.candidates(term):
+                username, bio, location, followers_count = self.users[user_id]
+                rank = match_rank(term, username, bio, location)
+                if rank:
+                    ranked.append((-rank,
+                                   len(username) if rank > PROFILE else 0,
+                                   -followers_count,
+                                   user_id))
+
+        ranked.sort()
+        return [user_id for (*_, user_id) in ranked[offset:offset + limit]]
+
+
+user_index = UserIndex()
+
+
+def _search_index(term, offset, limit):
+    ids = user_index.search(term, offset, limit)
+    users = {user.id: user for user in User.query.filter(User.id.in_(ids))}
+
+    return [users[user_id] for user_id in ids if user_id in users]
+
+
+##############################################################################
+# Postgres full-text backend for messages
+
+TEXT_SEARCH_CONFIG = literal_column("'english'")
+
+MESSAGE_TEXT_INDEX = DDL(
+    "CREATE INDEX IF NOT EXISTS ix_messages_text_fts "
+    "ON messages USING gin (to_tsvector('english', text))")
+
+event.listen(Message.__table__, 'after_create',
+             MESSAGE_TEXT_INDEX.execute_if(dialect='postgresql'))
+
+
+def max_candidates():
+    return current_app.config.get('SEARCH_MAX_CANDIDATES', MAX_CANDIDATES)
+
+
+def _search_messages_sql(query, offset, limit):
+    document = func.to_tsvector(TEXT_SEARCH_CONFIG, Message.text)
+    terms = func.plainto_tsquery(TEXT_SEARCH_CONFIG, query)
+
+    # ts_rank is costly: rank the newest matches only, not every one.
+    candidates = (db.session
+                  .query(Message.id)
+                  .filter(document.op('@@')(terms))
+                  .order_by(Message.id.desc())
+                  .limit(max_candidates())
+                  .subquery())
+
+    return (Message
+            .timeline_query()
+            .join(candidates, candidates.c.id == Message.id)
+            .order_by(func.ts_rank(document, terms).desc(), Message.id.desc())
+            .offset(offset)
+            .limit(limit)
+            .all())
+
+
+##############################################################################
+# In-process BM25 backend for messages
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+STOP_WORDS = frozenset("""
+    a an and are as at be but by for from has have he her his i if in into is
+    it its me my no not of on or our she so that the their them then there
+    these they this to was we were what when which who will with you your
+""".split())
+
+WORD = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(value):
+    """Lowercased search words in `value`, without stop words."""
+
+    return [word for word in WORD.findall(value.lower())
+            if word not in STOP_WORDS]
+
+
+class MessageIndex:
+    """An in-memory inverted index over message text, scored with BM25.
+
+    Built from the database on first use. Before each search it indexes
+    any messages with a higher id than it has seen, so messages posted by
+    other processes show up without a rebuild. Ids it skipped over are
+    looked for again for ID_GAP_SECONDS, in case their transactions
+    commit late. This process adds and removes its own messages as they
+    are posted and deleted; messages another process deleted are dropped
+    when a search finds them gone (see _search_messages_index).
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.built = False
+            self.max_id = 0
+            self.gaps = {}
+            self.postings = {}
+            self.docs = {}
+            self.total_length = 0
+
+    def catch_up(self):
+        """Index messages newer than the newest one already indexed.
+
+        Also looks again for ids skipped earlier, which may belong to
+        messages committed since.
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            self.gaps = {message_id: seen for message_id, seen
+                         in self.gaps.items() if now - seen < ID_GAP_SECONDS}
+            since = self.max_id
+            gaps = list(self.gaps)
+
+        newer = Message.id > since
+        rows = (db.session
+                .query(Message.id, Message.text)
+                .filter(or_(newer, Message.id.in_(gaps)) if gaps else newer)
+                .order_by(Message.id))
+
+        with self.lock:
+            for message_id, message_text in rows.yield_per(1000):
+                self._add(message_id, message_text)
+            self.built = True
+
+    def rebuild(self):
+        with self.lock:
+            self.clear()
+            self.catch_up()
+
+        return len(self.docs)
+
+    def add(self, message):
+        with self.lock:
+            if self.built:
+                self._add(message.id, message.text)
+
+    def remove(self, message_id):
+        with self.lock:
+            doc = self.docs.pop(message_id, None)
+            if doc is None:
+                return
+
+            length, terms = doc
+            self.total_length -= length
+            for term in terms:
+                postings = self.postings[term]
+                del postings[message_id]
+                if not postings:
+                    del self.postings[term]
+
+    def _add(self, message_id, message_text):
+        if message_id in self.docs:
+            return
+
+        words = tokenize(message_text)
+        counts = {}
+        for word in words:
+            counts[word] = counts.get(word, 0) + 1
+
+        for word, count in counts.items():
+            self.postings.setdefault(word, {})[message_id] = count
+
+        self.docs[message_id] = (len(words), tuple(counts))
+        self.total_length += len(words)
+
+        self.gaps.pop(message_id, None)
+        if message_id > self.max_id:
+            # Ids skipped over may belong to transactions not yet
+            # committed; only recent ones matter.
+            now = time.monotonic()
+            start = max(self.max_id + 1, message_id - MAX_GAPS)
+            self.gaps.update((missing, now)
+                             for missing in range(start, message_id))
+            self.max_id = message_id
+
+    def search(self, query, offset, limit):
+        """Return ids of the messages ranked `offset`..`offset + limit`."""
+
+        self.catch_up()
+        terms = set(tokenize(query))
+
+        with self.lock:
+            if not terms or not self.docs:
+                return []
+
+            posting_lists = [self.postings.get(term, {}) for term in terms]
+            posting_lists.sort(key=len)
+            matches = set(posting_lists[0]).intersection(*posting_lists[1:])
+            # Like the SQL backend: rank the newest matches only.
+            matches = sorted(matches, reverse=True)[:max_candidates()]
+
+            doc_count = len(self.docs)
+            average_length = self.total_length / doc_count or 1
+
+            ranked = []
+            for message_id in matches:
+                length = self.docs[message_id][0]
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+                score = 0.0
+                for postings in posting_lists:
+                    frequency = postings[message_id]
+                    idf = math.log(1 + (doc_count - len(postings) + 0.5)
+                                   / (len(postings) + 0.5))
+                    score += idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+                ranked.append((-score, -message_id))
+
+        ranked.sort()
+        return [-negative_id for (_, negative_id) in ranked[offset:offset + limit]]
+
+
+message_index = MessageIndex()
+
+
+def _search_messages_index(query, offset, limit):
+    while True:
+        ids = message_index.search(query, offset, limit)
+        messages = {msg.id: msg for msg
+                    in Message.timeline_query().filter(Message.id.in_(ids))}
+
+        missing = [message_id for message_id in ids
+                   if message_id not in messages]
+        if not missing:
+            return [messages[message_id] for message_id in ids]
+
+        # Deleted by another process: forget them and rank again.
+        for message_id in missing:
+            message_index.remove(message_id)
+
+
+##############################################################################
+# Public interface
+
+
+def uses_database_search():
+    """Will user search run in the database (True) or in-process (False)?
+
+    On Postgres it always runs in the database, rather than holding every
+    user in each worker's memory; without pg_trgm that is a scan of the
+    users table, so say so, once.
+    """
+
+    state = current_app.extensions.setdefault('search', {})
+    if 'database' not in state:
+        connection = db.session.connection()
+        state['database'] = connection.dialect.name == 'postgresql'
+        if state['database'] and not has_trigram_support(connection):
+            current_app.logger.warning(
+                "pg_trgm is not installed: user search scans the users "
+                "table. Run `flask migrate` where pg_trgm is available.")
+
+    return state['database']
+
+
+def uses_full_text_index():
+    """Will message search run in the database (True) or in-process?"""
+
+    return db.session.connection().dialect.name == 'postgresql'
+
+
+def ranked_page(fetch, cursor=None, per_page=None):
+    """Page through ranked results with an opaque offset cursor.
+
+    Ranked results have no stable keyset to resume from, so the cursor
+    wraps an offset; `fetch(offset, limit)` returns the rows. Ranking
+    stops at MAX_RESULTS.
+    """
+
+    if per_page is None:
+        per_page = per_page_default()
+
+    offset = decode_cursor(cursor, [None])[0] if cursor else 0
+    if not isinstance(offset, int) or offset < 0:
+        raise InvalidCursor(cursor)
+
+    limit = min(per_page, MAX_RESULTS - offset)
+    if limit <= 0:
+        return Page([])
+
+    # Fetch one extra to learn whether there is another page.
+    rows = fetch(offset, limit + 1)
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([offset + limit])
+
+    return Page(rows, next_cursor)
+
+
+def search_users(query, cursor=None, per_page=None):
+    """Return a Page of users matching `query`, best matches first."""
+
+    term = ' '.join(query.lower().split())
+    if not term:
+        return Page([])
+
+    fetch = _search_sql if uses_database_search() else _search_index
+
+    return ranked_page(lambda offset, limit: fetch(term, offset, limit),
+                       cursor=cursor,
+                       per_page=per_page)
+
+
+def search_messages(query, cursor=None, per_page=None):
+    """Return a Page of messages matching `query`, best matches first."""
+
+    if not tokenize(query):
+        return Page([])
+
+    if uses_full_text_index():
+        fetch = _search_messages_sql
+    else:
+        fetch = _search_messages_index
+
+    return ranked_page(lambda offset, limit: fetch(query, offset, limit),
+                       cursor=cursor,
+                       per_page=per_page)
+
+
+def user_changed(user):
+    """Keep the in-process index in step with a new or edited user."""
+
+    user_index.add(user)
+
+
+def user_deleted(user_id):
+    """Drop a deleted user from the in-process index."""
+
+    user_index.remove(user_id)
+
+
+def message_added(message):
+    """Keep the in-process index in step with a new message."""
+
+    message_index.add(message)
+
+
+def message_deleted(message_id):
+    """Drop a deleted message from the in-process index."""
+
+    message_index.remove(message_id)
+
+
+def rebuild_indexes():
+    """Rebuild the search indexes after a bulk load.
+
+    On Postgres this (re)creates the database indexes; otherwise it
+    rebuilds this process's in-memory indexes. Returns a description of
+    what was done.
+    """
+
+    connection = db.session.connection()
+
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(MESSAGE_TEXT_INDEX.statement))
+        connection.execute(text("REINDEX INDEX ix_messages_text_fts"))
+        connection.execute(text(USERNAME_PREFIX_INDEX.statement))
+        connection.execute(text("REINDEX INDEX ix_users_username_prefix"))
+        done = ["message full-text index", "username prefix index"]
+        if install_trigram_indexes(connection):
+            for field in USER_FIELDS:
+                connection.execute(text(f"REINDEX INDEX ix_users_{field}_trgm"))
+            done.append("user trigram indexes")
+        return f"Rebuilt {', '.join(done)}."
+
+    user_index.rebuild()
+    messages = message_index.rebuild()
+
+    return f"Indexed {len(user_index.users)} users and {messages} messages."
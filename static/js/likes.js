@@ -0,0 +1,29 @@
+// Like and unlike messages without reloading the page.
+//
+// Like buttons are plain forms posting to /like, which redirects back to
+// the page; this posts to the JSON endpoint instead and flips the star.
+// Without JavaScript, the forms still work.
+
+$(document).on('submit', 'form[action="/like"]', function (evt) {
+  evt.preventDefault();
+
+  var $form = $(this);
+  var $button = $form.find('button');
+  var messageId = $form.find('[name="message_id"]').val();
+
+  $button.prop('disabled', true);
+
+  $.post('/messages/' + messageId + '/like')
+    .done(function (data) {
+      $form.find('i.fa-star')
+        .toggleClass('fas', data.liked)
+        .toggleClass('far', !data.liked);
+    })
+    .fail(function () {
+      // Fall back to the full-page form post (which skips this handler).
+      evt.target.submit();
+    })
+    .always(function () {
+      $button.prop('disabled', false);
+    });
+});
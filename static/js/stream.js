@@ -0,0 +1,39 @@
+// Add new messages from followed users to the top of the home timeline.
+//
+// /stream sends a 'warble' event for each one (see streaming.py); the
+// browser reconnects by itself when the stream ends or drops.
+
+$(function () {
+  var $messages = $('#messages');
+  if (!$messages.length || !window.EventSource) return;
+
+  var source = new EventSource('/stream');
+
+  source.addEventListener('warble', function (evt) {
+    var msg = JSON.parse(evt.data);
+    if ($messages.find('input[name="message_id"][value="' + msg.id + '"]').length) return;
+
+    var userUrl = '/users/' + msg.user.id;
+    var posted = new Date(msg.timestamp + 'Z').toLocaleDateString(
+      'en-GB', {day: '2-digit', month: 'long', year: 'numeric'});
+
+    var $form = $('<form method="POST" action="/like">')
+      .append($('<input type="text" name="message_id" style="display: none">').val(msg.id))
+      .append($('<button class="btn" style="z-index: 10000000; position: relative">')
+        .append('<i class="far fa-star"></i>'));
+
+    var $area = $('<div class="message-area">')
+      .append($('<a class="message-link">').attr('href', '/messages/' + msg.id)
+        .append($('<a>').attr('href', userUrl).text('@' + msg.user.username))
+        .append(' ')
+        .append($('<span class="text-muted">').text(posted))
+        .append($('<p>').text(msg.text)));
+
+    $('<li class="list-group-item">')
+      .append($('<a>').attr('href', userUrl)
+        .append($('<img alt="" class="timeline-image">').attr('src', msg.user.image_url)))
+      .append($form)
+      .append($area)
+      .prependTo($messages);
+  });
+});
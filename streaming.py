@@ -0,0 +1,296 @@
+"""New messages pushed to the home page as Server-Sent Events.
+
+GET /stream is an event stream. A logged-in user receives a 'warble'
+event for each message posted by someone they follow, while the home
+page is open; static/js/stream.js adds it to the top of the page. Idle
+clients hold an open connection, not a database connection, instead
+of reloading / to check for news.
+
+messages_add() publishes each new message to its author's channel,
+"user:<id>". A stream subscribes to the channels of everyone its user
+follows. Brokers carry the messages. Each broker has:
+
+- publish(channel, event): send `event` (a JSON-serializable dict) to
+  the channel's current subscribers.
+- subscribe(channels): a subscription with get(timeout), returning the
+  next event or None after `timeout` seconds, and close().
+
+Streaming is off unless STREAM_BROKER picks a broker: /stream answers
+404, messages aren't published, and the home page doesn't open a
+stream. The brokers:
+
+- 'local' keeps subscribers in memory. It only reaches streams served
+  by the same process, so it suits one worker, and tests; init_app()
+  refuses it when WEB_CONCURRENCY is more than 1.
+- 'redis' uses Redis pub/sub (at STREAM_BROKER_URL), shared by every
+  worker.
+
+A user who follows no one gets a stream of keepalives. If the broker
+fails, posting still works: the message just isn't pushed.
+
+A stream ends after STREAM_MAX_SECONDS and the browser reconnects, so
+it picks up new follows. Until then it sends a comment every
+STREAM_KEEPALIVE seconds, so proxies don't close it as idle. Each open
+stream occupies a worker thread or greenlet; serve with a threaded or
+async worker class (see gunicorn.conf.py).
+"""
+
+import json
+import queue
+import threading
+import time
+from collections import defaultdict
+
+from flask import (Response, abort, current_app, g, jsonify,
+                   stream_with_context)
+
+from models import db
+
+RETRY_MS = 3000
+
+
+class LocalSubscription:
+    """A LocalBroker subscriber's queue of events."""
+
+    def __init__(self, broker, channels, max_queued):
+        self.broker = broker
+        self.channels = channels
+        self.queue = queue.Queue(maxsize=max_queued)
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # A client this far behind has stalled; drop rather than grow.
+            pass
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """Publish/subscribe within this process."""
+
+    def __init__(self, max_queued=100):
+        self.max_queued = max_queued
+        self.lock = threading.Lock()
+        self.subscribers = defaultdict(set)
+
+    def publish(self, channel, event):
+        with self.lock:
+            subscribers = list(self.subscribers.get(channel, ()))
+
+        for subscription in subscribers:
+            subscription.put(event)
+
+    def subscribe(self, channels):
+        subscription = LocalSubscription(self, list(channels),
+                                         self.max_queued)
+        with self.lock:
+            for channel in subscription.channels:
+                self.subscribers[channel].add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for channel in subscription.channels:
+                subscribers = self.subscribers.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.subscribers[channel]
+
+
+class IdleSubscription:
+    """A subscription to no channels: nothing ever arrives."""
+
+    def get(self, timeout):
+        time.sleep(timeout)
+        return None
+
+    def close(self):
+        pass
+
+
+class RedisSubscription:
+    """A Redis pub/sub connection, listening on some channels."""
+
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    def get(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+
+            message = self.pubsub.get_message(timeout=remaining)
+            if message is not None and message['type'] == 'message':
+                return json.loads(message['data'])
+
+    def close(self):
+        self.pubsub.close()
+
+
+class RedisBroker:
+    """Publish/subscribe through Redis, across every worker.
+
+    `client` is a redis.Redis, or a stand-in with the same publish and
+    pubsub methods.
+    """
+
+    def __init__(self, client, prefix='warbler:'):
+        self.client = client
+        self.prefix = prefix
+
+    def publish(self, channel, event):
+        self.client.publish(self.prefix + channel, json.dumps(event))
+
+    def subscribe(self, channels):
+        channels = [self.prefix + channel for channel in channels]
+        if not channels:
+            # Redis rejects a SUBSCRIBE with no channels.
+            return IdleSubscription()
+
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(*channels)
+        return RedisSubscription(pubsub)
+
+
+def make_broker(backend='local', url=None):
+    """Build the broker named by `backend`: 'local' or 'redis'."""
+
+    if backend == 'local':
+        return LocalBroker()
+
+    if backend == 'redis':
+        # Optional dependency: only needed when Redis is configured.
+        import redis
+        return RedisBroker(redis.Redis.from_url(url))
+
+    raise ValueError(f"Unknown stream broker: {backend!r}")
+
+
+def enabled():
+    """Is streaming on, i.e. is STREAM_BROKER set?"""
+
+    return bool(current_app.config.get('STREAM_BROKER'))
+
+
+def get_broker():
+    """This app's broker, built from its config."""
+
+    extensions = current_app.extensions
+    if 'stream_broker' not in extensions:
+        extensions['stream_broker'] = make_broker(
+            backend=current_app.config.get('STREAM_BROKER', 'local'),
+            url=current_app.config.get('STREAM_BROKER_URL'))
+
+    return extensions['stream_broker']
+
+
+def channel(user_id):
+    return f"user:{user_id}"
+
+
+def message_event(message, author):
+    """The event announcing `message`, flushed but perhaps not committed."""
+
+    return {
+        'id': message.id,
+        'text': message.text,
+        'timestamp': message.timestamp.isoformat(),
+        'user': {'id': author.id,
+                 'username': author.username,
+                 'image_url': author.image_url},
+    }
+
+
+def publish(author_id, event):
+    """Send a message_event() to the streams of the author's followers."""
+
+    if not enabled():
+        return
+
+    try:
+        get_broker().publish(channel(author_id), event)
+    except Exception:
+        # The message is saved; only the live push is lost.
+        current_app.logger.exception("Couldn't publish message %s",
+                                     event['id'])
+
+
+def format_event(event):
+    """An SSE 'warble' event for `event`."""
+
+    return (f"id: {event['id']}\n"
+            f"event: warble\n"
+            f"data: {json.dumps(event)}\n\n")
+
+
+def stream_view():
+    """The current user's stream of new messages from those they follow."""
+
+    if not enabled():
+        abort(404)
+
+    if not g.user:
+        return jsonify(error="Log in first."), 401
+
+    config = current_app.config
+    keepalive = config.get('STREAM_KEEPALIVE', 15)
+    max_seconds = config.get('STREAM_MAX_SECONDS', 300)
+
+    # Subscribe before responding, so nothing posted from here on is
+    # missed. The database connection goes back to the pool: the stream
+    # doesn't need it.
+    try:
+        subscription = get_broker().subscribe(
+            channel(user_id) for user_id in g.user.following_ids)
+    except Exception:
+        current_app.logger.exception("Couldn't subscribe to messages")
+        # EventSource gives up on an error status, rather than retrying.
+        return jsonify(error="Live updates are unavailable."), 503
+    db.session.close()
+
+    def events():
+        deadline = time.monotonic() + max_seconds
+        try:
+            yield f"retry: {RETRY_MS}\n\n"
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+
+                event = subscription.get(min(keepalive, remaining))
+                yield ": keepalive\n\n" if event is None else format_event(event)
+        finally:
+            subscription.close()
+
+    response = Response(stream_with_context(events()),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Don't let nginx buffer the stream.
+    response.headers['X-Accel-Buffering'] = 'no'
+
+    return response
+
+
+def init_app(app):
+    """Serve /stream for `app`."""
+
+    if (app.config.get('STREAM_BROKER') == 'local'
+            and app.config.get('WEB_CONCURRENCY', 1) > 1):
+        raise RuntimeError(
+            "STREAM_BROKER 'local' only reaches streams on its own worker; "
+            "use 'redis' with more than one (WEB_CONCURRENCY).")
+
+    app.add_url_rule('/stream', 'stream', stream_view)
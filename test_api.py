@@ -0,0 +1,207 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+import gzip
+import json
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows, Liked_Message
+import timeline
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class ApiTestCase(TestCase):
+    """Test the /api/v1 endpoints."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        reader = User.signup("reader", "reader@test.com", "password", "")
+        author = User.signup("author", "author@test.com", "password", "")
+        db.session.commit()
+        reader.following.append(author)
+        messages = [Message(text=f"warble {i}", user_id=author.id)
+                    for i in range(3)]
+        db.session.add_all(messages)
+        db.session.commit()
+        db.session.add(Liked_Message(liker_id=reader.id,
+                                     liked_msg_id=messages[0].id))
+        db.session.commit()
+
+        self.reader_id = reader.id
+        self.author_id = author.id
+        self.message_ids = [message.id for message in messages]
+
+        with app.app_context():
+            User.recount()
+            timeline.rebuild()
+            db.session.commit()
+
+        app.config['PAGE_SIZE'] = 2
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['PAGE_SIZE'] = 100
+        app.config['API_COMPRESS_MIN_SIZE'] = 1024
+        app.extensions.pop('user_cache', None)
+        app.extensions.pop('fragment_cache', None)
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+    def test_timeline(self):
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get("/api/v1/timeline")
+            self.assertEqual(resp.content_type, "application/json")
+            first = resp.json
+            self.assertEqual([msg['text'] for msg in first['items']],
+                             ["warble 2", "warble 1"])
+            self.assertEqual(first['items'][0]['user'],
+                             {'id': self.author_id, 'username': "author",
+                              'image_url': ""})
+
+            resp = c.get(f"/api/v1/timeline?cursor={first['next_cursor']}")
+            [last] = resp.json['items']
+            self.assertEqual(last['text'], "warble 0")
+            self.assertTrue(last['liked'])
+            self.assertIsNone(resp.json['next_cursor'])
+
+    def test_login_required(self):
+        for url in ("/api/v1/timeline",
+                    f"/api/v1/users/{self.author_id}/followers",
+                    f"/api/v1/users/{self.author_id}/likes"):
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 401)
+            self.assertIn('error', resp.json)
+
+        resp = self.client.post(f"/api/v1/messages/{self.message_ids[0]}/like")
+        self.assertEqual(resp.status_code, 401)
+
+    def test_user(self):
+        resp = self.client.get(f"/api/v1/users/{self.author_id}")
+        self.assertEqual(resp.json['username'], "author")
+        self.assertEqual(resp.json['messages_count'], 3)
+        self.assertEqual(resp.json['followers_count'], 1)
+        self.assertNotIn('password', resp.json)
+        self.assertNotIn('following', resp.json)
+
+        with self.client as c:
+            self.login(c)
+            resp = c.get(f"/api/v1/users/{self.author_id}")
+            self.assertTrue(resp.json['following'])
+
+        resp = self.client.get("/api/v1/users/0")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.json, {'error': "No such user."})
+
+    def test_user_messages(self):
+        resp = self.client.get(f"/api/v1/users/{self.author_id}/messages")
+        self.assertEqual(len(resp.json['items']), 2)
+        self.assertFalse(resp.json['items'][0]['liked'])
+
+    def test_followers_and_likes(self):
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get(f"/api/v1/users/{self.author_id}/followers")
+            [card] = resp.json['items']
+            self.assertEqual(card['username'], "reader")
+            self.assertFalse(card['following'])
+
+            resp = c.get(f"/api/v1/users/{self.reader_id}/following")
+            self.assertTrue(resp.json['items'][0]['following'])
+
+            resp = c.get(f"/api/v1/users/{self.reader_id}/likes")
+            self.assertEqual([msg['id'] for msg in resp.json['items']],
+                             [self.message_ids[0]])
+
+    def test_toggle_like(self):
+        with self.client as c:
+            self.login(c)
+            url = f"/api/v1/messages/{self.message_ids[1]}/like"
+
+            self.assertEqual(c.post(url).json, {'id': self.message_ids[1],
+                                                'liked': True,
+                                                'likes_count': 1})
+            self.assertFalse(c.post(url).json['liked'])
+
+            resp = c.post("/api/v1/messages/0/like")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_toggle_follow(self):
+        with self.client as c:
+            self.login(c)
+            url = f"/api/v1/users/{self.author_id}/follow"
+
+            self.assertFalse(c.post(url).json['following'])
+            self.assertEqual(User.query.get(self.author_id).followers_count, 0)
+            self.assertTrue(c.post(url).json['following'])
+            self.assertEqual(Follows.query.count(), 1)
+
+            resp = c.post(f"/api/v1/users/{self.reader_id}/follow")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_toggle_follow_stale_snapshot(self):
+        with self.client as c:
+            self.login(c)
+            url = f"/api/v1/users/{self.author_id}/follow"
+            c.get(f"/api/v1/users/{self.author_id}")
+
+            # Unfollowed through another worker: this one's cached
+            # snapshot still lists the follow.
+            Follows.query.delete()
+            db.session.commit()
+
+            resp = c.post(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.json['following'])
+            self.assertEqual(Follows.query.count(), 1)
+
+    def test_invalid_cursor(self):
+        resp = self.client.get(
+            f"/api/v1/users/{self.author_id}/messages?cursor=nonsense")
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('error', resp.json)
+
+    def test_gzip(self):
+        app.config['API_COMPRESS_MIN_SIZE'] = 10
+        url = f"/api/v1/users/{self.author_id}"
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(resp.data))['username'],
+                         "author")
+
+        resp = self.client.get(url)
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_small_responses_uncompressed(self):
+        resp = self.client.get(f"/api/v1/users/{self.author_id}",
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
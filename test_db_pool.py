@@ -0,0 +1,122 @@
+"""Connection pool tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_db_pool.py
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeout
+
+from app import app
+from models import db
+import db_pool
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+URL = os.environ['DATABASE_URL']
+
+
+class EngineOptionsTestCase(TestCase):
+    """Test reading pool settings from the environment."""
+
+    def test_defaults(self):
+        options = db_pool.engine_options(URL, {})
+
+        self.assertIs(options['poolclass'], db_pool.MeteredQueuePool)
+        self.assertEqual(options['pool_size'], 5)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertNotIn('connect_args', options)
+
+    def test_environment(self):
+        options = db_pool.engine_options(URL, {
+            'DB_POOL_SIZE': '2',
+            'DB_MAX_OVERFLOW': '0',
+            'DB_POOL_RECYCLE': '60',
+            'DB_POOL_PRE_PING': 'off',
+            'DB_STATEMENT_TIMEOUT_MS': '500',
+        })
+
+        self.assertEqual(options['pool_size'], 2)
+        self.assertEqual(options['max_overflow'], 0)
+        self.assertEqual(options['pool_recycle'], 60)
+        self.assertFalse(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'],
+                         {'options': "-c statement_timeout=500"})
+
+    def test_sqlite(self):
+        options = db_pool.engine_options('sqlite://', {'DB_POOL_SIZE': '2'})
+        self.assertEqual(set(options), {'pool_pre_ping'})
+
+    def test_app_engine(self):
+        self.assertIsInstance(db.engine.pool, db_pool.MeteredQueuePool)
+
+
+class PoolStatsTestCase(TestCase):
+    """Test the pool's counters."""
+
+    def setUp(self):
+        self.engine = create_engine(URL, **db_pool.engine_options(URL, {
+            'DB_POOL_SIZE': '1',
+            'DB_MAX_OVERFLOW': '1',
+            'DB_POOL_TIMEOUT': '0.05',
+            'DB_STATEMENT_TIMEOUT_MS': '50',
+        }))
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_checkouts_and_overflow(self):
+        first = self.engine.connect()
+        second = self.engine.connect()
+
+        stats = db_pool.stats(self.engine)
+        self.assertEqual(stats['checked_out'], 2)
+        self.assertEqual(stats['overflow'], 1)
+        self.assertEqual(stats['max_overflow_seen'], 1)
+
+        with self.assertRaises(PoolTimeout):
+            self.engine.connect()
+        stats = db_pool.stats(self.engine)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['checkouts'], 2)
+
+        first.close()
+        second.close()
+        self.assertEqual(db_pool.stats(self.engine)['checked_out'], 0)
+
+    def test_statement_timeout(self):
+        with self.engine.connect() as connection:
+            with self.assertRaises(OperationalError):
+                connection.execute("SELECT pg_sleep(1)")
+
+    def test_after_fork(self):
+        self.engine.connect().close()
+        db_pool.after_fork(self.engine)
+
+        stats = db_pool.stats(self.engine)
+        self.assertEqual(stats['checkouts'], 0)
+        self.assertEqual(stats['checked_in'], 0)
+
+    def test_metrics_endpoint(self):
+        app.config['METRICS_ENABLED'] = True
+        try:
+            resp = app.test_client().get("/_internal/metrics")
+        finally:
+            app.config['METRICS_ENABLED'] = False
+
+        self.assertIn('checkouts', resp.json['db_pool'])
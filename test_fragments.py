@@ -0,0 +1,135 @@
+"""Fragment cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fragments.py
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+from unittest import TestCase
+
+from flask import render_template_string
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows
+import fragments
+import timeline
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+TEMPLATE = "{% cache 'thing', 1, variant %}{{ value }}{% endcache %}"
+
+
+class FragmentTagTestCase(TestCase):
+    """Test the {% cache %} tag itself."""
+
+    def tearDown(self):
+        app.extensions.pop('fragment_cache', None)
+        app.config['FRAGMENT_CACHE_ENABLED'] = True
+
+    def render(self, **context):
+        with app.test_request_context():
+            return render_template_string(TEMPLATE, **context)
+
+    def test_cached(self):
+        self.assertEqual(self.render(variant=1, value="<b>"), "&lt;b&gt;")
+        self.assertEqual(self.render(variant=1, value="new"), "&lt;b&gt;")
+
+    def test_variants(self):
+        self.render(variant=1, value="one")
+        self.assertEqual(self.render(variant=2, value="two"), "two")
+        self.assertEqual(self.render(variant=1, value="x"), "one")
+
+    def test_invalidate(self):
+        self.render(variant=1, value="old")
+        with app.test_request_context():
+            fragments.invalidate('thing', 1)
+        self.assertEqual(self.render(variant=1, value="new"), "new")
+
+    def test_disabled(self):
+        app.config['FRAGMENT_CACHE_ENABLED'] = False
+        self.render(variant=1, value="old")
+        self.assertEqual(self.render(variant=1, value="new"), "new")
+
+
+class FragmentRoutesTestCase(TestCase):
+    """Test that routes invalidate the fragments they change."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        viewer = User.signup("viewer", "viewer@test.com", "password", "")
+        author = User.signup("author", "author@test.com", "password", "")
+        db.session.commit()
+        viewer.following.append(author)
+        message = Message(text="original text", user_id=author.id)
+        db.session.add(message)
+        db.session.commit()
+
+        self.viewer_id = viewer.id
+        self.author_id = author.id
+        self.message_id = message.id
+
+        with app.app_context():
+            timeline.rebuild()
+            db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.extensions.pop('fragment_cache', None)
+        app.extensions.pop('user_cache', None)
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.viewer_id
+
+    def test_like_invalidates(self):
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get("/")
+            self.assertIn("original text", str(resp.data))
+            self.assertNotIn("fas fa-star", str(resp.data))
+
+            # Edited behind the cache's back: the fragment is still used.
+            Message.query.filter_by(id=self.message_id).update(
+                {'text': "edited text"})
+            db.session.commit()
+            self.assertIn("original text", str(c.get("/").data))
+
+            c.post("/like", data={"message_id": self.message_id},
+                   headers={"Referer": "/"})
+            resp = c.get("/")
+            self.assertIn("edited text", str(resp.data))
+            self.assertIn("fas fa-star", str(resp.data))
+
+    def test_profile_change(self):
+        with self.client as c:
+            self.login(c)
+            self.assertIn("@author", str(c.get("/users").data))
+
+            User.query.filter_by(id=self.author_id).update(
+                {'username': "renamed", 'version': User.version + 1})
+            db.session.commit()
+
+            resp = c.get("/users")
+            self.assertIn("@renamed", str(resp.data))
+            self.assertNotIn("@author", str(resp.data))
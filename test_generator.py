@@ -0,0 +1,76 @@
+"""Sample data generator tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_generator.py
+
+import csv
+import os
+import subprocess
+import sys
+import tempfile
+from collections import Counter
+from unittest import TestCase
+
+GENERATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'generator', 'create_csvs.py')
+
+FILES = ('users.csv', 'messages.csv', 'follows.csv', 'likes.csv')
+
+
+def generate(directory, *args):
+    """Run the generator into `directory`; return {filename: bytes}."""
+
+    subprocess.run([sys.executable, GENERATOR, '--users', '500',
+                    '--messages', '2000', '--out', directory, *args],
+                   check=True, stdout=subprocess.DEVNULL)
+
+    files = {}
+    for filename in FILES:
+        with open(os.path.join(directory, filename), 'rb') as f:
+            files[filename] = f.read()
+
+    return files
+
+
+class GeneratorTestCase(TestCase):
+    """Test generator/create_csvs.py."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def test_reproducible(self):
+        first = generate(self.path('first'), '--seed', '7')
+        second = generate(self.path('second'), '--seed', '7')
+        other = generate(self.path('other'), '--seed', '8')
+
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+
+    def test_sharded_reproducible(self):
+        first = generate(self.path('first'), '--processes', '2')
+        second = generate(self.path('second'), '--processes', '2')
+
+        self.assertEqual(first, second)
+
+    def test_follows_skewed(self):
+        generate(self.directory.name)
+
+        with open(self.path('follows.csv'), newline='') as f:
+            rows = list(csv.DictReader(f))
+        followers = Counter(row['user_being_followed_id'] for row in rows)
+        following = Counter(row['user_following_id'] for row in rows)
+
+        # A power law: the top 1% of accounts (5 of 500) have several
+        # times the ~1% of followers uniform targets would give them.
+        top = sum(count for user, count in followers.most_common(5))
+        self.assertGreater(top / len(rows), 0.05)
+
+        # Out-degrees are Pareto-distributed: the busiest follower is
+        # well above the average.
+        average = len(rows) / len(following)
+        self.assertGreater(following.most_common(1)[0][1], 3 * average)
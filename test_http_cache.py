@@ -0,0 +1,160 @@
+"""HTTP caching tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_http_cache.py
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class HTTPCacheTestCase(TestCase):
+    """Test ETags, 304s and static caching."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        viewer = User.signup("viewer", "viewer@test.com", "password", "")
+        author = User.signup("author", "author@test.com", "password", "")
+        db.session.commit()
+        message = Message(text="cached", user_id=author.id)
+        db.session.add(message)
+        db.session.commit()
+
+        self.viewer_id = viewer.id
+        self.author_id = author.id
+        self.message_id = message.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.extensions.pop('user_cache', None)
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.viewer_id
+
+    def test_not_modified(self):
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get(f"/users/{self.author_id}")
+            etag = resp.headers['ETag']
+            self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+
+            resp = c.get(f"/users/{self.author_id}",
+                         headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+            self.assertEqual(resp.headers['ETag'], etag)
+
+    def test_author_change(self):
+        url = f"/messages/{self.message_id}"
+
+        with self.client as c:
+            self.login(c)
+            etag = c.get(url).headers['ETag']
+
+            User.adjust_counts(self.author_id, messages_count=1)
+            db.session.commit()
+
+            resp = c.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_viewer_change(self):
+        url = f"/users/{self.author_id}"
+
+        with self.client as c:
+            self.login(c)
+            etag = c.get(url).headers['ETag']
+
+            c.post(f"/users/follow/{self.author_id}")
+            resp = c.get(url, headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Unfollow", str(resp.data))
+
+    def test_viewer_changed_elsewhere(self):
+        # A like or follow handled by another worker bumps the viewer's
+        # version without touching this process's snapshot of them.
+        url = f"/users/{self.author_id}"
+
+        with self.client as c:
+            self.login(c)
+            etag = c.get(url).headers['ETag']
+
+            db.session.execute(
+                User.__table__.update()
+                .where(User.id == self.viewer_id)
+                .values(version=User.version + 1))
+            db.session.commit()
+
+            resp = c.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_other_viewer(self):
+        url = f"/users/{self.author_id}"
+        etag = self.client.get(url).headers['ETag']
+
+        with self.client as c:
+            self.login(c)
+            resp = c.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_missing_page(self):
+        resp = self.client.get("/users/0")
+        self.assertEqual(resp.status_code, 404)
+        self.assertNotIn('ETag', resp.headers)
+
+    def test_flashes_not_cached(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['_flashes'] = [('success', 'Hello!')]
+            resp = c.get(f"/users/{self.author_id}")
+
+            self.assertIn("Hello!", str(resp.data))
+            self.assertNotIn('ETag', resp.headers)
+
+    def test_default(self):
+        resp = self.client.get("/users")
+        self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+
+    def test_static(self):
+        resp = self.client.get("/")
+        self.assertEqual(resp.headers['Cache-Control'], 'public, no-cache')
+
+        start = resp.data.index(b"/static/stylesheets/style.css?v=")
+        url = resp.data[start:resp.data.index(b'"', start)].decode()
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+
+        resp = self.client.get("/static/stylesheets/style.css?v=stale")
+        self.assertNotIn('immutable', resp.headers['Cache-Control'])
@@ -0,0 +1,147 @@
+"""Instrumentation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_instrumentation.py
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+from unittest import TestCase
+
+from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows
+from instrumentation import RequestStats, metrics, statement_shape
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class StatementShapeTestCase(TestCase):
+    """Test grouping statements by shape."""
+
+    def test_parameters(self):
+        self.assertEqual(
+            statement_shape("SELECT * FROM users\n WHERE users.id = %(param_1)s"),
+            "SELECT * FROM users WHERE users.id = ?")
+
+    def test_in_lists(self):
+        self.assertEqual(
+            statement_shape("SELECT 1 WHERE id IN (%(id_1)s, %(id_2)s)"),
+            statement_shape("SELECT 1 WHERE id IN (%(id_1)s)"))
+
+    def test_literals(self):
+        self.assertEqual(statement_shape("SELECT 'a' LIMIT 10"),
+                         "SELECT ? LIMIT ?")
+
+    def test_repeated(self):
+        stats = RequestStats()
+        for i in range(4):
+            stats.record(f"SELECT * FROM users WHERE id = {i}", 0.001)
+        stats.record("SELECT * FROM messages", 0.002)
+
+        self.assertEqual(stats.repeated(3),
+                         {"SELECT * FROM users WHERE id = ?": 4})
+        self.assertEqual(stats.slowest(1),
+                         [("SELECT * FROM messages", 0.002)])
+
+
+class InstrumentationTestCase(TestCase):
+    """Test the request hooks and metrics endpoint."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        user = User.signup("measured", "measured@test.com", "password", "")
+        db.session.commit()
+        self.user_id = user.id
+
+        metrics.clear()
+        app.config['METRICS_ENABLED'] = True
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['N_PLUS_ONE_THRESHOLD'] = 10
+        app.config['INTERNAL_METRICS_TOKEN'] = None
+        app.config['METRICS_ENABLED'] = False
+
+    def test_server_timing(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            resp = c.get(f"/users/{self.user_id}")
+
+        timing = resp.headers['Server-Timing']
+        self.assertIn("db;dur=", timing)
+        self.assertIn("render;dur=", timing)
+        self.assertIn("total;dur=", timing)
+
+    def test_metrics(self):
+        self.client.get(f"/users/{self.user_id}")
+        self.client.get(f"/users/{self.user_id}")
+
+        resp = self.client.get("/_internal/metrics")
+        self.assertEqual(resp.status_code, 200)
+
+        users_show = resp.json['endpoints']['users_show']
+        self.assertEqual(users_show['requests'], 2)
+        self.assertGreater(users_show['mean_queries'], 0)
+        self.assertTrue(users_show['slowest_statements'])
+        self.assertIn('pending', resp.json['password_hasher'])
+
+    def test_metrics_token(self):
+        app.config['INTERNAL_METRICS_TOKEN'] = "sekrit"
+
+        self.assertEqual(self.client.get("/_internal/metrics").status_code, 404)
+        resp = self.client.get("/_internal/metrics",
+                               headers={'Authorization': "Bearer wrong"})
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get("/_internal/metrics",
+                               headers={'Authorization': "Bearer sekrit"})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_metrics_disabled(self):
+        app.config['METRICS_ENABLED'] = False
+
+        # Loopback is no credential: a local proxy forwards everyone.
+        resp = self.client.get("/_internal/metrics",
+                               environ_base={'REMOTE_ADDR': '127.0.0.1'})
+        self.assertEqual(resp.status_code, 404)
+
+    def test_failed_statement(self):
+        connection = db.session.connection()
+        for i in range(3):
+            with self.assertRaises(ProgrammingError):
+                with connection.begin_nested():
+                    connection.execute(text("SELECT * FROM no_such_table"))
+
+        self.assertEqual(connection.info.get('query_start'), [])
+
+    def test_n_plus_one_logged(self):
+        app.config['N_PLUS_ONE_THRESHOLD'] = 0
+
+        with self.assertLogs(app.logger, level='WARNING') as logs:
+            self.client.get(f"/users/{self.user_id}")
+
+        self.assertTrue(any("Possible N+1" in line for line in logs.output))
+        resp = self.client.get("/_internal/metrics")
+        self.assertEqual(
+            resp.json['endpoints']['users_show']['n_plus_one_requests'], 1)
@@ -0,0 +1,123 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loader.py
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+import csv
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine, func, inspect, select
+
+from app import app
+from models import db, User, Message, Follows, Liked_Message, TimelineEntry
+import loader
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+PASSWORD = "$2b$04$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe"
+
+
+def write_csvs(directory):
+    def write(filename, rows):
+        with open(os.path.join(directory, filename), 'w', newline='') as f:
+            csv.writer(f).writerows(rows)
+
+    write('users.csv', [
+        ['id', 'email', 'username', 'image_url', 'password', 'bio',
+         'header_image_url', 'location'],
+        [10, 'a@test.com', 'alice', '', PASSWORD, 'Hi, "quoted"\nbio', '', ''],
+        [20, 'b@test.com', 'bob', '', PASSWORD, '', '', 'Nowhere'],
+    ])
+    write('messages.csv', [
+        ['text', 'timestamp', 'user_id'],
+        ['first', '2017-01-21 11:04:53.522807', 10],
+        ['second', '2017-02-21 11:04:53', 10],
+        ['third', '2017-03-21 11:04:53', 20],
+    ])
+    write('follows.csv', [
+        ['user_being_followed_id', 'user_following_id'],
+        [10, 20],
+    ])
+
+
+class LoaderTestCase(TestCase):
+    """Test seeding from CSV files."""
+
+    def setUp(self):
+        db.session.rollback()
+        self.directory = tempfile.TemporaryDirectory()
+        write_csvs(self.directory.name)
+
+    def tearDown(self):
+        db.session.rollback()
+        self.directory.cleanup()
+
+        # Leave empty tables behind for the other test modules.
+        TimelineEntry.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_seed(self):
+        output = []
+        with app.app_context():
+            loaded = loader.seed(self.directory.name, chunk_size=2,
+                                 echo=output.append)
+
+        self.assertEqual(loaded, {'users': 2, 'messages': 3, 'follows': 1})
+        self.assertTrue(any("rows/s" in line for line in output))
+
+        alice = User.query.get(10)
+        self.assertEqual(alice.bio, 'Hi, "quoted"\nbio')
+        self.assertEqual(alice.messages_count, 2)
+        self.assertEqual(alice.followers_count, 1)
+        self.assertIsNone(User.query.get(20).bio)
+
+        bob_timeline = TimelineEntry.query.filter_by(owner_id=20).count()
+        self.assertEqual(bob_timeline, 2)
+
+        # Indexes and foreign keys are back, and new ids follow the loaded ones.
+        inspector = inspect(db.engine)
+        self.assertIn('ix_messages_user_id_timestamp_id',
+                      [index['name']
+                       for index in inspector.get_indexes('messages')])
+        self.assertTrue(inspector.get_foreign_keys('messages'))
+
+        user = User.signup("carol", "c@test.com", "password", "")
+        db.session.commit()
+        self.assertGreater(user.id, 20)
+
+    def test_sqlite(self):
+        engine = create_engine('sqlite://')
+        db.metadata.create_all(engine)
+
+        with engine.begin() as connection:
+            drops, creates = loader.deferred_ddl(connection, Message.__table__)
+            self.assertEqual(len(drops), 1)
+
+            for table, filename in loader.FILES[:3]:
+                loader.load_table(connection, table,
+                                  os.path.join(self.directory.name, filename),
+                                  echo=lambda line: None)
+
+            count = connection.execute(
+                select([func.count()]).select_from(Message.__table__)).scalar()
+            self.assertEqual(count, 3)
+            self.assertIsNone(connection.execute(
+                "SELECT bio FROM users WHERE id = 20").scalar())
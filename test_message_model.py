@@ -15,8 +15,9 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 from app import app
 from unittest import TestCase
+from sqlalchemy import create_engine
 from sqlalchemy.exc import IntegrityError
-from models import db, Message, User, Follows
+from models import db, Message, User, Follows, Liked_Message
 
 
 # Create our tables (we do this here, so we only create the tables
@@ -67,3 +68,58 @@ class MessageModelTestCase(TestCase):
         msg1 = Message(text="Hi there", user_id=user2.id)
 
         self.assertEqual(msg1.text, "Hi there")
+
+    def test_liked_message_ids(self):
+        """Does the batch liked lookup return only this user's likes?"""
+
+        user1 = User.query.filter(User.username=="testuser").first()
+        user2 = User.query.filter(User.username=="testuser2").first()
+
+        msgs = [Message(text=f"warble {i}", user_id=user2.id) for i in range(3)]
+        db.session.add_all(msgs)
+        db.session.commit()
+
+        db.session.add(Liked_Message(liker_id=user1.id, liked_msg_id=msgs[0].id))
+        db.session.add(Liked_Message(liker_id=user2.id, liked_msg_id=msgs[1].id))
+        db.session.commit()
+
+        ids = [msg.id for msg in msgs]
+        self.assertEqual(user1.liked_message_ids(ids), {msgs[0].id})
+        self.assertEqual(user2.liked_message_ids(ids), {msgs[1].id})
+        self.assertEqual(user1.liked_message_ids([]), set())
+
+    def test_toggle_like(self):
+        """Does toggling a like keep the row and both counters in step?"""
+
+        user1 = User.query.filter(User.username=="testuser").first()
+        user2 = User.query.filter(User.username=="testuser2").first()
+        msg = Message(text="toggled", user_id=user2.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.assertEqual(Liked_Message.toggle(user1.id, msg.id), (True, 1))
+        self.assertEqual(Liked_Message.toggle(user2.id, msg.id), (True, 2))
+        self.assertEqual(Liked_Message.toggle(user1.id, msg.id), (False, 1))
+        db.session.commit()
+
+        self.assertEqual(User.query.get(user1.id).likes_count, 0)
+        self.assertEqual(User.query.get(user2.id).likes_count, 1)
+        self.assertIsNone(Liked_Message.toggle(user1.id, msg.id + 1))
+
+    def test_toggle_like_sqlite(self):
+        """Does the SQLite version of the toggle match?"""
+
+        engine = create_engine("sqlite://")
+        db.metadata.create_all(engine)
+
+        with engine.begin() as connection:
+            connection.execute(User.__table__.insert().values(
+                id=1, username="u", email="u@test.com", password="-"))
+            connection.execute(Message.__table__.insert().values(
+                id=1, text="m", user_id=1))
+
+            self.assertEqual(Liked_Message.toggle(1, 1, connection), (True, 1))
+            self.assertEqual(Liked_Message.toggle(1, 1, connection), (False, 0))
+            self.assertIsNone(Liked_Message.toggle(1, 2, connection))
+            self.assertEqual(connection.execute(
+                "SELECT likes_count, version FROM users").first(), (0, 2))
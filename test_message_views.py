@@ -13,7 +13,8 @@ import os
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 from unittest import TestCase
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Liked_Message
+from sqlalchemy import event
 from sqlalchemy.orm.exc import NoResultFound
 
 
@@ -143,3 +144,157 @@ class MessageViewTestCase(TestCase):
     #         self.assertIn('<div class="alert alert-danger">Access unauthorized.</div>', str(response.data))
     #         self.assertEqual(not_deleted_message.text, '1238841092419')
     #         self.assertEqual(num_messages_after - num_messages_before, 0)
+
+    def test_message_counters(self):
+        user_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.post("/messages/new", data={"text": "counted"})
+            msg_id = Message.query.filter(Message.text == "counted").one().id
+            c.post("/like", data={"message_id": msg_id},
+                   headers={"Referer": "/"})
+
+            user = User.query.get(user_id)
+            self.assertEqual(user.messages_count, 1)
+            self.assertEqual(user.likes_count, 1)
+            self.assertEqual(Message.query.get(msg_id).likes_count, 1)
+
+            c.post(f"/messages/{msg_id}/delete")
+            user = User.query.get(user_id)
+            self.assertEqual(user.messages_count, 0)
+            self.assertEqual(user.likes_count, 0)
+
+    def test_liked_star(self):
+        user_id = self.testuser.id
+        author_id = self.testuser2.id
+        message_id = self.testmessage_id
+
+        db.session.add(Liked_Message(liker_id=user_id, liked_msg_id=message_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = c.get(f"/users/{user_id}/likes")
+            self.assertIn('fas fa-star', str(resp.data))
+            self.assertNotIn('far fa-star', str(resp.data))
+
+            resp = c.get(f"/users/{author_id}")
+            self.assertIn('fas fa-star', str(resp.data))
+
+
+class MessageListQueryCountTestCase(TestCase):
+    """Message lists should cost the same number of statements per page."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+
+        self.client = app.test_client()
+
+        reader = User.signup(username="reader",
+                             email="reader@test.com",
+                             password="testuser",
+                             image_url=None)
+        db.session.commit()
+        self.reader_id = reader.id
+
+    def _add_authors(self, count, start=0):
+        """Add `count` authors, each followed and liked by the reader."""
+
+        for i in range(start, start + count):
+            author = User.signup(username=f"author{i}",
+                                 email=f"author{i}@test.com",
+                                 password="testuser",
+                                 image_url=None)
+            db.session.commit()
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = author.id
+                c.post("/messages/new", data={"text": f"warble {i}"})
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.reader_id
+                c.post(f"/users/follow/{author.id}")
+                msg = Message.query.filter(Message.text == f"warble {i}").one()
+                c.post("/like", data={"message_id": msg.id},
+                       headers={"Referer": "/"})
+
+    def _count_statements(self, url):
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.reader_id
+                resp = c.get(url)
+                self.assertEqual(resp.status_code, 200)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+
+        return len(statements)
+
+    def test_statement_count_independent_of_page_size(self):
+        urls = ["/", f"/users/{self.reader_id}/likes"]
+
+        self._add_authors(2)
+        small = [self._count_statements(url) for url in urls]
+
+        self._add_authors(6, start=2)
+        large = [self._count_statements(url) for url in urls]
+
+        self.assertEqual(small, large)
+
+
+class LikeJsonTestCase(TestCase):
+    """Test liking messages through the JSON endpoint."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+
+        user = User.signup(username="liker", email="liker@test.com",
+                           password="testuser", image_url=None)
+        db.session.commit()
+        msg = Message(user_id=user.id, text="likeable")
+        db.session.add(msg)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.msg_id = msg.id
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_toggle(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.post(f"/messages/{self.msg_id}/like")
+            self.assertEqual(resp.json, {"message_id": self.msg_id,
+                                         "liked": True, "likes_count": 1})
+
+            resp = c.post(f"/messages/{self.msg_id}/like")
+            self.assertEqual(resp.json["liked"], False)
+            self.assertEqual(resp.json["likes_count"], 0)
+            self.assertEqual(Liked_Message.query.count(), 0)
+
+            resp = c.post(f"/messages/{self.msg_id + 1}/like")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_logged_out(self):
+        resp = self.client.post(f"/messages/{self.msg_id}/like")
+        self.assertEqual(resp.status_code, 401)
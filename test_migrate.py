@@ -0,0 +1,197 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrate.py
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine, inspect, text
+
+from app import app
+from models import db
+import migrate
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# The schema before the migration series, with a little data.
+BASELINE = [
+    """CREATE TABLE users (
+           id INTEGER PRIMARY KEY,
+           email TEXT NOT NULL UNIQUE,
+           username TEXT NOT NULL UNIQUE,
+           image_url TEXT,
+           header_image_url TEXT,
+           bio TEXT,
+           location TEXT,
+           password TEXT NOT NULL
+       )""",
+    """CREATE TABLE messages (
+           id INTEGER PRIMARY KEY,
+           text VARCHAR(140) NOT NULL,
+           timestamp DATETIME NOT NULL,
+           user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE
+       )""",
+    """CREATE TABLE follows (
+           user_being_followed_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+           user_following_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+           PRIMARY KEY (user_being_followed_id, user_following_id)
+       )""",
+    """CREATE TABLE liked_messages (
+           liker_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+           liked_msg_id INTEGER REFERENCES messages (id) ON DELETE CASCADE,
+           PRIMARY KEY (liker_id, liked_msg_id)
+       )""",
+    """INSERT INTO users (id, email, username, password)
+       VALUES (1, 'a@test.com', 'a', '-'), (2, 'b@test.com', 'b', '-')""",
+    """INSERT INTO messages (id, text, timestamp, user_id)
+       VALUES (1, 'one', '2020-01-01 00:00:00', 1),
+              (2, 'two', '2020-01-02 00:00:00', 1)""",
+    "INSERT INTO follows VALUES (1, 2)",
+    "INSERT INTO liked_messages VALUES (2, 1)",
+]
+
+REVERSE_INDEXES = {'follows': 'ix_follows_user_following_id_user_being_followed_id',
+                   'liked_messages': 'ix_liked_messages_liked_msg_id_liker_id'}
+
+
+def index_names(engine, table):
+    return {index['name'] for index in inspect(engine).get_indexes(table)}
+
+
+class MigrateTestCase(TestCase):
+    """Test applying migrations to an older database."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = create_engine(
+            f"sqlite:///{self.directory.name}/old.db")
+
+        # A database from before the reverse indexes.
+        db.metadata.create_all(self.engine)
+        for name in REVERSE_INDEXES.values():
+            self.engine.execute(f"DROP INDEX {name}")
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def test_discover(self):
+        migrations = migrate.discover()
+        versions = [migration.version for migration in migrations]
+
+        self.assertEqual(versions, sorted(set(versions)))
+        self.assertEqual(migrations[0].name, '0001_reverse_indexes')
+        self.assertFalse(migrations[0].transactional)
+
+    def test_upgrade(self):
+        applied = migrate.upgrade(self.engine, echo=lambda line: None)
+
+        self.assertEqual([m.name for m in applied],
+                         [m.name for m in migrate.discover()])
+        for table, name in REVERSE_INDEXES.items():
+            self.assertIn(name, index_names(self.engine, table))
+
+        self.assertEqual(migrate.upgrade(self.engine, echo=print), [])
+
+    def test_baseline(self):
+        """A database from before the series ends up matching the models."""
+
+        self.engine.dispose()
+        os.remove(f"{self.directory.name}/old.db")
+        for statement in BASELINE:
+            self.engine.execute(statement)
+
+        migrate.upgrade(self.engine, echo=lambda line: None)
+
+        inspector = inspect(self.engine)
+        for table in db.metadata.sorted_tables:
+            columns = {info['name'] for info in inspector.get_columns(table.name)}
+            self.assertLessEqual(set(table.columns.keys()), columns, table.name)
+            self.assertLessEqual({index.name for index in table.indexes},
+                                 index_names(self.engine, table.name),
+                                 table.name)
+
+        self.assertEqual(
+            self.engine.execute(
+                "SELECT id, messages_count, followers_count, following_count, "
+                "likes_count, version FROM users ORDER BY id").fetchall(),
+            [(1, 2, 1, 0, 0, 0), (2, 0, 0, 1, 1, 0)])
+        self.assertEqual(
+            self.engine.execute(
+                "SELECT id, likes_count FROM messages ORDER BY id").fetchall(),
+            [(1, 1), (2, 0)])
+        self.assertEqual(
+            self.engine.execute(
+                "SELECT owner_id, message_id, author_id FROM timeline_entries "
+                "ORDER BY message_id").fetchall(),
+            [(2, 1, 1), (2, 2, 1)])
+
+    def test_stamp(self):
+        migrate.stamp(self.engine)
+
+        self.assertEqual(migrate.applied(self.engine),
+                         {m.version for m in migrate.discover()})
+        self.assertEqual(migrate.upgrade(self.engine, echo=print), [])
+
+    def test_postgres(self):
+        """Concurrent index builds run outside a transaction, and re-run."""
+
+        engine = db.engine
+        with engine.begin() as connection:
+            migrate.metadata.create_all(connection)
+            connection.execute(migrate.schema_migrations.delete())
+
+        try:
+            applied = migrate.upgrade(engine, echo=lambda line: None)
+            self.assertEqual(len(applied), len(migrate.discover()))
+            for table, name in REVERSE_INDEXES.items():
+                self.assertIn(name, index_names(engine, table))
+        finally:
+            with engine.begin() as connection:
+                connection.execute(migrate.schema_migrations.delete())
+
+    def test_invalid_index_rebuilt(self):
+        """An index left INVALID by a failed concurrent build is rebuilt."""
+
+        engine = db.engine
+        with engine.connect() as connection:
+            connection = connection.execution_options(
+                isolation_level='AUTOCOMMIT')
+            connection.execute("DROP TABLE IF EXISTS migrate_scratch")
+            connection.execute("CREATE TABLE migrate_scratch (x integer)")
+            try:
+                connection.execute("INSERT INTO migrate_scratch VALUES (1), (1)")
+                with self.assertRaises(Exception):
+                    connection.execute("CREATE UNIQUE INDEX CONCURRENTLY "
+                                       "ix_migrate_scratch ON migrate_scratch (x)")
+
+                valid = text("SELECT indisvalid FROM pg_index "
+                             "WHERE indexrelid = 'ix_migrate_scratch'::regclass")
+                self.assertFalse(connection.execute(valid).scalar())
+
+                migrate.create_index(connection, 'ix_migrate_scratch',
+                                     'migrate_scratch', '(x)')
+                self.assertTrue(connection.execute(valid).scalar())
+            finally:
+                connection.execute("DROP TABLE migrate_scratch")
+
+    def test_cli(self):
+        migrate.stamp(db.engine)
+        result = app.test_cli_runner().invoke(args=['migrate'])
+
+        self.assertIn("Applied 0 migrations.", result.output)
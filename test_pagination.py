@@ -0,0 +1,167 @@
+"""Cursor pagination tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pagination.py
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from datetime import datetime, timedelta
+from unittest import TestCase
+from models import db, User, Message, Follows
+from pagination import InvalidCursor, decode_cursor, encode_cursor
+import timeline
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class CursorTestCase(TestCase):
+    """Test cursor tokens."""
+
+    def test_round_trip(self):
+        when = datetime(2019, 5, 1, 12, 30, 15, 123456)
+        token = encode_cursor([when, 42])
+
+        self.assertNotIn("2019", token)
+        self.assertEqual(decode_cursor(token, [Message.timestamp, Message.id]),
+                         [when, 42])
+
+    def test_invalid(self):
+        with self.assertRaises(InvalidCursor):
+            decode_cursor("not-a-cursor", [Message.timestamp, Message.id])
+
+        with self.assertRaises(InvalidCursor):
+            decode_cursor(encode_cursor([1]), [Message.timestamp, Message.id])
+
+    def test_wrong_types(self):
+        columns = [Message.timestamp, Message.id]
+        when = datetime(2019, 5, 1).isoformat()
+
+        for values in ([1, 42], [when, "42"], [when, 4.2], [when, True],
+                       [when, None], [when, 2 ** 31], [when, [42]]):
+            with self.subTest(values=values):
+                with self.assertRaises(InvalidCursor):
+                    decode_cursor(encode_cursor(values), columns)
+
+        with self.assertRaises(InvalidCursor):
+            decode_cursor(encode_cursor([7]), [User.username])
+        with self.assertRaises(InvalidCursor):
+            decode_cursor(encode_cursor(["a\x00b"]), [User.username])
+        self.assertEqual(decode_cursor(encode_cursor(["bob"]), [User.username]),
+                         ["bob"])
+
+
+class PaginationViewTestCase(TestCase):
+    """Test paged feeds and listings."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        timeline.reset_celebrity_cache()
+
+        app.config['PAGE_SIZE'] = 2
+
+        reader = User.signup("reader", "reader@test.com", "password", "")
+        author = User.signup("author", "author@test.com", "password", "")
+        db.session.commit()
+
+        self.reader_id = reader.id
+        self.author_id = author.id
+
+        # Two messages share a timestamp, so paging has to break the tie.
+        start = datetime(2019, 1, 1)
+        stamps = [start, start + timedelta(days=1), start + timedelta(days=1),
+                  start + timedelta(days=2), start + timedelta(days=3)]
+        for i, stamp in enumerate(stamps):
+            db.session.add(Message(text=f"warble-{i}",
+                                   timestamp=stamp,
+                                   user_id=self.author_id))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Clean up added sample data"""
+        db.session.rollback()
+        app.config['PAGE_SIZE'] = 100
+
+    def _walk(self, client, url):
+        """Follow 'More' links from `url`; return the warbles on each page."""
+
+        pages = []
+        while url:
+            resp = client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            html = resp.data.decode()
+            pages.append([f"warble-{i}" for i in range(5)
+                          if f"warble-{i}<" in html])
+
+            url = None
+            if 'id="next-page"' in html:
+                href = html.split('id="next-page"')[0].rsplit('href="', 1)[1]
+                url = href.split('"')[0].replace("&amp;", "&")
+
+        return pages
+
+    def test_profile_feed(self):
+        with self.client as c:
+            pages = self._walk(c, f"/users/{self.author_id}")
+
+        self.assertEqual(pages, [["warble-3", "warble-4"],
+                                 ["warble-1", "warble-2"],
+                                 ["warble-0"]])
+
+    def test_home_feed(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader_id
+
+            c.post(f"/users/follow/{self.author_id}")
+            pages = self._walk(c, "/")
+
+        self.assertEqual(sum(len(page) for page in pages), 5)
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(pages[0], ["warble-3", "warble-4"])
+
+    def test_users_listing(self):
+        with self.client as c:
+            resp = c.get("/users")
+            html = resp.data.decode()
+
+            self.assertIn("@author", html)
+            self.assertIn("@reader", html)
+            self.assertNotIn('id="next-page"', html)
+
+    def test_bad_cursor(self):
+        with self.client as c:
+            resp = c.get(f"/users/{self.author_id}?cursor=garbage")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_mistyped_cursor(self):
+        # Well-formed, but the id is a string: a 400, not a DataError.
+        cursor = encode_cursor([datetime(2019, 5, 1).isoformat(), "1; --"])
+        with self.client as c:
+            resp = c.get(f"/users/{self.author_id}?cursor={cursor}")
+            self.assertEqual(resp.status_code, 400)
+
+            resp = c.get(f"/api/v1/users/{self.author_id}/messages"
+                         f"?cursor={cursor}")
+            self.assertEqual(resp.status_code, 400)
@@ -0,0 +1,187 @@
+"""Password hasher tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_passwords.py
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+import importlib.util
+import threading
+import time
+from unittest import TestCase, mock, skipUnless
+
+from app import app
+import green
+from models import db, User, Message, Follows
+from passwords import (PasswordHasher, PasswordHasherBusy, hash_rounds,
+                       init_app, password_hasher)
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class PasswordHasherTestCase(TestCase):
+    """Test hashing inline and in the process pool."""
+
+    def test_inline(self):
+        hasher = PasswordHasher(workers=0, rounds=4)
+        hashed = hasher.hash("secret")
+
+        self.assertEqual(hash_rounds(hashed), 4)
+        self.assertTrue(hasher.verify(hashed, "secret"))
+        self.assertFalse(hasher.verify(hashed, "wrong"))
+        self.assertFalse(hasher.verify("not a hash", "secret"))
+
+    @skipUnless(importlib.util.find_spec('gevent'), "needs gevent")
+    def test_inline_under_gevent(self):
+        # With gevent running, inline hashes move to its thread pool.
+        hasher = PasswordHasher(workers=0, rounds=4)
+        threads = []
+
+        def where(*args):
+            threads.append(threading.get_ident())
+            return True
+
+        with mock.patch.object(green, 'is_patched', return_value=True):
+            self.assertTrue(hasher._run(where))
+
+        self.assertNotEqual(threads, [threading.get_ident()])
+
+    def test_pool(self):
+        hasher = PasswordHasher(workers=1, rounds=4)
+        hashed = hasher.hash("secret")
+
+        self.assertTrue(hasher.verify(hashed, "secret"))
+        self.assertIsNotNone(hasher.executor)
+
+        stats = hasher.stats()
+        self.assertEqual(stats['completed'], 2)
+        self.assertEqual(stats['pending'], 0)
+        self.assertIn('p95', stats['latency_ms'])
+
+    def test_needs_rehash(self):
+        hasher = PasswordHasher(rounds=4)
+        hashed = hasher.hash("secret")
+
+        self.assertFalse(hasher.needs_rehash(hashed))
+        hasher.configure(rounds=5)
+        self.assertTrue(hasher.needs_rehash(hashed))
+
+    def test_busy(self):
+        hasher = PasswordHasher(rounds=4, max_pending=1)
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow(*args):
+            started.set()
+            release.wait()
+
+        thread = threading.Thread(target=hasher._run, args=(slow,))
+        thread.start()
+        started.wait()
+        try:
+            with self.assertRaises(PasswordHasherBusy):
+                hasher.hash("secret")
+        finally:
+            release.set()
+            thread.join()
+
+        self.assertEqual(hasher.stats()['rejected'], 1)
+        self.assertEqual(hasher.stats()['max_pending_seen'], 1)
+
+
+    def test_timeout(self):
+        hasher = PasswordHasher(workers=1, rounds=4, timeout=0.01)
+        try:
+            with self.assertRaises(PasswordHasherBusy):
+                hasher._run(time.sleep, 1)
+        finally:
+            hasher.executor.shutdown()
+
+        self.assertEqual(hasher.stats()['timed_out'], 1)
+        self.assertEqual(hasher.stats()['pending'], 0)
+
+    def test_broken_pool(self):
+        hasher = PasswordHasher(workers=1, rounds=4)
+        with self.assertRaises(PasswordHasherBusy):
+            hasher._run(os._exit, 1)
+
+        self.assertEqual(hasher.stats()['pool_failures'], 1)
+        self.assertIsNone(hasher.executor)
+
+        # The next hash gets a new pool.
+        self.assertTrue(hasher.verify(hasher.hash("secret"), "secret"))
+
+
+class RehashTestCase(TestCase):
+    """Test upgrading hashes when the cost factor changes."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.rounds = app.config['BCRYPT_LOG_ROUNDS']
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        init_app(app)
+
+        User.signup("hasher", "hasher@test.com", "password", "")
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['BCRYPT_LOG_ROUNDS'] = self.rounds
+        init_app(app)
+
+    def test_rehash_on_login(self):
+        app.config['BCRYPT_LOG_ROUNDS'] = 5
+        init_app(app)
+
+        resp = self.client.post("/login", data={"username": "hasher",
+                                                "password": "password"})
+        self.assertEqual(resp.status_code, 302)
+
+        user = User.query.filter_by(username="hasher").one()
+        self.assertEqual(hash_rounds(user.password), 5)
+        self.assertTrue(User.authenticate("hasher", "password"))
+
+    def test_no_rehash_on_bad_password(self):
+        app.config['BCRYPT_LOG_ROUNDS'] = 5
+        init_app(app)
+
+        self.assertFalse(User.authenticate("hasher", "wrong"))
+        user = User.query.filter_by(username="hasher").one()
+        self.assertEqual(hash_rounds(user.password), 4)
+
+    def test_broken_pool_login(self):
+        password_hasher.configure(workers=1, rounds=4)
+        # Kill the pool's worker process.
+        password_hasher._pool().submit(os._exit, 1)
+        time.sleep(0.5)
+
+        resp = self.client.post("/login", data={"username": "hasher",
+                                                "password": "password"})
+        self.assertEqual(resp.status_code, 503)
+
+    def test_busy_login(self):
+        password_hasher.configure(rounds=4, max_pending=0, timeout=0)
+
+        resp = self.client.post("/login", data={"username": "hasher",
+                                                "password": "password"})
+        self.assertEqual(resp.status_code, 503)
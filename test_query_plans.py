@@ -0,0 +1,221 @@
+"""Query plan tests.
+
+Seeds a few thousand users' worth of follows, messages and likes, then
+requests the hot pages and EXPLAINs every SELECT they ran. None may
+read a large table with a sequential scan.
+"""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+import json
+from unittest import TestCase
+
+from sqlalchemy import event, text
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows, Liked_Message, TimelineEntry
+import loader
+import timeline
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+USERS = 2000
+FOLLOWS_PER_USER = 8
+MESSAGES = 10000
+LIKES = 40000
+
+VIEWER_ID = 1
+USER_ID = 5
+
+LARGE_TABLES = {'users', 'messages', 'follows', 'liked_messages',
+                'timeline_entries'}
+
+SEED = [
+    f"""INSERT INTO users (id, email, username, image_url, header_image_url,
+                           password)
+        SELECT g, 'user' || g || '@test.com', 'user' || g, '', '', '-'
+        FROM generate_series(1, {USERS}) g""",
+    # Distinct offsets, none a multiple of USERS: no duplicates or
+    # self-follows.
+    f"""INSERT INTO follows (user_being_followed_id, user_following_id)
+        SELECT (g + k * k * 37) % {USERS} + 1, g + 1
+        FROM generate_series(0, {USERS - 1}) g,
+             generate_series(1, {FOLLOWS_PER_USER}) k""",
+    f"""INSERT INTO messages (id, text, timestamp, user_id)
+        SELECT g, 'warble ' || g, now() - g * interval '1 minute',
+               g % {USERS} + 1
+        FROM generate_series(1, {MESSAGES}) g""",
+    f"""INSERT INTO liked_messages (liker_id, liked_msg_id)
+        SELECT g % {USERS} + 1, g * 13 % {MESSAGES} + 1
+        FROM generate_series(1, {LIKES}) g
+        ON CONFLICT DO NOTHING""",
+]
+
+
+def plan_nodes(plan):
+    """Every node of an EXPLAIN (FORMAT JSON) plan."""
+
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+class QueryPlanTestCase(TestCase):
+    """Test that the hot pages' queries use indexes."""
+
+    @classmethod
+    def setUpClass(cls):
+        db.session.rollback()
+        cls.clear()
+
+        for statement in SEED:
+            db.session.execute(text(statement))
+        loader.reset_sequences(db.session.connection(),
+                               [User.__table__, Message.__table__])
+        with app.app_context():
+            User.recount()
+            timeline.rebuild()
+            db.session.commit()
+
+        with db.engine.connect() as connection:
+            connection.execution_options(
+                isolation_level='AUTOCOMMIT').execute("VACUUM ANALYZE")
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.rollback()
+        cls.clear()
+        app.extensions.pop('fragment_cache', None)
+        app.extensions.pop('user_cache', None)
+
+    @classmethod
+    def clear(cls):
+        for model in (TimelineEntry, Liked_Message, Follows, Message, User):
+            model.query.delete()
+        db.session.commit()
+
+    def statements(self, url):
+        """The SELECTs run while serving `url` to a logged-in user."""
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append((statement, parameters))
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            with app.test_client() as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = VIEWER_ID
+                resp = c.get(url)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+
+        self.assertEqual(resp.status_code, 200)
+        return statements
+
+    def assertIndexed(self, url):
+        statements = self.statements(url)
+        self.assertTrue(statements)
+
+        with db.engine.connect() as connection:
+            for statement, parameters in statements:
+                [(plan,)] = connection.execute(
+                    "EXPLAIN (FORMAT JSON) " + statement, parameters)
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+
+                for node in plan_nodes(plan[0]['Plan']):
+                    if node.get('Relation Name') in LARGE_TABLES:
+                        self.assertNotEqual(
+                            node['Node Type'], 'Seq Scan',
+                            f"{url} scans {node['Relation Name']}:\n"
+                            f"{statement}")
+
+    def test_home(self):
+        self.assertIndexed("/")
+
+    def test_users_index(self):
+        self.assertIndexed("/users")
+
+    def test_users_show(self):
+        self.assertIndexed(f"/users/{USER_ID}")
+
+    def test_followers(self):
+        self.assertIndexed(f"/users/{USER_ID}/followers")
+
+    def test_following(self):
+        self.assertIndexed(f"/users/{USER_ID}/following")
+
+    def test_likes(self):
+        self.assertIndexed(f"/users/{USER_ID}/likes")
+
+    def test_messages_show(self):
+        self.assertIndexed(f"/messages/{USER_ID}")
+
+    def test_likers(self):
+        # messages_destroy takes a deleted message's likes out of its
+        # likers' counters.
+        likers = (db.session
+                  .query(Liked_Message.liker_id)
+                  .filter(Liked_Message.liked_msg_id == USER_ID))
+        sql = str(likers.statement.compile(
+            db.engine, compile_kwargs={'literal_binds': True}))
+
+        [(plan,)] = db.session.execute("EXPLAIN (FORMAT JSON) " + sql)
+        nodes = list(plan_nodes(plan[0]['Plan']))
+        self.assertIn('ix_liked_messages_liked_msg_id_liker_id',
+                      [node.get('Index Name') for node in nodes])
+
+    def explain_search(self, query):
+        """EXPLAIN ANALYZE the message search's ranking query."""
+
+        [(statement, parameters)] = [
+            (statement, parameters) for statement, parameters
+            in self.statements(f"/messages/search?q={query}")
+            if 'ts_rank' in statement]
+
+        with db.engine.connect() as connection:
+            [(plan,)] = connection.execute(
+                "EXPLAIN (ANALYZE, FORMAT JSON) " + statement, parameters)
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        return list(plan_nodes(plan[0]['Plan']))
+
+    def test_search_ranks_bounded(self):
+        # 'warble' is in every message: only the newest candidates are
+        # ranked.
+        app.config['SEARCH_MAX_CANDIDATES'] = 500
+        try:
+            nodes = self.explain_search("warble")
+        finally:
+            app.config['SEARCH_MAX_CANDIDATES'] = 5000
+
+        ranked = [node for node in nodes
+                  if 'ts_rank' in ' '.join(node.get('Sort Key', []))]
+        self.assertTrue(ranked)
+        for node in ranked:
+            self.assertLessEqual(node['Actual Rows'], 500)
+
+    def test_search_indexed(self):
+        nodes = self.explain_search("warble 1234")
+
+        self.assertIn('ix_messages_text_fts',
+                      [node.get('Index Name') for node in nodes])
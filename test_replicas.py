@@ -0,0 +1,165 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import text
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows
+import replicas
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class IsWriteTestCase(TestCase):
+    """Test telling reads from writes."""
+
+    def test_statements(self):
+        self.assertFalse(replicas.is_write(User.__table__.select()))
+        self.assertTrue(replicas.is_write(User.__table__.update()))
+        self.assertTrue(replicas.is_write(User.__table__.delete()))
+        self.assertFalse(replicas.is_write(text(" select 1")))
+        self.assertTrue(replicas.is_write(text("UPDATE users SET bio = ''")))
+        self.assertFalse(replicas.is_write(None))
+
+
+class ReplicaRouterTestCase(TestCase):
+    """Test choosing a replica."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.urls = [f"sqlite:///{self.directory.name}/{name}.db"
+                     for name in ('one', 'two')]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_robin(self):
+        router = replicas.ReplicaRouter(self.urls)
+        with app.app_context():
+            chosen = [str(router.choose().url) for i in range(4)]
+        router.dispose()
+
+        self.assertEqual(chosen, self.urls * 2)
+
+    def test_least_loaded(self):
+        router = replicas.ReplicaRouter(self.urls, strategy='least_loaded')
+        busy, idle = router.replicas
+        busy.load = lambda: 3
+        idle.load = lambda: 1
+
+        with app.app_context():
+            self.assertIs(router.choose(), idle.engine)
+        router.dispose()
+
+    def test_unknown_strategy(self):
+        with self.assertRaises(ValueError):
+            replicas.ReplicaRouter(self.urls, strategy='random')
+
+    def test_unavailable(self):
+        router = replicas.ReplicaRouter(
+            ["sqlite:////nonexistent/replica.db"] + self.urls[:1])
+        with app.app_context():
+            chosen = {str(router.choose().url) for i in range(3)}
+            self.assertEqual(chosen, {self.urls[0]})
+
+            router.replicas[1].mark_down()
+            self.assertIsNone(router.choose())
+        router.dispose()
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Test routing requests between the primary and a replica.
+
+    The replica is a SQLite database holding different data from the
+    primary, so each response shows which database it was read from.
+    """
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        user = User.signup("primary", "test@test.com", "password", "")
+        db.session.commit()
+        self.user_id = user.id
+
+        self.directory = tempfile.TemporaryDirectory()
+        router = replicas.ReplicaRouter(
+            [f"sqlite:///{self.directory.name}/replica.db"])
+        self.replica = router.replicas[0].engine
+        db.metadata.create_all(self.replica)
+        with self.replica.begin() as connection:
+            connection.execute(User.__table__.insert().values(
+                id=self.user_id, username="replica", email="test@test.com",
+                password="-", image_url="/static/images/default-pic.png",
+                header_image_url="/static/images/warbler-hero.jpg"))
+
+        app.extensions['replica_router'] = router
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.extensions.pop('replica_router').dispose()
+        app.extensions.pop('user_cache', None)
+        app.extensions.pop('fragment_cache', None)
+        self.directory.cleanup()
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def test_reads_from_replica(self):
+        resp = self.client.get(f"/users/{self.user_id}")
+        self.assertIn("@replica", str(resp.data))
+
+    def test_write_pins_to_primary(self):
+        with self.client as c:
+            self.login(c)
+            resp = c.post("/messages/new", data={"text": "Hello"})
+            self.assertEqual(resp.status_code, 302)
+
+            resp = c.get(f"/users/{self.user_id}")
+            self.assertIn("@primary", str(resp.data))
+            self.assertIn("Hello", str(resp.data))
+
+    def test_pin_expires(self):
+        with self.client as c:
+            self.login(c)
+            c.post("/messages/new", data={"text": "Hello"})
+            with c.session_transaction() as sess:
+                sess[replicas.PIN_KEY] = 0
+
+            resp = c.get(f"/users/{self.user_id}")
+            self.assertIn("@replica", str(resp.data))
+
+    def test_outside_requests_use_primary(self):
+        with app.app_context():
+            self.assertEqual(User.query.get(self.user_id).username, "primary")
+
+    def test_replica_down(self):
+        app.extensions['replica_router'].replicas[0].mark_down()
+
+        resp = self.client.get(f"/users/{self.user_id}")
+        self.assertIn("@primary", str(resp.data))
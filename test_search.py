@@ -0,0 +1,317 @@
+"""Search tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from unittest import TestCase
+from models import db, User, Message, Follows
+import search
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TextHelpersTestCase(TestCase):
+    """Test the search text helpers."""
+
+    def test_match_rank(self):
+        self.assertEqual(search.match_rank("bird", "bird", None, None),
+                         search.EXACT)
+        self.assertEqual(search.match_rank("bird", "birdie", None, None),
+                         search.PREFIX)
+        self.assertEqual(search.match_rank("bird", "bigbird", None, None),
+                         search.USERNAME)
+        self.assertEqual(search.match_rank("bird", "sam", "I like birds", None),
+                         search.PROFILE)
+        self.assertEqual(search.match_rank("bird", "sam", None, "Birdsville"),
+                         search.PROFILE)
+        self.assertEqual(search.match_rank("bird", "sam", None, None), 0)
+
+
+class UserSearchTestCase(TestCase):
+    """Test ranked user search."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        search.user_index.clear()
+
+        self.client = app.test_client()
+
+        for username, bio, location, followers in [
+                ("bigbird", None, None, 1),
+                ("birdwatcher", None, None, 5),
+                ("bird", None, None, 0),
+                ("sam", "I like birds", None, 0),
+                ("alex", None, "Birdsville", 50),
+                ("unrelated", "nothing here", "nowhere", 0)]:
+            user = User.signup(username, f"{username}@test.com", "password", "")
+            user.bio = bio
+            user.location = location
+            user.followers_count = followers
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up added sample data"""
+        db.session.rollback()
+        app.config['PAGE_SIZE'] = 100
+        search.user_index.clear()
+
+    def _usernames(self, page):
+        return [user.username for user in page]
+
+    def test_ranking(self):
+        with app.test_request_context():
+            page = search.search_users("Bird")
+
+            self.assertEqual(self._usernames(page),
+                             ["bird", "birdwatcher", "bigbird", "alex", "sam"])
+            self.assertIsNone(page.next_cursor)
+
+    def test_short_query_matches_prefixes(self):
+        with app.test_request_context():
+            self.assertEqual(self._usernames(search.search_users("bi")),
+                             ["bird", "bigbird", "birdwatcher"])
+
+    def test_backends_agree(self):
+        with app.test_request_context():
+            for term in ("bird", "bi", "b", "ird", "birds", "ville", "zz"):
+                self.assertEqual(
+                    self._usernames(search._search_sql(term, 0, 10)),
+                    self._usernames(search._search_index(term, 0, 10)),
+                    term)
+
+    def test_no_trigram_warning(self):
+        connection = db.session.connection()
+        if search.has_trigram_support(connection):
+            self.skipTest("pg_trgm is installed")
+
+        app.extensions.pop('search', None)
+        with app.test_request_context():
+            with self.assertLogs(app.logger, 'WARNING'):
+                self.assertTrue(search.uses_database_search())
+            search.search_users("bird")
+
+        # The users weren't loaded into this process.
+        self.assertIsNone(search.user_index.built_at)
+
+    def test_trigram_indexes(self):
+        connection = db.session.connection()
+        if not search.install_trigram_indexes(connection):
+            self.skipTest("pg_trgm is not available")
+        db.session.commit()
+
+        with app.test_request_context():
+            self.assertTrue(search.uses_database_search())
+            self.assertEqual(self._usernames(search.search_users("bird")),
+                             ["bird", "birdwatcher", "bigbird", "alex", "sam"])
+            self.assertEqual(self._usernames(search.search_users("bi")),
+                             ["bird", "bigbird", "birdwatcher"])
+
+    def test_pages(self):
+        app.config['PAGE_SIZE'] = 2
+
+        with app.test_request_context():
+            first = search.search_users("bird")
+            second = search.search_users("bird", cursor=first.next_cursor)
+            third = search.search_users("bird", cursor=second.next_cursor)
+
+        self.assertEqual(self._usernames(first), ["bird", "birdwatcher"])
+        self.assertEqual(self._usernames(second), ["bigbird", "alex"])
+        self.assertEqual(self._usernames(third), ["sam"])
+        self.assertIsNone(third.next_cursor)
+
+    def test_index_follows_profile_changes(self):
+        with app.test_request_context():
+            self.assertEqual(self._usernames(search.search_users("heron")), [])
+
+        user = User.query.filter_by(username="unrelated").one()
+        user_id = user.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = c.post("/users/profile", data={
+                "username": "unrelated",
+                "email": "unrelated@test.com",
+                "password": "password",
+                "bio": "Heron spotter",
+            })
+            self.assertEqual(resp.status_code, 302)
+
+            resp = c.get("/users?q=heron")
+            self.assertIn("@unrelated", str(resp.data))
+
+            c.post("/users/delete")
+
+        with app.test_request_context():
+            self.assertEqual(self._usernames(search.search_users("heron")), [])
+
+    def test_search_page(self):
+        with self.client as c:
+            resp = c.get("/users?q=bird")
+            html = str(resp.data)
+
+            self.assertIn("@birdwatcher", html)
+            self.assertIn("@sam", html)
+            self.assertNotIn("@unrelated", html)
+
+
+class MessageSearchTestCase(TestCase):
+    """Test full-text message search."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        search.message_index.clear()
+
+        self.client = app.test_client()
+
+        author = User.signup("author", "author@test.com", "password", "")
+        db.session.commit()
+        self.author_id = author.id
+
+        texts = ["The heron waded into the marsh",
+                 "heron heron heron",
+                 "A kingfisher and a heron share the marsh at dawn",
+                 "Nothing about birds at all"]
+        self.ids = {}
+        for message_text in texts:
+            msg = Message(text=message_text, user_id=author.id)
+            db.session.add(msg)
+            db.session.commit()
+            self.ids[message_text] = msg.id
+
+    def tearDown(self):
+        """Clean up added sample data"""
+        db.session.rollback()
+        search.message_index.clear()
+
+    def test_tokenize(self):
+        self.assertEqual(search.tokenize("The Heron's marsh, at dawn!"),
+                         ["heron", "s", "marsh", "dawn"])
+
+    def test_index_ranking(self):
+        with app.app_context():
+            ids = search.message_index.search("heron", 0, 10)
+
+        self.assertEqual(ids[0], self.ids["heron heron heron"])
+        self.assertEqual(len(ids), 3)
+
+    def test_index_requires_every_word(self):
+        with app.app_context():
+            ids = search.message_index.search("heron marsh", 0, 10)
+            self.assertEqual(set(ids), {
+                self.ids["The heron waded into the marsh"],
+                self.ids["A kingfisher and a heron share the marsh at dawn"]})
+
+            self.assertEqual(search.message_index.search("the", 0, 10), [])
+
+    def test_index_updates(self):
+        with app.app_context():
+            search.message_index.search("heron", 0, 10)
+
+            # posted by another process: picked up by id on the next search
+            msg = Message(text="egret", user_id=self.author_id)
+            db.session.add(msg)
+            db.session.commit()
+            self.assertEqual(search.message_index.search("egret", 0, 10),
+                             [msg.id])
+
+            search.message_deleted(msg.id)
+            self.assertEqual(search.message_index.search("egret", 0, 10), [])
+
+    def test_index_late_commit(self):
+        with app.app_context():
+            search.message_index.search("heron", 0, 10)
+
+            # Another process took the next id, but its message only
+            # commits after a later one has been indexed.
+            late_id = db.session.execute(
+                "SELECT nextval('messages_id_seq')").scalar()
+            msg = Message(text="egret", user_id=self.author_id)
+            db.session.add(msg)
+            db.session.commit()
+            self.assertEqual(search.message_index.search("egret", 0, 10),
+                             [msg.id])
+
+            late = Message(id=late_id, text="egret egret",
+                           user_id=self.author_id)
+            db.session.add(late)
+            db.session.commit()
+            self.assertEqual(search.message_index.search("egret", 0, 10),
+                             [late_id, msg.id])
+
+    def test_deleted_elsewhere(self):
+        with app.app_context():
+            search.message_index.search("heron", 0, 10)
+
+            # Deleted by another process, which can't update this index.
+            Message.query.filter_by(
+                id=self.ids["heron heron heron"]).delete()
+            db.session.commit()
+
+            found = search._search_messages_index("heron", 0, 10)
+            self.assertEqual(len(found), 2)
+            self.assertNotIn(self.ids["heron heron heron"],
+                             search.message_index.docs)
+
+    def test_candidates_bounded(self):
+        app.config['SEARCH_MAX_CANDIDATES'] = 2
+        try:
+            with app.app_context():
+                ids = search.message_index.search("heron", 0, 10)
+        finally:
+            app.config['SEARCH_MAX_CANDIDATES'] = 5000
+
+        # Only the two newest matches are ranked.
+        self.assertEqual(set(ids), {
+            self.ids["heron heron heron"],
+            self.ids["A kingfisher and a heron share the marsh at dawn"]})
+
+    def test_search_page(self):
+        with self.client as c:
+            resp = c.get("/messages/search?q=kingfisher")
+            html = str(resp.data)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("A kingfisher and a heron", html)
+            self.assertNotIn("heron heron heron", html)
+
+    def test_search_pages(self):
+        app.config['PAGE_SIZE'] = 2
+        try:
+            with app.test_request_context():
+                first = search.search_messages("heron")
+                second = search.search_messages("heron",
+                                                cursor=first.next_cursor)
+        finally:
+            app.config['PAGE_SIZE'] = 100
+
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertIsNone(second.next_cursor)
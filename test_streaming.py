@@ -0,0 +1,253 @@
+"""Message stream tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_streaming.py
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+import json
+from unittest import TestCase
+
+from flask import Flask
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows
+import streaming
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FakePubSub:
+    def __init__(self, redis):
+        self.redis = redis
+        self.channels = []
+        self.closed = False
+
+    def subscribe(self, *channels):
+        if not channels:
+            raise ValueError("wrong number of arguments for 'subscribe'")
+        self.channels.extend(channels)
+        self.redis.subscribers.append(self)
+
+    def get_message(self, timeout):
+        for channel, data in self.redis.published:
+            if channel in self.channels:
+                self.redis.published.remove((channel, data))
+                return {'type': 'message', 'channel': channel, 'data': data}
+        return None
+
+    def close(self):
+        self.closed = True
+
+
+class FakeRedis:
+    def __init__(self):
+        self.published = []
+        self.subscribers = []
+
+    def publish(self, channel, data):
+        self.published.append((channel, data))
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakePubSub(self)
+
+
+def events(body):
+    """The (event, data) pairs in an event-stream body."""
+
+    found = []
+    for block in body.decode().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines()
+                      if not line.startswith(":"))
+        if 'event' in fields:
+            found.append((fields['event'], json.loads(fields['data'])))
+    return found
+
+
+class BrokerTestCase(TestCase):
+    """Test the brokers."""
+
+    def test_local(self):
+        broker = streaming.LocalBroker()
+        subscription = broker.subscribe(["user:1", "user:2"])
+
+        broker.publish("user:2", {'id': 1})
+        broker.publish("user:3", {'id': 2})
+        self.assertEqual(subscription.get(0.1), {'id': 1})
+        self.assertIsNone(subscription.get(0.01))
+
+        subscription.close()
+        self.assertEqual(dict(broker.subscribers), {})
+        broker.publish("user:1", {'id': 3})
+        self.assertIsNone(subscription.get(0.01))
+
+    def test_local_drops_when_full(self):
+        broker = streaming.LocalBroker(max_queued=2)
+        subscription = broker.subscribe(["user:1"])
+
+        for i in range(3):
+            broker.publish("user:1", {'id': i})
+
+        self.assertEqual(subscription.get(0.1), {'id': 0})
+        self.assertEqual(subscription.get(0.1), {'id': 1})
+        self.assertIsNone(subscription.get(0.01))
+
+    def test_redis(self):
+        client = FakeRedis()
+        broker = streaming.RedisBroker(client)
+        subscription = broker.subscribe(["user:1"])
+
+        broker.publish("user:1", {'id': 1})
+        self.assertEqual(client.published, [("warbler:user:1", '{"id": 1}')])
+        self.assertEqual(subscription.get(0.1), {'id': 1})
+        self.assertIsNone(subscription.get(0.01))
+
+        subscription.close()
+        self.assertTrue(client.subscribers[0].closed)
+
+    def test_redis_no_channels(self):
+        subscription = streaming.RedisBroker(FakeRedis()).subscribe([])
+        self.assertIsNone(subscription.get(0.01))
+        subscription.close()
+
+    def test_local_refused_with_workers(self):
+        other = Flask(__name__)
+        other.config.update(STREAM_BROKER='local', WEB_CONCURRENCY=2)
+        with self.assertRaises(RuntimeError):
+            streaming.init_app(other)
+
+        other.config['STREAM_BROKER'] = 'redis'
+        streaming.init_app(other)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            streaming.make_broker('carrier-pigeon')
+
+
+class StreamViewTestCase(TestCase):
+    """Test GET /stream."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        reader = User.signup("reader", "reader@test.com", "password", "")
+        author = User.signup("author", "author@test.com", "password", "")
+        stranger = User.signup("stranger", "stranger@test.com", "password", "")
+        db.session.commit()
+        reader.following.append(author)
+        db.session.commit()
+
+        self.reader_id = reader.id
+        self.author_id = author.id
+        self.stranger_id = stranger.id
+
+        app.config['STREAM_BROKER'] = 'local'
+        app.config['STREAM_KEEPALIVE'] = 0.1
+        app.config['STREAM_MAX_SECONDS'] = 0.5
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['STREAM_BROKER'] = None
+        app.config['STREAM_KEEPALIVE'] = 15
+        app.config['STREAM_MAX_SECONDS'] = 300
+        app.extensions.pop('stream_broker', None)
+        app.extensions.pop('user_cache', None)
+        app.extensions.pop('fragment_cache', None)
+
+    def client_for(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client
+
+    def post(self, user_id, text):
+        resp = self.client_for(user_id).post("/messages/new",
+                                             data={"text": text})
+        self.assertEqual(resp.status_code, 302)
+
+    def test_pushes_followed_messages(self):
+        resp = self.client_for(self.reader_id).get("/stream", buffered=False)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        self.assertEqual(resp.headers['Cache-Control'], "no-cache")
+
+        self.post(self.author_id, "hello, followers")
+        self.post(self.stranger_id, "hello, nobody")
+
+        body = b"".join(resp.response)
+        resp.close()
+
+        self.assertTrue(body.startswith(b"retry: 3000\n\n"))
+        self.assertIn(b": keepalive\n\n", body)
+
+        [(name, data)] = events(body)
+        self.assertEqual(name, "warble")
+        self.assertEqual(data['text'], "hello, followers")
+        self.assertEqual(data['user'], {'id': self.author_id,
+                                        'username': "author",
+                                        'image_url': ""})
+        self.assertEqual(
+            data['id'], Message.query.filter_by(user_id=self.author_id).one().id)
+
+        # The stream unsubscribed when it ended.
+        self.assertEqual(dict(app.extensions['stream_broker'].subscribers), {})
+
+    def test_follows_nobody(self):
+        app.extensions['stream_broker'] = streaming.RedisBroker(FakeRedis())
+
+        resp = self.client_for(self.stranger_id).get("/stream", buffered=False)
+        self.assertEqual(resp.status_code, 200)
+        body = b"".join(resp.response)
+        resp.close()
+
+        self.assertIn(b": keepalive\n\n", body)
+        self.assertEqual(events(body), [])
+
+    def test_broker_down(self):
+        class DownBroker:
+            def publish(self, channel, event):
+                raise ConnectionError()
+
+            def subscribe(self, channels):
+                raise ConnectionError()
+
+        app.extensions['stream_broker'] = DownBroker()
+
+        resp = self.client_for(self.reader_id).get("/stream")
+        self.assertEqual(resp.status_code, 503)
+
+        self.post(self.author_id, "still saved")
+        self.assertEqual(Message.query.filter_by(text="still saved").count(), 1)
+
+    def test_off_by_default(self):
+        app.config['STREAM_BROKER'] = None
+
+        resp = self.client_for(self.reader_id).get("/stream")
+        self.assertEqual(resp.status_code, 404)
+        home = self.client_for(self.reader_id).get("/")
+        self.assertNotIn(b"stream.js", home.data)
+
+        self.post(self.author_id, "not pushed")
+        self.assertNotIn('stream_broker', app.extensions)
+
+    def test_login_required(self):
+        resp = app.test_client().get("/stream")
+        self.assertEqual(resp.status_code, 401)
+        self.assertIn('error', resp.json)
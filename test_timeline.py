@@ -0,0 +1,193 @@
+"""Home timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from unittest import TestCase
+from models import db, User, Message, Follows, TimelineEntry
+import timeline
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TimelineTestCase(TestCase):
+    """Test fan-out-on-write timelines."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        TimelineEntry.query.delete()
+
+        app.config['TIMELINE_FANOUT_THRESHOLD'] = 10000
+        timeline.reset_celebrity_cache()
+
+        reader = User.signup("reader", "reader@test.com", "password", "")
+        author = User.signup("author", "author@test.com", "password", "")
+        db.session.commit()
+
+        self.reader_id = reader.id
+        self.author_id = author.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Clean up added sample data"""
+        db.session.rollback()
+        app.config['TIMELINE_FANOUT_THRESHOLD'] = 10000
+        timeline.reset_celebrity_cache()
+
+    def _login(self, client, user_id):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def _entries(self):
+        return (TimelineEntry
+                .query
+                .filter(TimelineEntry.owner_id == self.reader_id)
+                .count())
+
+    def test_follow_backfills_and_unfollow_trims(self):
+        db.session.add(Message(text="older warble", user_id=self.author_id))
+        db.session.commit()
+
+        with self.client as c:
+            self._login(c, self.reader_id)
+
+            c.post(f"/users/follow/{self.author_id}")
+            self.assertEqual(self._entries(), 1)
+
+            resp = c.get("/")
+            self.assertIn("older warble", str(resp.data))
+
+            c.post(f"/users/stop-following/{self.author_id}")
+            self.assertEqual(self._entries(), 0)
+
+    def test_backfill_twice(self):
+        db.session.add(Message(text="older warble", user_id=self.author_id))
+        db.session.add(Follows(user_being_followed_id=self.author_id,
+                               user_following_id=self.reader_id))
+        db.session.commit()
+
+        with app.app_context():
+            timeline.backfill(self.reader_id, self.author_id)
+            timeline.backfill(self.reader_id, self.author_id)
+            db.session.commit()
+
+        self.assertEqual(self._entries(), 1)
+
+    def test_follow_twice(self):
+        db.session.add(Message(text="older warble", user_id=self.author_id))
+        db.session.commit()
+
+        with self.client as c:
+            self._login(c, self.reader_id)
+
+            for i in range(2):
+                resp = c.post(f"/users/follow/{self.author_id}")
+                self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(self._entries(), 1)
+
+    def test_new_message_fans_out(self):
+        db.session.add(Follows(user_being_followed_id=self.author_id,
+                               user_following_id=self.reader_id))
+        db.session.commit()
+
+        with self.client as c:
+            self._login(c, self.author_id)
+            c.post("/messages/new", data={"text": "fresh warble"})
+
+        self.assertEqual(self._entries(), 1)
+
+        with self.client as c:
+            self._login(c, self.reader_id)
+            resp = c.get("/")
+            self.assertIn("fresh warble", str(resp.data))
+
+    def test_celebrity_messages_merged_at_read_time(self):
+        app.config['TIMELINE_FANOUT_THRESHOLD'] = 0
+
+        db.session.add(Follows(user_being_followed_id=self.author_id,
+                               user_following_id=self.reader_id))
+        db.session.commit()
+        User.recount()
+        db.session.commit()
+
+        with self.client as c:
+            self._login(c, self.author_id)
+            c.post("/messages/new", data={"text": "celebrity warble"})
+
+        self.assertEqual(self._entries(), 0)
+
+        with self.client as c:
+            self._login(c, self.reader_id)
+            resp = c.get("/")
+            self.assertIn("celebrity warble", str(resp.data))
+
+    def test_former_celebrity_keeps_messages(self):
+        app.config['TIMELINE_FANOUT_THRESHOLD'] = 0
+
+        db.session.add(Follows(user_being_followed_id=self.author_id,
+                               user_following_id=self.reader_id))
+        db.session.commit()
+        User.recount()
+        db.session.commit()
+
+        with self.client as c:
+            self._login(c, self.author_id)
+            c.post("/messages/new", data={"text": "celebrity warble"})
+
+            # Below the threshold again: new posts are fanned out, and the
+            # one that wasn't is still merged in.
+            app.config['TIMELINE_FANOUT_THRESHOLD'] = 10
+            c.post("/messages/new", data={"text": "ordinary warble"})
+
+        self.assertEqual(self._entries(), 1)
+        self.assertIsNotNone(User.query.get(self.author_id).celebrity_since)
+
+        with self.client as c:
+            self._login(c, self.reader_id)
+            resp = c.get("/")
+            self.assertIn("celebrity warble", str(resp.data))
+            self.assertIn("ordinary warble", str(resp.data))
+
+        with app.app_context():
+            timeline.rebuild()
+            db.session.commit()
+
+        self.assertEqual(self._entries(), 2)
+        self.assertIsNone(User.query.get(self.author_id).celebrity_since)
+
+    def test_rebuild(self):
+        db.session.add(Follows(user_being_followed_id=self.author_id,
+                               user_following_id=self.reader_id))
+        db.session.add(Message(text="seeded warble", user_id=self.author_id))
+        db.session.commit()
+        self.assertEqual(self._entries(), 0)
+
+        with app.app_context():
+            timeline.rebuild()
+            db.session.commit()
+
+        self.assertEqual(self._entries(), 1)
@@ -0,0 +1,168 @@
+"""Current user cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_user_context.py
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from unittest import TestCase
+from flask import Flask
+from sqlalchemy import event
+from models import db, User, Message, Follows
+from cache import LRUCache, RedisCache
+import user_context
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FakeRedis:
+    """Just enough of redis.Redis for RedisCache."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value.encode()
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class CacheTestCase(TestCase):
+    """Test the cache backends."""
+
+    def test_lru_eviction(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_lru_expiry(self):
+        cache = LRUCache(maxsize=2, ttl=-1)
+        cache.set("a", 1)
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+    def test_redis(self):
+        client = FakeRedis()
+        cache = RedisCache(client, prefix="test:")
+        cache.set("a", {"following_ids": [1, 2]})
+
+        self.assertIn("test:a", client.data)
+        self.assertEqual(cache.get("a"), {"following_ids": [1, 2]})
+
+        cache.delete("a")
+        self.assertIsNone(cache.get("a"))
+
+
+class UserContextTestCase(TestCase):
+    """Test the cached current user."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.client = app.test_client()
+
+        user = User.signup("cached", "cached@test.com", "password", "")
+        other = User.signup("other", "other@test.com", "password", "")
+        db.session.commit()
+
+        self.user_id = user.id
+        self.other_id = other.id
+
+    def tearDown(self):
+        """Clean up added sample data"""
+        db.session.rollback()
+        app.extensions.pop('user_cache', None)
+
+    def _users_queries(self, url):
+        """Statements against `users` while serving `url`."""
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+                resp = c.get(url)
+                self.assertEqual(resp.status_code, 200)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+
+        return [s for s in statements if "FROM users" in s]
+
+    def _check_snapshot_reused(self):
+        self._users_queries("/messages/search")
+        self.assertEqual(self._users_queries("/messages/search"), [])
+
+    def test_snapshot_reused_between_requests(self):
+        self._check_snapshot_reused()
+
+    def test_redis_backend(self):
+        client = FakeRedis()
+        app.extensions['user_cache'] = RedisCache(client, prefix="test:")
+
+        self._check_snapshot_reused()
+        self.assertIn(f"test:{self.user_id}", client.data)
+
+    def test_follow_invalidates(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.get("/")
+            c.post(f"/users/follow/{self.other_id}")
+            resp = c.get(f"/users/{self.other_id}")
+
+            self.assertIn("Unfollow", str(resp.data))
+
+            with app.test_request_context():
+                current = user_context.load(self.user_id)
+                self.assertEqual(current.following_count, 1)
+                self.assertEqual(current.following_ids, {self.other_id})
+
+    def test_memory_refused_with_workers(self):
+        other = Flask(__name__)
+        other.config.update(USER_CACHE_BACKEND='memory', WEB_CONCURRENCY=2)
+        with self.assertRaises(RuntimeError):
+            user_context.init_app(other)
+
+        other.config['USER_CACHE_BACKEND'] = 'null'
+        user_context.init_app(other)
+
+    def test_deleted_user(self):
+        with app.test_request_context():
+            self.assertIsNone(user_context.load(-1))
@@ -16,7 +16,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 from app import app
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Liked_Message, IdSet
 
 
 # Create our tables (we do this here, so we only create the tables
@@ -116,4 +116,43 @@ class UserModelTestCase(TestCase):
 
         #password failing authentication
         u2_fail_pw = User.authenticate("testuser2", "testtest")
-        self.assertEqual(u2_fail_pw, False)
\ No newline at end of file
+        self.assertEqual(u2_fail_pw, False)
+    def test_recount(self):
+        """Does recount repair drifted counters?"""
+
+        u = User.signup("counted", "counted@test.com", "HASHED_PASSWORD", "")
+        u2 = User.signup("counted2", "counted2@test.com", "HASHED_PASSWORD", "")
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=u.id,
+                               user_following_id=u2.id))
+        msg = Message(text="counted warble", user_id=u.id)
+        db.session.add(msg)
+        db.session.commit()
+        db.session.add(Liked_Message(liker_id=u2.id, liked_msg_id=msg.id))
+        db.session.commit()
+
+        # rows were added directly, so the counters have drifted
+        self.assertEqual(u.followers_count, 0)
+
+        User.recount()
+        db.session.commit()
+
+        self.assertEqual(u.messages_count, 1)
+        self.assertEqual(u.followers_count, 1)
+        self.assertEqual(u.following_count, 0)
+        self.assertEqual(u2.following_count, 1)
+        self.assertEqual(u2.likes_count, 1)
+        self.assertEqual(msg.likes_count, 1)
+
+    def test_id_set(self):
+        """Does IdSet behave like a set of ints?"""
+
+        ids = IdSet([5, 1, 3])
+
+        self.assertIn(3, ids)
+        self.assertNotIn(2, ids)
+        self.assertNotIn(6, ids)
+        self.assertEqual(list(ids), [1, 3, 5])
+        self.assertEqual(len(ids), 3)
+        self.assertNotIn(1, IdSet())
@@ -8,7 +8,10 @@
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
 # connected to the database
+import re
+
 from models import User, db, Follows, Message
+from sqlalchemy import event
 from unittest import TestCase
 from app import app
 import os
@@ -153,3 +156,126 @@ class UserViewTestCase(TestCase):
 
             self._assert200(response)
             self.assertIn('Access unauthorized.', str(response.data))
+
+    def test_follow_counters(self):
+        user5_id = self.user5.id
+        user6_id = self.user6.id
+
+        with self.client as client:
+            with client.session_transaction() as s:
+                s["curr_user"] = user5_id
+
+            client.post(f"/users/follow/{user6_id}")
+            self.assertEqual(User.query.get(user5_id).following_count, 1)
+            self.assertEqual(User.query.get(user6_id).followers_count, 1)
+
+            client.post(f"/users/stop-following/{user6_id}")
+            self.assertEqual(User.query.get(user5_id).following_count, 0)
+            self.assertEqual(User.query.get(user6_id).followers_count, 0)
+
+    def test_repeated_follow(self):
+        user5_id = self.user5.id
+        user6_id = self.user6.id
+
+        with self.client as client:
+            with client.session_transaction() as s:
+                s["curr_user"] = user5_id
+
+            # A double click, or a stale Follow button.
+            for i in range(2):
+                resp = client.post(f"/users/follow/{user6_id}")
+                self.assertEqual(resp.status_code, 302)
+            self.assertEqual(User.query.get(user5_id).following_count, 1)
+            self.assertEqual(User.query.get(user6_id).followers_count, 1)
+            self.assertEqual(Follows.query.filter_by(
+                user_following_id=user5_id).count(), 1)
+
+            for i in range(2):
+                resp = client.post(f"/users/stop-following/{user6_id}")
+                self.assertEqual(resp.status_code, 302)
+            self.assertEqual(User.query.get(user5_id).following_count, 0)
+            self.assertEqual(User.query.get(user6_id).followers_count, 0)
+
+
+class FollowListTestCase(TestCase):
+    """Test paging through followers and following."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Follows.query.delete()
+
+        users = [User.signup(username=f"user{i}", email=f"user{i}@test.com",
+                             password="testtest", image_url="")
+                 for i in range(6)]
+        db.session.commit()
+
+        self.celebrity_id, self.viewer_id = users[0].id, users[1].id
+        self.fan_ids = [user.id for user in users[1:]]
+
+        for fan_id in self.fan_ids:
+            db.session.add(Follows(user_being_followed_id=self.celebrity_id,
+                                   user_following_id=fan_id))
+            db.session.add(Follows(user_being_followed_id=fan_id,
+                                   user_following_id=self.celebrity_id))
+        db.session.add(Follows(user_being_followed_id=self.fan_ids[2],
+                               user_following_id=self.viewer_id))
+        db.session.commit()
+
+        app.config['PAGE_SIZE'] = 2
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['PAGE_SIZE'] = 100
+        app.extensions.pop('fragment_cache', None)
+        app.extensions.pop('user_cache', None)
+
+    def _pages(self, url):
+        """The usernames and Unfollow buttons on each page of `url`."""
+
+        pages = []
+        with self.client as client:
+            with client.session_transaction() as s:
+                s["curr_user"] = self.viewer_id
+
+            while url:
+                html = client.get(url).data.decode()
+                pages.append((re.findall(r"<p>@(\w+)</p>", html),
+                              html.count("btn-sm\">Unfollow<")))
+                next_page = re.search(r'href="([^"]+)"\s+class="[^"]*"'
+                                      r'\s+id="next-page"', html)
+                url = next_page and next_page.group(1).replace("&amp;", "&")
+
+        return pages
+
+    def test_followers_pages(self):
+        pages = self._pages(f"/users/{self.celebrity_id}/followers")
+
+        self.assertEqual([names for names, unfollows in pages],
+                         [["user1", "user2"], ["user3", "user4"], ["user5"]])
+        # The viewer follows user0 (not listed here) and user3.
+        self.assertEqual([unfollows for names, unfollows in pages], [0, 1, 0])
+
+    def test_following_pages(self):
+        pages = self._pages(f"/users/{self.celebrity_id}/following")
+
+        self.assertEqual(sum((names for names, unfollows in pages), []),
+                         [f"user{i}" for i in range(1, 6)])
+        self.assertEqual(sum(unfollows for names, unfollows in pages), 1)
+
+    def test_projected(self):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            self._pages(f"/users/{self.celebrity_id}/followers")
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+
+        listing = [statement for statement in statements
+                   if "follows_1" in statement]
+        self.assertEqual(len(listing), 3)
+        self.assertNotIn("users.password", " ".join(listing))
@@ -0,0 +1,206 @@
+"""Write-behind queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_writebehind.py
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+import tempfile
+import time
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows, Liked_Message
+import writebehind
+from writebehind import FOLLOW, LIKE
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class WriteBehindTestCase(TestCase):
+    """Test queueing likes and follows and applying them."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        fan = User.signup("fan", "fan@test.com", "password", "")
+        author = User.signup("author", "author@test.com", "password", "")
+        db.session.commit()
+        message = Message(text="Popular", user_id=author.id)
+        db.session.add(message)
+        db.session.commit()
+
+        self.fan_id = fan.id
+        self.author_id = author.id
+        self.message_id = message.id
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "queue.sqlite3")
+        self.queue = writebehind.WriteBehindQueue(app, self.path,
+                                                  interval=3600)
+        app.extensions['write_behind'] = self.queue
+
+    def tearDown(self):
+        self.queue.stop()
+        app.extensions.pop('write_behind')
+        app.extensions.pop('user_cache', None)
+        app.extensions.pop('fragment_cache', None)
+        db.session.rollback()
+        self.directory.cleanup()
+
+    def counts(self):
+        db.session.remove()
+        fan = User.query.get(self.fan_id)
+        author = User.query.get(self.author_id)
+        message = Message.query.get(self.message_id)
+        return {
+            'likes': Liked_Message.query.count(),
+            'follows': Follows.query.count(),
+            'fan_likes': fan.likes_count,
+            'fan_following': fan.following_count,
+            'author_followers': author.followers_count,
+            'message_likes': message.likes_count,
+        }
+
+    def test_coalesce(self):
+        for state in (True, False, True):
+            self.queue.enqueue(LIKE, self.fan_id, self.message_id, state)
+
+        self.assertEqual(self.queue.size(), 1)
+        self.assertEqual(self.queue.pending(self.fan_id),
+                         {LIKE: {self.message_id: True}, FOLLOW: {}})
+
+    def test_flush(self):
+        self.queue.enqueue(LIKE, self.fan_id, self.message_id, True)
+        self.queue.enqueue(FOLLOW, self.fan_id, self.author_id, True)
+
+        self.assertEqual(self.queue.flush(), 2)
+        self.assertEqual(self.queue.size(), 0)
+        self.assertEqual(self.counts(), {
+            'likes': 1, 'follows': 1, 'fan_likes': 1, 'fan_following': 1,
+            'author_followers': 1, 'message_likes': 1})
+
+        self.queue.enqueue(LIKE, self.fan_id, self.message_id, False)
+        self.queue.enqueue(FOLLOW, self.fan_id, self.author_id, False)
+        self.queue.flush()
+        self.assertEqual(set(self.counts().values()), {0})
+
+    def test_toggle_back_is_noop(self):
+        self.queue.enqueue(LIKE, self.fan_id, self.message_id, True)
+        self.queue.enqueue(LIKE, self.fan_id, self.message_id, False)
+        self.queue.flush()
+
+        self.assertEqual(set(self.counts().values()), {0})
+
+    def test_apply_twice(self):
+        rows = [(self.fan_id, LIKE, self.message_id, 1, 1)]
+        with app.app_context():
+            writebehind.apply(rows)
+            writebehind.apply(rows)
+            db.session.commit()
+
+        self.assertEqual(self.counts()['message_likes'], 1)
+
+    def test_deleted_target(self):
+        self.queue.enqueue(LIKE, self.fan_id, self.message_id, True)
+        Message.query.delete()
+        db.session.commit()
+
+        self.assertEqual(self.queue.flush(), 1)
+        self.assertEqual(Liked_Message.query.count(), 0)
+
+    def test_changed_during_flush(self):
+        self.queue.enqueue(LIKE, self.fan_id, self.message_id, True)
+
+        apply = writebehind.apply
+
+        def apply_then_unlike(rows):
+            self.queue.enqueue(LIKE, self.fan_id, self.message_id, False)
+            return apply(rows)
+
+        writebehind.apply = apply_then_unlike
+        try:
+            self.queue.flush()
+        finally:
+            writebehind.apply = apply
+
+        self.assertEqual(self.queue.pending(self.fan_id)[LIKE],
+                         {self.message_id: False})
+
+    def test_durable(self):
+        self.queue.enqueue(FOLLOW, self.fan_id, self.author_id, True)
+
+        reopened = writebehind.WriteBehindQueue(app, self.path)
+        self.assertEqual(reopened.pending(self.fan_id)[FOLLOW],
+                         {self.author_id: True})
+
+    def test_background_flush(self):
+        self.queue.interval = 0.01
+        self.queue.enqueue(LIKE, self.fan_id, self.message_id, True)
+
+        deadline = time.monotonic() + 5
+        while self.queue.size() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(self.queue.size(), 0)
+        self.assertEqual(self.counts()['likes'], 1)
+
+    def test_resume(self):
+        writebehind.resume(app)
+        self.assertIsNone(self.queue.thread)
+
+        # Left by a worker that stopped before flushing it.
+        earlier = writebehind.WriteBehindQueue(app, self.path)
+        earlier._execute(writebehind.ENQUEUE,
+                         (self.fan_id, LIKE, self.message_id, 1))
+
+        self.queue.interval = 0.01
+        writebehind.resume(app)
+
+        deadline = time.monotonic() + 5
+        while self.queue.size() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(self.queue.size(), 0)
+        self.assertEqual(self.counts()['likes'], 1)
+
+    def test_routes_show_pending(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.fan_id
+
+            c.post("/like", data={"message_id": self.message_id},
+                   headers={"Referer": "/"})
+            c.post(f"/users/follow/{self.author_id}")
+            self.assertEqual(Liked_Message.query.count(), 0)
+
+            resp = c.get(f"/users/{self.author_id}")
+            html = str(resp.data)
+            self.assertIn("fas fa-star", html)
+            self.assertIn("Unfollow", html)
+
+            resp = c.get("/")
+            self.assertIn('/following">1</a>', str(resp.data))
+
+            # Liking again takes the queued like into account.
+            c.post("/like", data={"message_id": self.message_id},
+                   headers={"Referer": "/"})
+            self.assertEqual(self.queue.pending(self.fan_id)[LIKE],
+                             {self.message_id: False})
@@ -0,0 +1,253 @@
+"""Materialized home timelines for Warbler.
+
+Each message is copied into a `timeline_entries` row for every follower
+of its author when it is posted (fan-out-on-write), so reading a home
+timeline is a single range scan over the reader's own entries.
+
+Authors with more followers than TIMELINE_FANOUT_THRESHOLD are not fanned
+out: copying their messages would mean thousands of inserts per post.
+Their messages are merged into the reader's timeline at read time instead
+(fan-out-on-read).
+
+The first post that skips fan-out sets the author's `celebrity_since`,
+and from then on their messages are merged at read time whatever their
+follower count, since readers' entries are missing the messages posted
+while they were above the threshold. Only rebuild() clears the mark, as
+it rematerializes every timeline.
+"""
+
+import time
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import literal
+from sqlalchemy.dialects import postgresql
+
+from models import db, Follows, Message, TimelineEntry, User
+from pagination import (Page, encode_cursor, page_of, paginate,
+                        per_page_default)
+
+DEFAULT_FANOUT_THRESHOLD = 10000
+DEFAULT_BACKFILL_LIMIT = 100
+CELEBRITY_CACHE_SECONDS = 60
+
+_celebrity_cache = {"expires": 0, "ids": frozenset()}
+
+
+def _config(key, default):
+    return current_app.config.get(key, default)
+
+
+def celebrity_ids():
+    """Return the ids of users whose messages are merged at read time.
+
+    The set comes from the indexed `users.celebrity_since` column and is
+    kept for CELEBRITY_CACHE_SECONDS, so timeline reads rarely pay for it.
+    """
+
+    cache = _celebrity_cache
+
+    if cache["expires"] < time.monotonic():
+        rows = (db.session
+                .query(User.id)
+                .filter(User.celebrity_since.isnot(None))
+                .all())
+        cache["ids"] = frozenset(user_id for (user_id,) in rows)
+        cache["expires"] = time.monotonic() + CELEBRITY_CACHE_SECONDS
+
+    return cache["ids"]
+
+
+def reset_celebrity_cache():
+    """Forget the cached celebrity set (used by tests and bulk loads)."""
+
+    _celebrity_cache["expires"] = 0
+
+
+def fan_out(message):
+    """Copy `message` into the timelines of its author's followers.
+
+    Must be called after the message has been flushed (so it has an id);
+    the inserts join the caller's transaction. If the author is above the
+    fan-out threshold, marks them as a celebrity instead.
+    """
+
+    threshold = _config('TIMELINE_FANOUT_THRESHOLD', DEFAULT_FANOUT_THRESHOLD)
+    followers_count = (db.session
+                       .query(User.followers_count)
+                       .filter(User.id == message.user_id)
+                       .scalar())
+
+    if followers_count > threshold:
+        (User
+         .query
+         .filter(User.id == message.user_id, User.celebrity_since.is_(None))
+         .update({User.celebrity_since: datetime.utcnow()},
+                 synchronize_session=False))
+        return
+
+    followers = (db.session
+                 .query(Follows.user_following_id,
+                        literal(message.id),
+                        literal(message.user_id),
+                        literal(message.timestamp))
+                 .filter(Follows.user_being_followed_id == message.user_id))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['owner_id', 'message_id', 'author_id', 'timestamp'],
+            followers.subquery().select()))
+
+
+def backfill(follower_id, followed_id):
+    """Add `followed_id`'s most recent messages to `follower_id`'s timeline.
+
+    Messages already in the timeline are skipped, so it is safe to run
+    again, or over entries an earlier fan-out made.
+    """
+
+    if followed_id in celebrity_ids():
+        return
+
+    limit = _config('TIMELINE_BACKFILL_LIMIT', DEFAULT_BACKFILL_LIMIT)
+    recent = (db.session
+              .query(literal(follower_id),
+                     Message.id,
+                     Message.user_id,
+                     Message.timestamp)
+              .filter(Message.user_id == followed_id)
+              .order_by(Message.timestamp.desc())
+              .limit(limit))
+    columns = ['owner_id', 'message_id', 'author_id', 'timestamp']
+
+    if db.session.connection().dialect.name == 'postgresql':
+        insert = (postgresql.insert(TimelineEntry.__table__)
+                  .from_select(columns, recent.subquery().select())
+                  .on_conflict_do_nothing())
+    else:
+        present = (db.session
+                   .query(TimelineEntry.message_id)
+                   .filter(TimelineEntry.owner_id == follower_id))
+        missing = recent.filter(~Message.id.in_(present))
+        insert = TimelineEntry.__table__.insert().from_select(
+            columns, missing.subquery().select())
+
+    db.session.execute(insert)
+
+
+def trim(follower_id, followed_id):
+    """Remove `followed_id`'s messages from `follower_id`'s timeline."""
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.owner_id == follower_id,
+             TimelineEntry.author_id == followed_id)
+     .delete(synchronize_session=False))
+
+
+def rebuild():
+    """Rematerialize every timeline from `follows` and `messages`.
+
+    Used after bulk loads (seed.py) that bypass the write paths. Authors
+    above the fan-out threshold are marked as celebrities; every other
+    author's messages are materialized, so their marks are cleared.
+    """
+
+    threshold = _config('TIMELINE_FANOUT_THRESHOLD', DEFAULT_FANOUT_THRESHOLD)
+    above = User.followers_count > threshold
+    (User
+     .query
+     .filter(above, User.celebrity_since.is_(None))
+     .update({User.celebrity_since: datetime.utcnow()},
+             synchronize_session=False))
+    (User
+     .query
+     .filter(~above, User.celebrity_since.isnot(None))
+     .update({User.celebrity_since: None}, synchronize_session=False))
+
+    reset_celebrity_cache()
+    celebrities = celebrity_ids()
+
+    TimelineEntry.query.delete(synchronize_session=False)
+
+    entries = (db.session
+               .query(Follows.user_following_id,
+                      Message.id,
+                      Message.user_id,
+                      Message.timestamp)
+               .join(Message,
+                     Message.user_id == Follows.user_being_followed_id))
+    if celebrities:
+        entries = entries.filter(~Message.user_id.in_(celebrities))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['owner_id', 'message_id', 'author_id', 'timestamp'],
+            entries.subquery().select()))
+
+
+def home_timeline(user, cursor=None, per_page=None, query=None):
+    """Return a Page of the most recent messages from users `user` follows.
+
+    Reads the materialized entries, then merges in messages from any
+    followed accounts marked as celebrities. Both sources are
+    keyset-paginated on (timestamp, message id).
+
+    `query` makes the query the messages are read with; the default,
+    Message.timeline_query, loads Message objects. Its rows need `id`
+    and `timestamp` attributes.
+    """
+
+    if per_page is None:
+        per_page = per_page_default()
+
+    if query is None:
+        query = Message.timeline_query
+
+    entries = paginate(
+        (query()
+         .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+         .filter(TimelineEntry.owner_id == user.id)),
+        [TimelineEntry.timestamp, TimelineEntry.message_id],
+        cursor=cursor,
+        per_page=per_page,
+        key=message_key)
+
+    celebrities = celebrity_ids()
+    if not celebrities:
+        return entries
+
+    followed_celebrities = [
+        user_id for (user_id,) in (db.session
+                                   .query(Follows.user_being_followed_id)
+                                   .filter(Follows.user_following_id == user.id,
+                                           Follows.user_being_followed_id
+                                           .in_(celebrities)))]
+    if not followed_celebrities:
+        return entries
+
+    merged = paginate(
+        (query()
+         .filter(Message.user_id.in_(followed_celebrities))),
+        [Message.timestamp, Message.id],
+        cursor=cursor,
+        per_page=per_page,
+        key=message_key)
+
+    # An author who crossed the threshold may have entries on both sides.
+    unique = {msg.id: msg for msg in entries.items + merged.items}.values()
+    messages = sorted(unique, key=message_key, reverse=True)
+
+    if entries.next_cursor or merged.next_cursor:
+        # Either source may hold older messages than the ones shown, so
+        # there is another page even if this one came out short.
+        messages = messages[:per_page]
+        return Page(messages, encode_cursor(message_key(messages[-1])))
+
+    return page_of(messages, per_page, message_key)
+
+
+def message_key(message):
+    """The (timestamp, id) sort key shared by every message feed."""
+
+    return [message.timestamp, message.id]
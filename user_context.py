@@ -0,0 +1,211 @@
+"""The logged-in user, loaded from a cached snapshot.
+
+Every request needs the current user's profile, counts and who they
+follow. Rather than loading the User row (and then its relationships)
+before each request, a compact snapshot is cached under the user's id
+and turned into a CurrentUser. Anything the snapshot doesn't hold is
+loaded from the database on first use.
+
+The cache backend comes from the USER_CACHE_* settings. Routes that
+change what a snapshot holds call invalidate() for each affected user.
+invalidate() only reaches other workers through a shared backend, so
+init_app() refuses 'memory' when WEB_CONCURRENCY is more than 1.
+"""
+
+from flask import current_app
+
+from cache import make_cache
+from models import db, Follows, IdSet, User
+
+SNAPSHOT_FIELDS = (
+    'id',
+    'username',
+    'email',
+    'image_url',
+    'header_image_url',
+    'bio',
+    'location',
+    'messages_count',
+    'followers_count',
+    'following_count',
+    'likes_count',
+    'version',
+)
+
+
+class CurrentUser:
+    """The logged-in user, backed by a snapshot.
+
+    Snapshot fields read straight from the snapshot; other attributes
+    and methods (relationships, release_counts, ...) are served by the
+    User row, loaded once per request through `model`. Assign to the
+    model, not to this object.
+    """
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+        self._model = None
+        self._following_ids = None
+        self._pending_likes = {}
+        self._pending_follows = {}
+        self.pending = ()
+
+    def __getattr__(self, name):
+        snapshot = self.__dict__['_snapshot']
+        if name in snapshot:
+            return snapshot[name]
+
+        return getattr(self.model, name)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+    @property
+    def model(self):
+        """The User row for this user, loaded on first use."""
+
+        if self._model is None:
+            self._model = User.query.get(self.id)
+
+        return self._model
+
+    @property
+    def following_ids(self):
+        """IdSet of the users this user follows."""
+
+        if self._following_ids is None:
+            self._following_ids = IdSet.from_sorted(
+                self._snapshot['following_ids'])
+
+        return self._following_ids
+
+    def is_following(self, other_user):
+        """Is this user following `other_user`?"""
+
+        return other_user.id in self.following_ids
+
+    def follows(self, user_id, stored):
+        """Does this user follow `user_id`? `stored` is the database's answer.
+
+        A queued follow or unfollow (see overlay) overrides it.
+        """
+
+        return self._pending_follows.get(user_id, stored)
+
+    def liked_message_ids(self, message_ids):
+        """Return the set of `message_ids` this user has liked."""
+
+        liked = User.liked_message_ids(self, message_ids)
+        for message_id in message_ids:
+            if self._pending_likes.get(message_id):
+                liked.add(message_id)
+            elif message_id in self._pending_likes:
+                liked.discard(message_id)
+
+        return liked
+
+    def overlay(self, follows, likes):
+        """Show follows and likes that are queued but not yet applied.
+
+        `follows` and `likes` map user and message ids to whether this
+        user now wants to follow or like them (see writebehind.py).
+        They're kept in `pending`, for ETags to vary on.
+        """
+
+        if not follows and not likes:
+            return
+
+        snapshot = dict(self._snapshot)
+
+        following = set(snapshot['following_ids'])
+        for user_id, state in follows.items():
+            if state != (user_id in following):
+                snapshot['following_count'] += 1 if state else -1
+                if state:
+                    following.add(user_id)
+                else:
+                    following.remove(user_id)
+        snapshot['following_ids'] = sorted(following)
+
+        if likes:
+            liked = User.liked_message_ids(self, list(likes))
+            snapshot['likes_count'] += sum(
+                state - (message_id in liked)
+                for message_id, state in likes.items())
+
+        self._snapshot = snapshot
+        self._following_ids = None
+        self._pending_likes = likes
+        self._pending_follows = follows
+        self.pending = (sorted(follows.items()), sorted(likes.items()))
+
+
+def init_app(app):
+    """Check that `app`'s user cache backend suits its worker count."""
+
+    if (app.config.get('USER_CACHE_BACKEND', 'memory') == 'memory'
+            and app.config.get('WEB_CONCURRENCY', 1) > 1):
+        raise RuntimeError(
+            "USER_CACHE_BACKEND 'memory' is only invalidated on its own "
+            "worker; use 'redis' or 'null' with more than one "
+            "(WEB_CONCURRENCY).")
+
+
+def get_cache():
+    """This app's user snapshot cache, built from its config."""
+
+    extensions = current_app.extensions
+    if 'user_cache' not in extensions:
+        config = current_app.config
+        extensions['user_cache'] = make_cache(
+            backend=config.get('USER_CACHE_BACKEND', 'memory'),
+            url=config.get('USER_CACHE_URL'),
+            maxsize=config.get('USER_CACHE_SIZE', 10000),
+            ttl=config.get('USER_CACHE_TTL', 60),
+            prefix='warbler:user:')
+
+    return extensions['user_cache']
+
+
+def take_snapshot(user_id):
+    """Read a user's snapshot from the database; None if they're gone."""
+
+    columns = [getattr(User, field) for field in SNAPSHOT_FIELDS]
+    row = db.session.query(*columns).filter(User.id == user_id).first()
+    if row is None:
+        return None
+
+    snapshot = dict(zip(SNAPSHOT_FIELDS, row))
+    snapshot['following_ids'] = [
+        followed_id for (followed_id,) in (db.session
+                                           .query(Follows.user_being_followed_id)
+                                           .filter(Follows.user_following_id
+                                                   == user_id)
+                                           .order_by(Follows
+                                                     .user_being_followed_id))]
+
+    return snapshot
+
+
+def load(user_id):
+    """Return the CurrentUser for `user_id`, or None if there is none."""
+
+    cache = get_cache()
+    key = str(user_id)
+
+    snapshot = cache.get(key)
+    if snapshot is None:
+        snapshot = take_snapshot(user_id)
+        if snapshot is None:
+            return None
+        cache.set(key, snapshot)
+
+    return CurrentUser(snapshot)
+
+
+def invalidate(*user_ids):
+    """Drop cached snapshots, after a change to what they hold."""
+
+    cache = get_cache()
+    for user_id in user_ids:
+        cache.delete(str(user_id))
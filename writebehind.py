@@ -0,0 +1,347 @@
+"""Write-behind for likes and follows.
+
+With WRITE_BEHIND_ENABLED on, like/unlike and follow/unfollow clicks
+don't touch the database. They record the state the user asked for in
+a local SQLite queue (WRITE_BEHIND_PATH) and return. A background
+thread in each worker process applies the queue in batches, every
+WRITE_BEHIND_INTERVAL seconds:
+
+- Each (user, kind, target) has one row, holding the latest state asked
+  for, so repeated toggles coalesce: like, unlike, like is one insert,
+  and like, unlike is nothing at all.
+- A batch is applied in one transaction: bulk inserts that skip
+  existing rows and bulk deletes, then one counter update per user
+  and message. Counters move only by the rows that actually changed,
+  so applying a batch twice is harmless.
+- Rows are removed from the queue once applied, unless they were
+  changed again in the meantime.
+
+The queue commits each click before returning, so it survives a worker
+crash or restart. Workers on one host share the file. A worker starts
+its flusher on the first click it queues. It also starts it when it
+comes up with clicks left in the queue, via resume(): gunicorn's
+post_fork calls resume(), and so does each app's first request.
+
+Until its actions are applied, the user sees them through pending():
+the current user's follows, likes and counts are overlaid with them
+(see CurrentUser.overlay).
+"""
+
+import os
+import sqlite3
+import threading
+from collections import Counter
+
+from flask import current_app
+from sqlalchemy import and_, tuple_
+from sqlalchemy.dialects import postgresql
+
+import fragments
+import timeline
+import user_context
+from models import db, Follows, Liked_Message, Message, User
+
+LIKE = 'like'
+FOLLOW = 'follow'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS intents (
+    user_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    target_id INTEGER NOT NULL,
+    state INTEGER NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (user_id, kind, target_id)
+)
+"""
+
+ENQUEUE = """
+INSERT INTO intents (user_id, kind, target_id, state) VALUES (?, ?, ?, ?)
+ON CONFLICT (user_id, kind, target_id)
+DO UPDATE SET state = excluded.state, version = version + 1
+"""
+
+# (table, user column, target column, table the target lives in)
+TABLES = {
+    LIKE: (Liked_Message.__table__, 'liker_id', 'liked_msg_id', Message),
+    FOLLOW: (Follows.__table__, 'user_following_id',
+             'user_being_followed_id', User),
+}
+
+
+class WriteBehindQueue:
+    """The durable queue of likes and follows, and its flusher thread."""
+
+    def __init__(self, app, path, interval=0.5, batch_size=500):
+        self.app = app
+        self.path = path
+        self.interval = interval
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.pid = None
+        self.connection = None
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def _connect(self):
+        """This process's connection to the queue; call holding the lock.
+
+        Connections and threads don't survive a fork, so a worker
+        forked from a preloaded app opens its own.
+        """
+
+        if self.pid != os.getpid():
+            self.connection = sqlite3.connect(
+                self.path, timeout=10, isolation_level=None,
+                check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode = WAL")
+            self.connection.execute("PRAGMA synchronous = FULL")
+            self.connection.execute(SCHEMA)
+            self.pid = os.getpid()
+            self.thread = None
+
+        return self.connection
+
+    def _execute(self, sql, parameters=()):
+        with self.lock:
+            return self._connect().execute(sql, parameters).fetchall()
+
+    def enqueue(self, kind, user_id, target_id, state):
+        """Ask for `user_id` to (or not to) like/follow `target_id`."""
+
+        self._execute(ENQUEUE, (user_id, kind, target_id, int(state)))
+        self.start()
+
+    def pending(self, user_id):
+        """{kind: {target_id: state}} of `user_id`'s unapplied actions."""
+
+        pending = {LIKE: {}, FOLLOW: {}}
+        for kind, target_id, state in self._execute(
+                "SELECT kind, target_id, state FROM intents WHERE user_id = ?",
+                (user_id,)):
+            pending[kind][target_id] = bool(state)
+
+        return pending
+
+    def size(self):
+        """How many actions are waiting to be applied."""
+
+        return self._execute("SELECT count(*) FROM intents")[0][0]
+
+    def flush(self):
+        """Apply a batch of the queue; return how many rows it held."""
+
+        rows = self._execute(
+            "SELECT user_id, kind, target_id, state, version FROM intents "
+            "LIMIT ?", (self.batch_size,))
+        if not rows:
+            return 0
+
+        with self.app.app_context():
+            try:
+                changed = apply(rows)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+            user_context.invalidate(*changed['users'])
+            fragments.invalidate('message', *changed['messages'])
+
+        with self.lock:
+            connection = self._connect()
+            connection.execute("BEGIN")
+            connection.executemany(
+                "DELETE FROM intents WHERE user_id = ? AND kind = ? "
+                "AND target_id = ? AND version = ?",
+                [(user_id, kind, target_id, version)
+                 for user_id, kind, target_id, state, version in rows])
+            connection.execute("COMMIT")
+
+        return len(rows)
+
+    def start(self):
+        """Start this process's flusher thread, if it isn't running."""
+
+        with self.lock:
+            self._connect()
+            if self.thread is None or not self.thread.is_alive():
+                self.stopping.clear()
+                self.thread = threading.Thread(
+                    target=self._run, name='write-behind', daemon=True)
+                self.thread.start()
+
+    def resume(self):
+        """Start the flusher if actions are waiting, e.g. after a restart."""
+
+        if self.size():
+            self.start()
+
+    def stop(self):
+        """Stop the flusher thread; the queue keeps what it hasn't applied."""
+
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                # Catch up on a backlog without waiting between batches.
+                while self.flush() == self.batch_size:
+                    pass
+            except Exception:
+                self.app.logger.exception("Write-behind flush failed")
+
+
+def _insert_missing(table, user_column, target_column, pairs):
+    """Insert the (user, target) rows that don't exist; return those."""
+
+    if not pairs:
+        return []
+
+    user_column, target_column = table.c[user_column], table.c[target_column]
+
+    if db.session.connection().dialect.name == 'postgresql':
+        insert = (postgresql.insert(table)
+                  .values([{user_column.name: user_id,
+                            target_column.name: target_id}
+                           for user_id, target_id in pairs])
+                  .on_conflict_do_nothing()
+                  .returning(user_column, target_column))
+        return db.session.execute(insert).fetchall()
+
+    inserted = []
+    for user_id, target_id in pairs:
+        exists = db.session.execute(
+            table.select().where(and_(user_column == user_id,
+                                      target_column == target_id))).first()
+        if exists is None:
+            db.session.execute(table.insert().values(
+                {user_column: user_id, target_column: target_id}))
+            inserted.append((user_id, target_id))
+
+    return inserted
+
+
+def _delete_present(table, user_column, target_column, pairs):
+    """Delete the (user, target) rows that exist; return those."""
+
+    if not pairs:
+        return []
+
+    user_column, target_column = table.c[user_column], table.c[target_column]
+
+    if db.session.connection().dialect.name == 'postgresql':
+        delete = (table.delete()
+                  .where(tuple_(user_column, target_column).in_(pairs))
+                  .returning(user_column, target_column))
+        return db.session.execute(delete).fetchall()
+
+    deleted = []
+    for user_id, target_id in pairs:
+        result = db.session.execute(table.delete().where(
+            and_(user_column == user_id, target_column == target_id)))
+        if result.rowcount:
+            deleted.append((user_id, target_id))
+
+    return deleted
+
+
+def _existing(model, ids):
+    if not ids:
+        return set()
+    return {id for (id,) in
+            db.session.query(model.id).filter(model.id.in_(ids))}
+
+
+def apply(rows):
+    """Bring the database in line with queued (user, kind, target, state)s.
+
+    Returns the ids of the users and messages whose rows changed.
+    """
+
+    changes = {}
+    for kind, (table, user_column, target_column, target_model) \
+            in TABLES.items():
+        wanted = [(user_id, target_id)
+                  for user_id, row_kind, target_id, state, version in rows
+                  if row_kind == kind and state]
+        unwanted = [(user_id, target_id)
+                    for user_id, row_kind, target_id, state, version in rows
+                    if row_kind == kind and not state]
+
+        # Skip actions on users or messages deleted since the click.
+        users = _existing(User, {user_id for user_id, target_id in wanted})
+        targets = _existing(target_model,
+                            {target_id for user_id, target_id in wanted})
+        wanted = [(user_id, target_id) for user_id, target_id in wanted
+                  if user_id in users and target_id in targets]
+
+        changes[kind] = (
+            _insert_missing(table, user_column, target_column, wanted),
+            _delete_present(table, user_column, target_column, unwanted))
+
+    user_deltas = {}
+    message_deltas = Counter()
+
+    def adjust(user_id, counter, delta):
+        user_deltas.setdefault(user_id, Counter())[counter] += delta
+
+    added, removed = changes[LIKE]
+    for pairs, delta in ((added, 1), (removed, -1)):
+        for user_id, message_id in pairs:
+            adjust(user_id, 'likes_count', delta)
+            message_deltas[message_id] += delta
+
+    added, removed = changes[FOLLOW]
+    for pairs, delta in ((added, 1), (removed, -1)):
+        for follower_id, followed_id in pairs:
+            adjust(follower_id, 'following_count', delta)
+            adjust(followed_id, 'followers_count', delta)
+    for follower_id, followed_id in added:
+        timeline.backfill(follower_id, followed_id)
+    for follower_id, followed_id in removed:
+        timeline.trim(follower_id, followed_id)
+
+    for user_id, deltas in user_deltas.items():
+        User.adjust_counts(user_id, **deltas)
+    for message_id, delta in message_deltas.items():
+        if delta:
+            Message.adjust_likes(message_id, delta)
+
+    return {'users': set(user_deltas), 'messages': set(message_deltas)}
+
+
+def get_queue():
+    """This app's write-behind queue, or None if write-behind is off."""
+
+    return current_app.extensions.get('write_behind')
+
+
+def resume(app):
+    """Apply what an earlier process left in `app`'s queue, if any."""
+
+    queue = app.extensions.get('write_behind')
+    if queue is not None:
+        queue.resume()
+
+
+def init_app(app):
+    """Queue `app`'s likes and follows, if WRITE_BEHIND_ENABLED is on."""
+
+    if not app.config.get('WRITE_BEHIND_ENABLED'):
+        return
+
+    path = app.config.get('WRITE_BEHIND_PATH') or os.path.join(
+        app.instance_path, 'writebehind.sqlite3')
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    app.extensions['write_behind'] = WriteBehindQueue(
+        app, path,
+        interval=app.config.get('WRITE_BEHIND_INTERVAL', 0.5),
+        batch_size=app.config.get('WRITE_BEHIND_BATCH_SIZE', 500))
+
+    # Not now: a preloading gunicorn master would run the thread itself.
+    app.before_first_request(lambda: resume(app))